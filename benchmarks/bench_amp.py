@@ -0,0 +1,123 @@
+"""
+Throughput and reconstruction error of fp32 vs. mixed precision training.
+
+Example:
+    python benchmarks/bench_amp.py --nsteps 50 --precision fp32 bf16
+"""
+import os
+import sys
+import time
+import json
+import argparse
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from vapor.model import VQVAE, F2F
+from vapor.util.amp import PRECISIONS, get_autocast, get_grad_scaler
+from models import GeneratorResNet
+from synthetic import synthetic_f0
+
+
+def make_case(name, batch_size, seed):
+    X = torch.from_numpy(synthetic_f0(batch_size * 4, seed=seed))
+    X = X[:, np.newaxis, :32, :32]
+    if name == "vqvae":
+        model = VQVAE(3, 3, 128, 2, 32, 512, 64, 0.25, decay=0.99)
+        x = X.repeat(1, 3, 1, 1)
+
+        def step(m, xb):
+            vq_loss, recon, _ = m(xb)
+            return recon, xb, vq_loss
+
+    elif name == "f2f":
+        model = F2F(3, 3, 64, 4, [9, 3, 1])
+        x = X.repeat(1, 3, 1, 1)
+
+        def step(m, xb):
+            return m(xb), xb, 0.0
+
+    elif name == "srgan":
+        model = GeneratorResNet(in_channels=1, out_channels=1, n_residual_blocks=4)
+        x = X
+
+        def step(m, xb):
+            return m(F.avg_pool2d(xb, 4)), xb, 0.0
+
+    else:
+        raise NotImplementedError(name)
+    return model, x, step
+
+
+def run(name, precision, nsteps, batch_size, seed):
+    torch.manual_seed(seed)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model, x, step = make_case(name, batch_size, seed)
+    model = model.to(device)
+    x = x.to(device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    scaler = get_grad_scaler(device, precision)
+
+    nwarmup = min(5, nsteps // 2)
+    t0 = time.time()
+    for i in range(nsteps):
+        if i == nwarmup:
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            t0 = time.time()
+        k = (i * batch_size) % (len(x) - batch_size + 1)
+        xb = x[k : k + batch_size]
+        optimizer.zero_grad()
+        with get_autocast(device, precision):
+            recon, target, extra = step(model, xb)
+        loss = F.mse_loss(recon.float(), target) + extra
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    elapsed = time.time() - t0
+
+    model.eval()
+    with torch.no_grad():
+        with get_autocast(device, precision):
+            recon, target, _ = step(model, x)
+        rmse = torch.sqrt(F.mse_loss(recon.float(), target)).item()
+
+    return {
+        "model": name,
+        "precision": precision,
+        "device": device.type,
+        "batch_size": batch_size,
+        "nsteps": nsteps - nwarmup,
+        "samples_per_sec": (nsteps - nwarmup) * batch_size / elapsed,
+        "rmse": rmse,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", nargs="+", default=["vqvae", "f2f", "srgan"])
+    parser.add_argument("--precision", nargs="+", default=["fp32", "bf16"])
+    parser.add_argument("--nsteps", type=int, default=50)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write results as JSON")
+    args = parser.parse_args()
+
+    results = list()
+    for name in args.models:
+        for precision in args.precision:
+            assert precision in PRECISIONS
+            r = run(name, precision, args.nsteps, args.batch_size, args.seed)
+            print(
+                "%-8s %-5s %10.1f samples/s  RMSE %g"
+                % (name, precision, r["samples_per_sec"], r["rmse"])
+            )
+            results.append(r)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,280 @@
+"""
+I/O benchmark of the ADIOS2 readers and writers on synthetic XGC and NSTX files.
+
+Writes <workdir>/restart_dir/xgc.f0.<istep>.bp, xgc.mesh.bp, the NSTX GPI file and
+recon files (X0, zlb) of the configured size, then times each case in a fresh process:
+  read_f0, read_f0 (randomread), read_f0 (fieldline), read_f0_nodes (with and
+  without untwist), read_nstx, XGC_F0_Dataset, recon.py and merge.py
+The adios2 module is wrapped to split the time into open/close, read, write and the
+rest (post-processing). Reports MB/s and peak RSS. See bench_parallel_read.py for the
+MPI-collective reads.
+
+Example:
+    python benchmarks/bench_io.py --nphi 8 --nsurf 64 --nper 256 --output io.json
+"""
+import os
+import sys
+import time
+import json
+import types
+import runpy
+import shutil
+import argparse
+import tempfile
+import multiprocessing as mp
+
+import numpy as np
+import adios2 as ad2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from synthetic import (
+    synthetic_xgc_f0,
+    xgc_windows,
+    synthetic_gpi,
+    synthetic_mesh,
+    nextnode_planes,
+)
+from bench_models import ROOT, load_script, peak_rss, git_commit
+
+CASES = (
+    "read_f0",
+    "read_f0_random",
+    "read_f0_fieldline",
+    "read_f0_nodes",
+    "read_f0_nodes_untwist",
+    "read_nstx",
+    "xgc_f0_dataset",
+    "recon",
+    "merge",
+)
+
+
+class IOStats:
+    def __init__(self):
+        self.open = 0.0
+        self.read = 0.0
+        self.write = 0.0
+        self.read_bytes = 0
+        self.write_bytes = 0
+
+
+class TimedFile:
+    """ADIOS2 file handle that accumulates the time spent in read/write/close"""
+
+    def __init__(self, f, stats):
+        self._f = f
+        self._stats = stats
+
+    def read(self, *args, **kwargs):
+        t0 = time.perf_counter()
+        out = self._f.read(*args, **kwargs)
+        self._stats.read += time.perf_counter() - t0
+        self._stats.read_bytes += getattr(out, "nbytes", 0)
+        return out
+
+    def write(self, name, value, *args, **kwargs):
+        t0 = time.perf_counter()
+        self._f.write(name, value, *args, **kwargs)
+        self._stats.write += time.perf_counter() - t0
+        self._stats.write_bytes += getattr(value, "nbytes", 0)
+
+    def close(self):
+        t0 = time.perf_counter()
+        self._f.close()
+        self._stats.open += time.perf_counter() - t0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+
+def timed_adios2(stats):
+    """A copy of the adios2 module whose open() returns TimedFile handles"""
+    module = types.ModuleType("adios2")
+    module.__dict__.update(ad2.__dict__)
+
+    def open(*args, **kwargs):
+        t0 = time.perf_counter()
+        f = ad2.open(*args, **kwargs)
+        stats.open += time.perf_counter() - t0
+        return TimedFile(f, stats)
+
+    module.open = open
+    return module
+
+
+def write_bp(fname, variables):
+    with ad2.open(fname, "w") as fw:
+        for name, value in variables.items():
+            value = np.asarray(value)
+            if value.ndim == 0:
+                ## Single value (e.g., n_n)
+                fw.write(name, value)
+            else:
+                shape = value.shape
+                fw.write(name, value.copy(), shape, [0] * len(shape), shape)
+
+
+def write_data(workdir, args):
+    os.makedirs(os.path.join(workdir, "restart_dir"), exist_ok=True)
+    mesh = synthetic_mesh(args.nsurf, args.nper)
+    write_bp(os.path.join(workdir, "xgc.mesh.bp"), mesh)
+
+    nnodes = mesh["n_n"]
+    f0 = synthetic_xgc_f0(args.nphi, nnodes, args.nmu, args.nvp, seed=args.seed)
+    fname = os.path.join(workdir, "restart_dir/xgc.f0.%05d.bp" % args.istep)
+    write_bp(fname, {"i_f": f0})
+    print("%s: %.1f MB" % (fname, f0.nbytes / 1024 ** 2))
+
+    Z = synthetic_gpi(args.nframes, seed=args.seed)
+    write_bp(os.path.join(workdir, "nstx_data_ornl_demo_v2.bp"), {"gpiData": Z})
+
+    ## Reconstructed windows split into nrecon files, as written by vapor.py
+    X, lb = xgc_windows(f0)
+    nwin = len(X) // args.nrecon
+    for k in range(args.nrecon):
+        sl = slice(k * nwin, (k + 1) * nwin)
+        zlb = np.zeros((nwin, 4), dtype=np.int64)
+        zlb[:, 0] = np.arange(nwin)
+        zlb[:, 1] = args.istep
+        zlb[:, 2:] = lb[sl]
+        write_bp(os.path.join(workdir, "recon.%d.bp" % k), {"X0": X[sl], "zlb": zlb})
+
+
+def run_case(name, workdir, args):
+    stats = IOStats()
+    sys.modules["adios2"] = timed_adios2(stats)
+    expdir = workdir
+    recon_files = [
+        os.path.join(workdir, "recon.%d.bp" % k) for k in range(args.nrecon)
+    ]
+
+    if name in ("recon", "merge"):
+        if name == "recon":
+            argv = ["--exp", expdir, "--istep", str(args.istep)]
+            argv += ["--output", os.path.join(workdir, "out-recon.bp")] + recon_files
+        else:
+            argv = recon_files + ["--outfile", os.path.join(workdir, "out-merge.bp")]
+        sys.argv = [name + ".py"] + argv
+        func = lambda: runpy.run_path(
+            os.path.join(ROOT, name + ".py"), run_name="__main__"
+        )
+    elif name == "xgc_f0_dataset":
+        from vapor.dataset import XGC_F0_Dataset
+        from vapor.util.config import initconf
+
+        initconf(dict())
+        prefix = os.path.join(workdir, "restart_dir")
+        func = lambda: XGC_F0_Dataset(prefix, prefix, args.istep)
+    else:
+        vapor = load_script()
+        if name == "read_f0":
+            func = lambda: vapor.read_f0(args.istep, expdir=expdir, normalize=True)
+        elif name == "read_f0_random":
+            ## randomread reads one plane per chunk after the first (iphi is reset)
+            func = lambda: vapor.read_f0(
+                args.istep,
+                expdir=expdir,
+                iphi=0,
+                randomread=args.randomread,
+                nchunk=16,
+            )
+        elif name == "read_f0_fieldline":
+            func = lambda: vapor.read_f0(args.istep, expdir=expdir, fieldline=True)
+        elif name in ("read_f0_nodes", "read_f0_nodes_untwist"):
+            mesh = synthetic_mesh(args.nsurf, args.nper)
+            nextnode_arr = None
+            if name == "read_f0_nodes_untwist":
+                nextnode_arr = nextnode_planes(mesh["nextnode"], args.nphi)
+            inodes = range(mesh["n_n"])
+            func = lambda: vapor.read_f0_nodes(
+                args.istep, inodes, expdir=expdir, nextnode_arr=nextnode_arr
+            )
+        elif name == "read_nstx":
+            func = lambda: vapor.read_nstx(
+                expdir=expdir, offset=0, nframes=args.nframes
+            )
+        else:
+            raise NotImplementedError(name)
+
+    rss0 = peak_rss()
+    t0 = time.perf_counter()
+    func()
+    total = time.perf_counter() - t0
+    io = stats.open + stats.read + stats.write
+    nbytes = stats.read_bytes + stats.write_bytes
+    return {
+        "case": name,
+        "total_sec": total,
+        "open_sec": stats.open,
+        "read_sec": stats.read,
+        "write_sec": stats.write,
+        "post_sec": total - io,
+        "read_mb": stats.read_bytes / 1024 ** 2,
+        "write_mb": stats.write_bytes / 1024 ** 2,
+        "io_mb_per_sec": nbytes / 1024 ** 2 / io if io > 0 else None,
+        "mb_per_sec": nbytes / 1024 ** 2 / total,
+        "peak_rss_mb": peak_rss(),
+        "base_rss_mb": rss0,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cases", nargs="+", default=list(CASES), choices=CASES)
+    parser.add_argument("--workdir", help="keep the files here (default: temp dir)")
+    parser.add_argument("--istep", type=int, default=420)
+    parser.add_argument("--nphi", type=int, default=4)
+    parser.add_argument("--nsurf", type=int, default=32, help="num. of flux surfaces")
+    parser.add_argument("--nper", type=int, default=64, help="num. of nodes per surf")
+    parser.add_argument("--nmu", type=int, default=39)
+    parser.add_argument("--nvp", type=int, default=39)
+    parser.add_argument("--nframes", type=int, default=4096, help="NSTX GPI frames")
+    parser.add_argument("--nrecon", type=int, default=4, help="num. of recon files")
+    parser.add_argument("--randomread", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write results as JSON")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench-io-")
+    write_data(workdir, args)
+
+    results = list()
+    ctx = mp.get_context("spawn")
+    try:
+        for name in args.cases:
+            ## A fresh process per case for a clean peak RSS
+            with ctx.Pool(1) as pool:
+                r = pool.apply(run_case, (name, workdir, args))
+            print(
+                "%-22s %7.3f s (open %.3f read %.3f write %.3f post %.3f) "
+                "%8.1f MB/s  RSS %7.1f MB"
+                % (
+                    name,
+                    r["total_sec"],
+                    r["open_sec"],
+                    r["read_sec"],
+                    r["write_sec"],
+                    r["post_sec"],
+                    r["mb_per_sec"],
+                    r["peak_rss_mb"],
+                )
+            )
+            results.append(r)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir)
+
+    if args.output is not None:
+        info = {
+            "commit": git_commit(),
+            "config": vars(args),
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(info, f, indent=2)
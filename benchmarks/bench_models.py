@@ -0,0 +1,309 @@
+"""
+CPU benchmark of the f0/GPI compression models on synthetic data.
+
+For each model: training step throughput, inference samples/s, peak RSS and
+compression ratio (bits of the input over bits of the latent; null for models that
+map f0 to f0). Each model runs in a fresh process so that peak RSS is its own.
+
+Example:
+    python benchmarks/bench_models.py --output bench-$(git rev-parse --short HEAD).json
+    python benchmarks/bench_models.py --models vqvae ae --nnodes 4000 --nphi 2
+"""
+import os
+import sys
+import math
+import time
+import json
+import resource
+import argparse
+import subprocess
+import importlib.util
+import multiprocessing as mp
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+from synthetic import synthetic_xgc_f0, xgc_windows, synthetic_gpi, normalize_frames
+
+MODELS = ("vqvae", "cvqvae", "ae", "vae", "net2d", "f2f", "fc", "vqvae2", "srgan")
+
+
+def load_script(fname="vapor.py"):
+    """Import a top-level script (e.g., vapor.py, which is shadowed by the package)"""
+    name = os.path.splitext(fname)[0].replace("-", "_") + "_script"
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, fname))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def peak_rss():
+    """Peak resident set size of this process in MB"""
+    r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return r / 1024 ** 2 if sys.platform == "darwin" else r / 1024
+
+
+def vq_ratio(model, quantizer, x, num_embeddings, *inputs):
+    """Input bits over code bits (one index of log2(num_embeddings) bits per vector)"""
+    shape = dict()
+    h = quantizer.register_forward_hook(
+        lambda m, i, o: shape.__setitem__("z", i[0].shape)
+    )
+    with torch.no_grad():
+        model(x, *inputs)
+    h.remove()
+    nb, _, nh, nw = shape["z"]
+    ncodes = nh * nw
+    return (x[0].numel() * 32) / (ncodes * math.ceil(math.log2(num_embeddings)))
+
+
+def make_case(name, args):
+    """Return model, input, target, loss(model, x, y), infer(model, x), ratio"""
+    f0 = synthetic_xgc_f0(args.nphi, args.nnodes, args.nmu, args.nvp, seed=args.seed)
+    X, lb = xgc_windows(f0)
+    x = torch.from_numpy(X).unsqueeze(1)
+    nx, ny = args.nmu, args.nvp
+
+    if name in ("vqvae", "cvqvae"):
+        vapor = load_script()
+        padding = [1, 1, 1]
+        if nx == 39:
+            padding = [1, 1, 0]
+        if nx == 45:
+            padding = [1, 0, 0]
+        num_embeddings = 512
+        model = vapor.Model(
+            1,
+            128,
+            2,
+            32,
+            num_embeddings,
+            16,
+            0.25,
+            0.99,
+            decoder_padding=padding,
+            da_conditional=(name == "cvqvae"),
+        )
+        ## distance and angle of each node (setup_da)
+        da = torch.from_numpy(
+            np.stack([lb[:, 1] / args.nnodes, np.cos(lb[:, 1])], axis=1).astype(
+                np.float32
+            )
+        )
+        x = (x, da) if name == "cvqvae" else (x,)
+
+        def loss(m, xb, yb):
+            vq_loss, recon, _, dloss = m(*xb)
+            return F.mse_loss(recon, xb[0]) + vq_loss + dloss
+
+        def infer(m, xb):
+            return m(*xb)[1]
+
+        xb = tuple(t[:2] for t in x)
+        ratio = vq_ratio(model, model._vq_vae, xb[0], num_embeddings, *xb[1:])
+        return model, x, None, loss, infer, ratio
+
+    if name == "ae":
+        vapor = load_script()
+        model = vapor.AE(input_dim=nx * ny, embedding_dim=args.embedding_dim)
+
+        def loss(m, xb, yb):
+            return F.mse_loss(m(xb), xb)
+
+        return model, x, None, loss, lambda m, xb: m(xb), nx * ny / args.embedding_dim
+
+    if name == "vae":
+        vapor = load_script()
+        nz = nx * ny // 4 // 4
+        model = vapor.VAE(1, nx, ny, nx * ny // 4, nz, 32, 2)
+
+        def loss(m, xb, yb):
+            recon, mu, logvar = m(xb)
+            return m.loss_function(recon, xb.clamp(0, 1), mu, logvar)
+
+        return model, x, None, loss, lambda m, xb: m(xb)[0], nx * ny / nz
+
+    if name == "net2d":
+        vapor = load_script()
+        ## (a(x, y), x, y) as in the fno input
+        xv, yv = np.meshgrid(
+            np.linspace(0, 1, nx, dtype=np.float32),
+            np.linspace(0, 1, ny, dtype=np.float32),
+            indexing="ij",
+        )
+        grid = torch.from_numpy(np.stack([xv, yv], axis=2))
+        xin = torch.cat([x[:, 0, :, :, np.newaxis], grid.expand(len(x), -1, -1, -1)], 3)
+        model = vapor.Net2d(12, 32, nlayers=3)
+
+        def loss(m, xb, yb):
+            return F.mse_loss(m(xb), yb)
+
+        return model, xin, x[:, 0], loss, lambda m, xb: m(xb), None
+
+    if name in ("f2f", "fc", "vqvae2"):
+        from vapor.model import F2F, FC, VQVAE
+
+        ## 3 consecutive planes (or nodes) as channels, as in Exp
+        n = len(x) // 3 * 3
+        x3 = x[:n].reshape(-1, 3, nx, ny)
+        if name == "f2f":
+            model = F2F(3, 3, 64, 4, [9, 3, 1])
+            ratio = None
+        elif name == "fc":
+            model = FC(3, 3, nx, ny)
+            ratio = None
+        else:
+            ## Encoder/decoder of vapor.model are for even sizes
+            x3 = x3[:, :, : nx // 4 * 4, : ny // 4 * 4]
+            model = VQVAE(3, 3, 128, 2, 32, 512, 64, 0.25, decay=0.99)
+
+        def loss(m, xb, yb):
+            out = m(xb)
+            if name == "vqvae2":
+                return F.mse_loss(out[1], xb) + out[0]
+            return F.mse_loss(out, xb)
+
+        def infer(m, xb):
+            out = m(xb)
+            return out[1] if name == "vqvae2" else out
+
+        if name == "vqvae2":
+            ratio = vq_ratio(model, model._vq_vae, x3[:2], 512)
+        return model, x3, None, loss, infer, ratio
+
+    if name == "srgan":
+        from models import GeneratorResNet
+
+        Z = normalize_frames(synthetic_gpi(args.nframes, seed=args.seed))
+        hr = torch.from_numpy(Z.astype(np.float32)).unsqueeze(1)
+        lr = F.avg_pool2d(hr, 4)
+        model = GeneratorResNet(in_channels=1, out_channels=1, n_residual_blocks=16)
+
+        def loss(m, xb, yb):
+            return F.mse_loss(m(xb), yb)
+
+        ratio = hr[0].numel() / lr[0].numel()
+        return model, lr, hr, loss, lambda m, xb: m(xb), ratio
+
+    raise NotImplementedError(name)
+
+
+def batches(x, y, batch_size, k):
+    n = len(x[0]) if isinstance(x, tuple) else len(x)
+    k = (k * batch_size) % (n - batch_size + 1)
+    sl = slice(k, k + batch_size)
+    xb = tuple(t[sl] for t in x) if isinstance(x, tuple) else x[sl]
+    yb = None if y is None else y[sl]
+    return xb, yb
+
+
+def run(name, args):
+    torch.manual_seed(args.seed)
+    if args.nthreads is not None:
+        torch.set_num_threads(args.nthreads)
+    rss0 = peak_rss()
+    model, x, y, loss_fn, infer, ratio = make_case(name, args)
+    n = len(x[0]) if isinstance(x, tuple) else len(x)
+    batch_size = min(args.batch_size, n)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+
+    model.train()
+    nwarmup = min(args.nwarmup, args.nsteps // 2)
+    for i in range(args.nsteps):
+        if i == nwarmup:
+            t0 = time.perf_counter()
+        xb, yb = batches(x, y, batch_size, i)
+        optimizer.zero_grad()
+        loss = loss_fn(model, xb, yb)
+        loss.backward()
+        optimizer.step()
+    train_time = time.perf_counter() - t0
+    nsteps = args.nsteps - nwarmup
+
+    model.eval()
+    ninfer = 0
+    t0 = time.perf_counter()
+    with torch.no_grad():
+        for i in range(0, n, args.infer_batch_size):
+            sl = slice(i, i + args.infer_batch_size)
+            xb = tuple(t[sl] for t in x) if isinstance(x, tuple) else x[sl]
+            infer(model, xb)
+            ninfer += len(xb[0]) if isinstance(xb, tuple) else len(xb)
+    infer_time = time.perf_counter() - t0
+
+    return {
+        "model": name,
+        "nparams": sum(p.numel() for p in model.parameters()),
+        "nsamples": n,
+        "batch_size": batch_size,
+        "train_steps_per_sec": nsteps / train_time,
+        "train_samples_per_sec": nsteps * batch_size / train_time,
+        "infer_samples_per_sec": ninfer / infer_time,
+        "peak_rss_mb": peak_rss(),
+        "base_rss_mb": rss0,
+        "compression_ratio": ratio,
+        "final_loss": loss.item(),
+    }
+
+
+def git_commit():
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True
+        )
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", nargs="+", default=list(MODELS), choices=MODELS)
+    parser.add_argument("--nphi", type=int, default=1)
+    parser.add_argument("--nnodes", type=int, default=2000)
+    parser.add_argument("--nmu", type=int, default=39)
+    parser.add_argument("--nvp", type=int, default=39)
+    parser.add_argument("--nframes", type=int, default=1024, help="NSTX GPI frames")
+    parser.add_argument("--embedding_dim", type=int, default=16)
+    parser.add_argument("--nsteps", type=int, default=30)
+    parser.add_argument("--nwarmup", type=int, default=5)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--infer_batch_size", type=int, default=256)
+    parser.add_argument("--nthreads", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write results as JSON")
+    args = parser.parse_args()
+
+    results = list()
+    ctx = mp.get_context("spawn")
+    for name in args.models:
+        ## A fresh process per model for a clean peak RSS
+        with ctx.Pool(1) as pool:
+            r = pool.apply(run, (name, args))
+        print(
+            "%-8s train %8.1f samples/s  infer %9.1f samples/s  RSS %7.1f MB  ratio %s"
+            % (
+                name,
+                r["train_samples_per_sec"],
+                r["infer_samples_per_sec"],
+                r["peak_rss_mb"],
+                "-"
+                if r["compression_ratio"] is None
+                else "%.1f" % r["compression_ratio"],
+            )
+        )
+        results.append(r)
+
+    if args.output is not None:
+        info = {
+            "commit": git_commit(),
+            "torch": torch.__version__,
+            "nthreads": args.nthreads or torch.get_num_threads(),
+            "config": vars(args),
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(info, f, indent=2)
@@ -0,0 +1,111 @@
+"""
+Aggregate read bandwidth of serial vs. MPI-collective ADIOS2 reads of an XGC f0 file.
+
+A synthetic xgc.f0 file (nphi, nmu, nnodes, nvp) is written collectively, then read:
+  serial:   every rank reads the whole file with ad2.open(fname, "r")
+  parallel: ranks read disjoint node blocks (read_f0_parallel)
+  gather:   parallel + allgather_nodes (every rank ends up with the whole file)
+
+Example:
+    mpirun -n 4 python benchmarks/bench_parallel_read.py --nnodes 16000
+"""
+import os
+import sys
+import time
+import json
+import shutil
+import argparse
+
+import numpy as np
+import adios2 as ad2
+from mpi4py import MPI
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from vapor.dataset.parallel import (
+    node_blocks,
+    read_f0_parallel,
+    allgather_nodes,
+    redistribute_nodes,
+)
+
+
+def write_synthetic(fname, comm, nphi, nmu, nnodes, nvp):
+    size, rank = comm.Get_size(), comm.Get_rank()
+    n0, n1 = node_blocks(nnodes, size)[rank]
+    rng = np.random.default_rng(rank)
+    block = rng.random((nphi, nmu, n1 - n0, nvp))
+    with ad2.open(fname, "w", comm) as fw:
+        shape = (nphi, nmu, nnodes, nvp)
+        start = (0, 0, n0, 0)
+        count = block.shape
+        fw.write("i_f", block.copy(), shape, start, count)
+
+
+def timed(comm, func):
+    comm.Barrier()
+    t0 = time.time()
+    out = func()
+    t = time.time() - t0
+    return out, comm.allreduce(t, op=MPI.MAX)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fname", default="bench-xgc.f0.00000.bp")
+    parser.add_argument("--nphi", type=int, default=8)
+    parser.add_argument("--nmu", type=int, default=39)
+    parser.add_argument("--nnodes", type=int, default=16000)
+    parser.add_argument("--nvp", type=int, default=39)
+    parser.add_argument("--nreaders", type=int, default=None)
+    parser.add_argument("--nrepeat", type=int, default=3)
+    parser.add_argument("--keep", action="store_true", help="keep the synthetic file")
+    parser.add_argument("--output", help="write results as JSON")
+    args = parser.parse_args()
+
+    comm = MPI.COMM_WORLD
+    size, rank = comm.Get_size(), comm.Get_rank()
+    write_synthetic(args.fname, comm, args.nphi, args.nmu, args.nnodes, args.nvp)
+    nbytes = args.nphi * args.nmu * args.nnodes * args.nvp * 8
+
+    def serial():
+        with ad2.open(args.fname, "r") as f:
+            return f.read("i_f")
+
+    def parallel():
+        return read_f0_parallel(args.fname, comm, nreaders=args.nreaders)
+
+    def gather():
+        return allgather_nodes(*parallel(), comm)
+
+    def alltoall():
+        ## Ownership shifted by one rank: every node moves
+        block, n0, _ = parallel()
+        dest = np.arange(args.nnodes) * size // args.nnodes
+        dest = (dest + 1) % size
+        return redistribute_nodes(block, n0, dest, comm)
+
+    results = dict(size=size, nbytes=nbytes, nreaders=args.nreaders or size)
+    for name, func, nread in [
+        ("serial", serial, nbytes * size),
+        ("parallel", parallel, nbytes),
+        ("gather", gather, nbytes),
+        ("alltoall", alltoall, nbytes),
+    ]:
+        tlist = [timed(comm, func)[1] for _ in range(args.nrepeat)]
+        t = min(tlist)
+        results[name] = dict(time=t, read_bytes=nread, bandwidth=nread / t)
+        if rank == 0:
+            print(
+                "%-8s %8.3f s  %10.1f MB/s (file bytes read: %d)"
+                % (name, t, nread / t / 2 ** 20, nread)
+            )
+
+    if rank == 0:
+        if args.output is not None:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+        if not args.keep:
+            if os.path.isdir(args.fname):
+                shutil.rmtree(args.fname)
+            elif os.path.exists(args.fname):
+                os.remove(args.fname)
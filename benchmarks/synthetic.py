@@ -0,0 +1,140 @@
+"""
+Synthetic XGC f0 and NSTX GPI data for the benchmarks (no experiment data needed).
+"""
+import numpy as np
+
+
+def synthetic_f0(n, nmu=39, nvp=39, seed=0):
+    """Min-max normalized Maxwellian-like (nmu, nvp) slices"""
+    rng = np.random.default_rng(seed)
+    mu = np.linspace(0, 1, nmu)[:, np.newaxis]
+    vp = np.linspace(-1, 1, nvp)[np.newaxis, :]
+    T = rng.uniform(0.1, 0.5, size=(n, 1, 1))
+    u = rng.uniform(-0.2, 0.2, size=(n, 1, 1))
+    X = np.exp(-(mu + (vp - u) ** 2) / T)
+    X += 0.01 * rng.standard_normal(X.shape)
+    xmin = X.min(axis=(1, 2), keepdims=True)
+    xmax = X.max(axis=(1, 2), keepdims=True)
+    return ((X - xmin) / (xmax - xmin)).astype(np.float32)
+
+
+def synthetic_xgc_f0(nphi=1, nnodes=1000, nmu=39, nvp=39, seed=0):
+    """
+    XGC-shaped i_f array (nphi, nmu, nnodes, nvp) in float64.
+    Density, temperature and flow vary smoothly over the nodes (as along flux surfaces)
+    and slightly between planes, with a small turbulent perturbation.
+    """
+    rng = np.random.default_rng(seed)
+    s = np.linspace(0, 1, nnodes)
+    phi = np.arange(nphi)[:, np.newaxis] * 2 * np.pi / max(nphi, 1)
+    theta = 2 * np.pi * 17 * s[np.newaxis, :]
+    den = (1.0 - 0.8 * s) * (1 + 0.05 * np.cos(theta + phi))
+    T = (0.5 - 0.4 * s) * (1 + 0.05 * np.sin(theta - phi))
+    u = 0.1 * np.sin(2 * np.pi * s)[np.newaxis, :] * np.ones((nphi, 1))
+
+    mu = np.linspace(0, 1, nmu)
+    vp = np.linspace(-1, 1, nvp)
+    ## (nphi, nmu, nnodes, nvp)
+    _mu = mu[np.newaxis, :, np.newaxis, np.newaxis]
+    _vp = vp[np.newaxis, np.newaxis, np.newaxis, :]
+    _den = den[:, np.newaxis, :, np.newaxis]
+    _T = T[:, np.newaxis, :, np.newaxis]
+    _u = u[:, np.newaxis, :, np.newaxis]
+    f0 = _den / _T ** 1.5 * np.exp(-(_mu + (_vp - _u) ** 2) / _T)
+    f0 *= 1 + 0.01 * rng.standard_normal(f0.shape)
+    return f0
+
+
+def xgc_windows(f0):
+    """
+    (nphi, nmu, nnodes, nvp) -> (nphi*nnodes, nmu, nvp) float32 windows, min-max
+    normalized per window as in read_f0, and the (iphi, inode) label of each window
+    """
+    nphi, nmu, nnodes, nvp = f0.shape
+    X = np.moveaxis(f0, 2, 1).reshape(nphi * nnodes, nmu, nvp)
+    xmin = X.min(axis=(1, 2), keepdims=True)
+    xmax = X.max(axis=(1, 2), keepdims=True)
+    X = np.ascontiguousarray((X - xmin) / (xmax - xmin), dtype=np.float32)
+    lb = np.stack(np.meshgrid(np.arange(nphi), np.arange(nnodes), indexing="ij"))
+    return X, lb.reshape(2, -1).T.astype(np.int32)
+
+
+def synthetic_gpi(nframes=1024, nh=64, nw=80, nblobs=4, seed=0):
+    """
+    NSTX GPI-shaped frames (nframes, nh, nw) in float32: Gaussian blobs drifting
+    across a radial background profile, with camera noise
+    """
+    rng = np.random.default_rng(seed)
+    y = np.arange(nh)[np.newaxis, :, np.newaxis]
+    x = np.arange(nw)[np.newaxis, np.newaxis, :]
+    t = np.arange(nframes)[:, np.newaxis, np.newaxis]
+    Z = 200.0 * np.exp(-x / (0.4 * nw)) * np.ones((nframes, nh, 1))
+    for _ in range(nblobs):
+        y0, x0 = rng.uniform(0, nh), rng.uniform(0, nw)
+        vy, vx = rng.uniform(-0.3, 0.3), rng.uniform(0.1, 0.5)
+        w = rng.uniform(3, 8)
+        yc = (y0 + vy * t) % nh
+        xc = (x0 + vx * t) % nw
+        Z += 500.0 * np.exp(-((y - yc) ** 2 + (x - xc) ** 2) / (2 * w ** 2))
+    Z += 5.0 * rng.standard_normal(Z.shape)
+    return Z.astype(np.float32)
+
+
+def normalize_frames(Z):
+    """Per-frame min-max normalization as in read_nstx"""
+    zmin = Z.min(axis=(1, 2), keepdims=True)
+    zmax = Z.max(axis=(1, 2), keepdims=True)
+    return (Z - zmin) / (zmax - zmin)
+
+
+def synthetic_mesh(nsurf=32, nper=64, twist=3):
+    """
+    XGC-like mesh of nsurf concentric flux surfaces with nper nodes each, as the
+    variables of xgc.mesh.bp. nextnode follows a field line to the next plane
+    (twist nodes along the surface); surf_idx is 1-based as in XGC.
+    """
+    nnodes = nsurf * nper
+    rho = np.linspace(0.1, 1.0, nsurf)
+    theta = np.linspace(0, 2 * np.pi, nper, endpoint=False)
+    R = 1.7 + 0.6 * rho[:, np.newaxis] * np.cos(theta[np.newaxis, :])
+    Z = 0.6 * 1.6 * rho[:, np.newaxis] * np.sin(theta[np.newaxis, :])
+    rz = np.stack([R.ravel(), Z.ravel()], axis=1)
+
+    idx = np.arange(nnodes).reshape(nsurf, nper)
+    nextnode = np.roll(idx, -twist, axis=1).ravel()
+
+    ## Two triangles per quad between neighboring surfaces
+    a = idx[:-1, :]
+    b = np.roll(idx[:-1, :], -1, axis=1)
+    c = idx[1:, :]
+    d = np.roll(idx[1:, :], -1, axis=1)
+    conn = np.concatenate(
+        [np.stack([a, b, c], -1).reshape(-1, 3), np.stack([b, d, c], -1).reshape(-1, 3)]
+    )
+
+    psi = np.repeat(rho ** 2, nper)
+    node_vol = np.repeat(rho, nper) * (2 * np.pi / nper) * (0.9 / nsurf)
+    return {
+        "n_n": nnodes,
+        "n_t": len(conn),
+        "rz": rz,
+        "nd_connect_list": conn.astype(np.int32),
+        "psi": psi,
+        "nextnode": nextnode.astype(np.int32),
+        "epsilon": np.repeat(rho * 0.6 / 1.7, nper),
+        "node_vol": node_vol,
+        "node_vol_nearest": node_vol,
+        "psi_surf": rho ** 2,
+        "surf_idx": (idx + 1).astype(np.int32),
+        "surf_len": np.full(nsurf, nper, dtype=np.int32),
+        "theta": np.tile(theta, nsurf),
+    }
+
+
+def nextnode_planes(nextnode, nphi):
+    """(nphi, nnodes) node order following the field lines plane by plane (untwist)"""
+    arr = np.zeros((nphi, len(nextnode)), dtype=np.int64)
+    arr[0, :] = np.arange(len(nextnode))
+    for i in range(1, nphi):
+        arr[i, :] = nextnode[arr[i - 1, :]]
+    return arr
@@ -7,6 +7,8 @@ from mpl_toolkits.axes_grid1 import make_axes_locatable
 
 import numpy as np
 import adios2 as ad2
+import torch
+import torch.nn.functional as F
 
 from PIL import Image
 import os
@@ -20,9 +22,12 @@ import queue
 import argparse
 import random
 
-import queue
-from threading import Thread
 import time
+import shutil
+import subprocess
+from collections import deque
+
+from vapor.dataset.mesh import load_mesh
 
 
 def get_size(fig, dpi=100):
@@ -118,174 +123,219 @@ def xdowork(Z, Zbar, trimesh, r, z, fsum, inode, title, outdir, seq):
     return fname
 
 
-def dowork_only2(
-    Z0, Z1, N0, N1, T0, T1, trimesh, r, z, fsum, inode, title, outdir, seq, save=True
-):
-    fig = plt.figure(figsize=[12, 6], constrained_layout=False)
-
-    ax = plt.subplot(1, 2, 1)
-    plt.tricontourf(trimesh, fsum)
-    clb = plt.colorbar()
-    clb.ax.set_title("log10(max)", fontsize=10)
-    plt.axis("scaled")
-    plt.axis("off")
-    # plt.triplot(trimesh, alpha=0.3, c='0.3')
-    plt.scatter(r[inode], z[inode], c="r", marker="x", s=80)
-
-    ny, nx = Z0.shape
-    x = np.arange(nx)
-    y = np.arange(ny)
-    X, Y = np.meshgrid(x, y)
+def remove_contour(cs):
+    try:
+        cs.remove()
+    except AttributeError:
+        ## Older matplotlib
+        for c in cs.collections:
+            c.remove()
+
+
+class FrameRenderer:
+    """
+    Render per-node frames of the only2/full figure.
+
+    The mesh panel (tricontourf of fsum) is the same in every frame: it is drawn once
+    and kept as a background. A frame restores the background and draws only the
+    per-node artists on top (marker, title, images with colorbars and contours).
+    """
+
+    ## (title, contour) of the image panels in the order of the data passed to render
+    FULL_PANELS = [
+        ("f0", True),
+        ("den", False),
+        ("f0 nonadia n0", False),
+        ("f0 (recon)", True),
+        ("den (recon)", False),
+        ("f0 nonadia n0 (recon)", False),
+    ]
+
+    def __init__(self, mode, trimesh, fsum, r, z, shape):
+        self.r = r
+        self.z = z
+        ny, nx = shape
+        self.X, self.Y = np.meshgrid(np.arange(nx), np.arange(ny))
+        self.nx = nx
+        self.panels = list()
+        blank = np.zeros(shape)
+
+        if mode == "only2":
+            fig = plt.figure(figsize=[12, 6], constrained_layout=False)
+            ax = plt.subplot(1, 2, 1)
+            plt.tricontourf(trimesh, fsum)
+            clb = plt.colorbar()
+            clb.ax.set_title("log10(max)", fontsize=10)
+            plt.axis("scaled")
+            plt.axis("off")
+            self.marker = plt.scatter(r[0], z[0], c="r", marker="x", s=80)
+
+            ax = plt.subplot(1, 2, 2)
+            self.add_panel(ax, blank, None, True)
+            self.title = ax.title
+            self.suptitle = False
+        else:
+            fig = plt.figure(figsize=[12, 8], constrained_layout=False)
+            self.title = fig.suptitle("", fontsize=14, y=0.97)
+            self.title.set_animated(True)
+            self.suptitle = True
+            gs = fig.add_gridspec(2, 4, width_ratios=[1, 1, 1, 1])
+
+            ax = fig.add_subplot(gs[:, 0])
+            im = plt.tricontourf(trimesh, fsum)
+            clb = plt.colorbar(im, orientation="horizontal", pad=0.01)
+            clb.ax.set_title("log10(max)", fontsize=10)
+            clb.ax.set_xticklabels(clb.ax.get_xticklabels(), rotation=90)
+            plt.axis("scaled")
+            plt.axis("off")
+            self.marker = plt.scatter(r[0], z[0], c="r", marker="x", s=80)
+
+            grid = [gs[0, 1], gs[0, 2], gs[0, 3], gs[1, 1], gs[1, 2], gs[1, 3]]
+            for pos, (title, contour) in zip(grid, self.FULL_PANELS):
+                ax = fig.add_subplot(pos)
+                self.add_panel(ax, blank, title, contour)
+
+        self.marker.set_animated(True)
+        self.fig = fig
+        fig.canvas.draw()
+        self.background = fig.canvas.copy_from_bbox(fig.bbox)
+
+    def add_panel(self, ax, blank, title, contour):
+        im = ax.imshow(blank, origin="lower")
+        cbar = plt.colorbar(im, orientation="horizontal", pad=0.01)
+        ax.axvline(x=self.nx / 2, c="w", alpha=0.3, ls="dashed")
+        if title is not None:
+            ax.set_title(title)
+        ax.axis("scaled")
+        ax.axis("off")
+        ## Not part of the background; drawn in every frame
+        ax.set_animated(True)
+        cbar.ax.set_animated(True)
+        self.panels.append([ax, im, cbar, contour, None])
+
+    def render(self, inode, title, data):
+        """Return the RGBA buffer (height, width, 4) of the frame"""
+        canvas = self.fig.canvas
+        canvas.restore_region(self.background)
+        self.marker.set_offsets([[self.r[inode], self.z[inode]]])
+        self.title.set_text(title)
+        for panel, Z in zip(self.panels, data):
+            ax, im, cbar, contour, cs = panel
+            im.set_data(Z)
+            im.set_clim(Z.min(), Z.max())
+            cbar.update_normal(im)
+            if contour:
+                if cs is not None:
+                    remove_contour(cs)
+                panel[4] = ax.contour(
+                    self.X, self.Y, Z, levels=5, colors="w", alpha=0.3, origin="lower"
+                )
+            self.fig.draw_artist(ax)
+            self.fig.draw_artist(cbar.ax)
+        self.marker.axes.draw_artist(self.marker)
+        if self.suptitle:
+            self.fig.draw_artist(self.title)
+        return np.asarray(canvas.buffer_rgba())
+
+
+class VideoWriter:
+    """
+    Write RGB frames, in order, to a single video file.
+
+    Frames are piped as raw video into one ffmpeg process (same encoding as
+    run-ffmpeg.sh). Without ffmpeg, they are written uncompressed to an .npy file of
+    shape (nframes, height, width, 3) instead.
+    """
+
+    def __init__(self, fname, nframes, fps=30, ffmpeg="ffmpeg"):
+        self.fname = fname
+        self.nframes = nframes
+        self.fps = fps
+        self.ffmpeg = shutil.which(ffmpeg)
+        self.proc = None
+        self.out = None
+        self.seq = 0
+
+    def open(self, height, width):
+        if self.ffmpeg is not None:
+            cmd = [self.ffmpeg, "-y", "-f", "rawvideo", "-pix_fmt", "rgb24"]
+            cmd += ["-s", "%dx%d" % (width, height), "-r", str(self.fps), "-i", "-"]
+            cmd += ["-vcodec", "libx264", "-crf", "25", "-pix_fmt", "yuv420p"]
+            cmd += [self.fname]
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        else:
+            self.fname = os.path.splitext(self.fname)[0] + ".npy"
+            print(f"[WARN] no ffmpeg. Writing raw frames: {self.fname}")
+            shape = (self.nframes, height, width, 3)
+            self.out = np.lib.format.open_memmap(
+                self.fname, mode="w+", dtype=np.uint8, shape=shape
+            )
 
-    ax = plt.subplot(1, 2, 2)
-    im = ax.imshow(Z0, origin="lower")
-    plt.colorbar(im, orientation="horizontal", pad=0.01)
-    # colorbar(im)
-    plt.axvline(x=nx / 2, c="w", alpha=0.3, ls="dashed")
-    plt.contour(X, Y, Z0, levels=5, colors="w", alpha=0.3, origin="lower")
-    plt.title(title)
-    plt.axis("scaled")
-    plt.axis("off")
-    # plt.tight_layout(h_pad=1)
+    def write(self, rgb):
+        if (self.proc is None) and (self.out is None):
+            self.open(*rgb.shape[:2])
+        if self.proc is not None:
+            self.proc.stdin.write(np.ascontiguousarray(rgb).tobytes())
+        else:
+            self.out[self.seq] = rgb
+        self.seq += 1
+
+    def close(self):
+        if self.proc is not None:
+            self.proc.stdin.close()
+            if self.proc.wait() != 0:
+                raise RuntimeError("ffmpeg failed: %d" % self.proc.returncode)
+        if self.out is not None:
+            self.out.flush()
+            del self.out
+            self.out = None
+        print("Video: %s (%d frames)" % (self.fname, self.seq))
+
+
+def grey_thumbnails(X, size=160, step=1):
+    """
+    (n, nmu, nvp) -> (n, size, size) uint8 thumbnails: min-max normalized per node to
+    0-255, subsampled by step and resized with bicubic interpolation (PIL-like)
+    """
+    xmin = X.min(axis=(1, 2), keepdims=True)
+    xmax = X.max(axis=(1, 2), keepdims=True)
+    X = ((X - xmin) / (xmax - xmin) * 255).astype(np.float32)
+    X = X[:, ::step, ::step].astype(np.uint8)
+    t = torch.from_numpy(X.astype(np.float32))[:, np.newaxis, :, :]
+    t = F.interpolate(
+        t, size=(size, size), mode="bicubic", align_corners=False, antialias=True
+    )
+    return t.round().clamp(0, 255).to(torch.uint8)[:, 0, :, :].numpy()
 
-    fname = "%s/%06d.jpg" % (outdir, seq)
-    # if inode%100 == 0: print (fname)
-    # set_size(fig, (8, 6))
-    # plt.savefig(fname, bbox_inches='tight')
-    ## (2021/02) not working
-    # plt.savefig(fname, bbox_inches='tight', pad_inches=1.0)
-    if save:
-        plt.savefig(fname)
-        plt.close()
 
+def save_png(X, fname):
+    Image.fromarray(X).save(fname)
     return fname
 
 
-def dowork_full(
-    Z0, Z1, N0, N1, T0, T1, trimesh, r, z, fsum, inode, title, outdir, seq, save=True
-):
-    fig = plt.figure(figsize=[12, 8], constrained_layout=False)
-    fig.suptitle(title, fontsize=14, y=0.97)
-    gs = fig.add_gridspec(2, 4, width_ratios=[1, 1, 1, 1])
-
-    ax = fig.add_subplot(gs[:, 0])
-    im = plt.tricontourf(trimesh, fsum)
-    divider = make_axes_locatable(ax)
-    # cax = divider.append_axes("right", size="10%", pad=0.05)
-    # clb = plt.colorbar(im, cax=cax)
-    clb = plt.colorbar(im, orientation="horizontal", pad=0.01)
-    clb.ax.set_title("log10(max)", fontsize=10)
-    clb.ax.set_xticklabels(clb.ax.get_xticklabels(), rotation=90)
-    plt.axis("scaled")
-    plt.axis("off")
-    # plt.triplot(trimesh, alpha=0.3, c='0.3')
-    plt.scatter(r[inode], z[inode], c="r", marker="x", s=80)
-
-    ny, nx = Z0.shape
-    x = np.arange(nx)
-    y = np.arange(ny)
-    X, Y = np.meshgrid(x, y)
-
-    ax = fig.add_subplot(gs[0, 1])
-    im = plt.imshow(Z0, origin="lower")
-    plt.colorbar(im, orientation="horizontal", pad=0.01)
-    plt.axvline(x=nx / 2, c="w", alpha=0.3, ls="dashed")
-    plt.contour(X, Y, Z0, levels=5, colors="w", alpha=0.3, origin="lower")
-    plt.title("f0")
-    plt.axis("scaled")
-    plt.axis("off")
-
-    ax = fig.add_subplot(gs[0, 3])
-    im = plt.imshow(N0, origin="lower")
-    plt.colorbar(im, orientation="horizontal", pad=0.01)
-    plt.axvline(x=nx / 2, c="w", alpha=0.3, ls="dashed")
-    # plt.contour(X, Y, N0, levels=5, colors='w', alpha=0.3, origin='lower')
-    plt.title("f0 nonadia n0")
-    plt.axis("scaled")
-    plt.axis("off")
-
-    #     ax = fig.add_subplot(gs[0, 3])
-    #     im = plt.imshow(T0, origin='lower')
-    #     plt.colorbar(im, orientation='horizontal', pad=0.01)
-    #     plt.axvline(x=nx/2, c='w', alpha=0.3, ls='dashed')
-    #     #plt.contour(X, Y, T0, levels=5, colors='w', alpha=0.3, origin='lower')
-    #     plt.title('f0 nonadia turb')
-    #     plt.axis('scaled')
-    #     plt.axis('off')
-
-    ax = fig.add_subplot(gs[0, 2])
-    im = plt.imshow(T0, origin="lower")
-    plt.colorbar(im, orientation="horizontal", pad=0.01)
-    plt.axvline(x=nx / 2, c="w", alpha=0.3, ls="dashed")
-    # plt.contour(X, Y, T0, levels=5, colors='w', alpha=0.3, origin='lower')
-    plt.title("den")
-    plt.axis("scaled")
-    plt.axis("off")
-
-    ax = fig.add_subplot(gs[1, 1])
-    im = plt.imshow(Z1, origin="lower")
-    plt.colorbar(im, orientation="horizontal", pad=0.01)
-    plt.axvline(x=nx / 2, c="w", alpha=0.3, ls="dashed")
-    plt.contour(X, Y, Z1, levels=5, colors="w", alpha=0.3, origin="lower")
-    plt.title("f0 (recon)")
-    plt.axis("scaled")
-    plt.axis("off")
+## Per-process renderer (set by init_worker)
+renderer = None
+frame_dir = None
 
-    ax = fig.add_subplot(gs[1, 3])
-    im = plt.imshow(N1, origin="lower")
-    plt.colorbar(im, orientation="horizontal", pad=0.01)
-    plt.axvline(x=nx / 2, c="w", alpha=0.3, ls="dashed")
-    # plt.contour(X, Y, N1, levels=5, colors='w', alpha=0.3, origin='lower')
-    plt.title("f0 nonadia n0 (recon)")
-    plt.axis("scaled")
-    plt.axis("off")
 
-    #     ax = fig.add_subplot(gs[1, 3])
-    #     im = plt.imshow(T1, origin='lower')
-    #     plt.colorbar(im, orientation='horizontal', pad=0.01)
-    #     plt.axvline(x=nx/2, c='w', alpha=0.3, ls='dashed')
-    #     #plt.contour(X, Y, T1, levels=5, colors='w', alpha=0.3, origin='lower')
-    #     plt.title('f0 nonadia turb (recon)')
-    #     plt.axis('scaled')
-    #     plt.axis('off')
-
-    ax = fig.add_subplot(gs[1, 2])
-    im = plt.imshow(T1, origin="lower")
-    plt.colorbar(im, orientation="horizontal", pad=0.01)
-    plt.axvline(x=nx / 2, c="w", alpha=0.3, ls="dashed")
-    # plt.contour(X, Y, T1, levels=5, colors='w', alpha=0.3, origin='lower')
-    plt.title("den (recon)")
-    plt.axis("scaled")
-    plt.axis("off")
+def init_worker(mode, r, z, conn, fsum, shape, outdir):
+    """Build the figure and its background once per worker process"""
+    global renderer, frame_dir
+    trimesh = tri.Triangulation(r, z, conn)
+    renderer = FrameRenderer(mode, trimesh, fsum, r, z, shape)
+    frame_dir = outdir
 
-    fname = "%s/%06d.jpg" % (outdir, seq)
-    # if inode%100 == 0: print (fname)
-    # set_size(fig, (8, 6))
-    # plt.savefig(fname, bbox_inches='tight')
-    ## (2021/02) not working
-    # plt.savefig(fname, bbox_inches='tight', pad_inches=1.0)
-    if save:
-        plt.savefig(fname)
-        plt.close()
 
+def render_frame(seq, inode, title, data):
+    """Save the frame as a JPEG, or return its RGB array if there is no frame_dir"""
+    rgba = renderer.render(inode, title, data)
+    if frame_dir is None:
+        return rgba[:, :, :3].copy()
+    fname = "%s/%06d.jpg" % (frame_dir, seq)
+    Image.fromarray(rgba[:, :, :3]).save(fname)
     return fname
 
 
-def dispatch(dq):
-    seq = 0
-    while True:
-        future = dq.get()
-        _ = future.result()
-        dq.task_done()
-        print("Done: %d/%d" % (seq, dq.qsize()))
-        seq += 1
-
-
-def hello():
-    time.sleep(3)
-    print("Hello: %d" % os.getpid())
-
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("exp", help="exp")
@@ -293,6 +343,25 @@ if __name__ == "__main__":
     parser.add_argument("--onlyn", type=int, help="onlyn", default=10000000)
     parser.add_argument("--nofuture", help="nofuture", action="store_true")
     parser.add_argument("--nworkers", type=int, help="nworkers", default=32)
+    parser.add_argument(
+        "--maxpending",
+        type=int,
+        help="max. num. of frames in flight (default: 4 x nworkers)",
+        default=None,
+    )
+    parser.add_argument(
+        "--video",
+        help="write frames to a video file (e.g., out.mp4) instead of JPEG files",
+    )
+    parser.add_argument("--fps", type=int, help="video frame rate", default=30)
+    parser.add_argument("--ffmpeg", help="ffmpeg executable", default="ffmpeg")
+    parser.add_argument(
+        "--npy",
+        help="grey/grey4x: write all thumbnails into one (nnodes, 160, 160) NPY file",
+    )
+    parser.add_argument(
+        "--batch", type=int, help="grey/grey4x: nodes per batch", default=4096
+    )
     parser.add_argument("--istep", type=int, help="istep", default=420)
     parser.add_argument("--iphi", help="iphi", action="store_true")
     parser.add_argument("--rand", type=float, help="rand", default=1.0)
@@ -317,262 +386,178 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    with concurrent.futures.ProcessPoolExecutor(max_workers=args.nworkers) as executor:
-        for i in range(args.nworkers):
-            executor.submit(hello)
-
-        exp = args.exp  #'d3d_coarse_v2_4x'
-        print(exp)
-        with ad2.open("%s/xgc.mesh.bp" % exp, "r") as f:
-            nnodes = int(
-                f.read(
-                    "n_n",
-                )
-            )
-            # ncells = int(f.read('n_t', ))
-            rz = f.read("rz")
-            conn = f.read("nd_connect_list")
-            # psi = f.read('psi')
-            nextnode = f.read("nextnode")
-            # epsilon = f.read('epsilon')
-            # node_vol = f.read('node_vol')
-            # node_vol_nearest = f.read('node_vol_nearest')
-            # psi_surf = f.read('psi_surf')
-            surf_idx = f.read("surf_idx")
-            surf_len = f.read("surf_len")
-
-        r = rz[:, 0]
-        z = rz[:, 1]
-        trimesh = tri.Triangulation(r, z, conn)
-        print(nnodes)
-
-        bl = np.zeros_like(nextnode, dtype=bool)
-        for i in range(len(surf_len)):
-            n = surf_len[i]
-            k = surf_idx[i, :n] - 1
-            for j in k:
-                bl[j] = True
-
-        not_in_surf = np.arange(len(nextnode))[~bl]
-
-        #     with ad2.open('%s/restart_dir/xgc.f0.00420.bp'%exp,'r') as f:
-        #         i_f = f.read('i_f')
-        #     i_f = np.moveaxis(i_f,1,2)
-        #     print (i_f.shape)
-
-        #     with ad2.open('%s-recon.bp'%exp,'r') as f:
-        #         X0 = f.read('i_f_recon')
-        #     print (X0.shape)
-
-        def adios2_get_shape(f, varname):
-            nstep = int(f.available_variables()[varname]["AvailableStepsCount"])
-            shape = f.available_variables()[varname]["Shape"]
-            lshape = None
-            if shape == "":
-                ## Accessing Adios1 file
-                ## Read data and figure out
-                v = f.read(varname)
-                lshape = v.shape
-            else:
-                lshape = tuple([int(x.strip(",")) for x in shape.strip().split()])
-            return (nstep, lshape)
-
-        with ad2.open("%s/restart_dir/xgc.f0.%05d.bp" % (exp, args.istep), "r") as f:
-            nstep, nsize = adios2_get_shape(f, "i_f")
-            nphi = nsize[0]
-            nmu = nsize[1]
-            nnodes = nsize[2]
-            nvp = nsize[3]
-            start = (0, 0, 0, 0)
-            count = (nphi, nmu, nnodes, nvp)
-
-            if args.iphi:
-                count = (1, nmu, nnodes, nvp)
-                i_f = np.zeros(nsize)
-                i_f[0, :] = f.read("i_f", start=start, count=count)
-            else:
-                i_f = f.read("i_f", start=start, count=count)
-        f0_f = np.moveaxis(i_f, 2, 1).copy()
-
-        fname = "%s-recon.bp" % exp
-        if os.path.exists(fname):
-            with ad2.open(fname, "r") as f:
-                f0_g = f.read("i_f_recon")
-            print(f0_f.shape, f0_g.shape)
-        else:
-            print(f"[WARN] cannot open: {fname}")
-
-        fname = "%s-physics1.bp" % exp
-        if os.path.exists(fname):
-            with ad2.open(fname, "r") as f:
-                den_f = f.read("den_f")
-                den_g = f.read("den_g")
+    exp = args.exp  #'d3d_coarse_v2_4x'
+    print(exp)
+    mesh = load_mesh("%s/xgc.mesh.bp" % exp)
+    nnodes = mesh.nnodes
+    conn = mesh.conn
+    nextnode = mesh.nextnode
+    r = mesh.r
+    z = mesh.z
+    print(nnodes)
+    not_in_surf = mesh.not_in_surf
+
+    #     with ad2.open('%s/restart_dir/xgc.f0.00420.bp'%exp,'r') as f:
+    #         i_f = f.read('i_f')
+    #     i_f = np.moveaxis(i_f,1,2)
+    #     print (i_f.shape)
+
+    #     with ad2.open('%s-recon.bp'%exp,'r') as f:
+    #         X0 = f.read('i_f_recon')
+    #     print (X0.shape)
+
+    def adios2_get_shape(f, varname):
+        nstep = int(f.available_variables()[varname]["AvailableStepsCount"])
+        shape = f.available_variables()[varname]["Shape"]
+        lshape = None
+        if shape == "":
+            ## Accessing Adios1 file
+            ## Read data and figure out
+            v = f.read(varname)
+            lshape = v.shape
         else:
-            print(f"[WARN] cannot open: {fname}")
-
-        fname = "%s-physics3.bp" % exp
-        if os.path.exists(fname):
-            with ad2.open(fname, "r") as f:
-                fn_n0_all_f = f.read("fn_n0_all_f")
-                fn_n0_all_g = f.read("fn_n0_all_g")
-                fn_turb_all_f = f.read("fn_turb_all_f")
-                fn_turb_all_g = f.read("fn_turb_all_g")
-            print(den_f.shape, fn_n0_all_f.shape, fn_turb_all_f.shape)
+            lshape = tuple([int(x.strip(",")) for x in shape.strip().split()])
+        return (nstep, lshape)
+
+    with ad2.open("%s/restart_dir/xgc.f0.%05d.bp" % (exp, args.istep), "r") as f:
+        nstep, nsize = adios2_get_shape(f, "i_f")
+        nphi = nsize[0]
+        nmu = nsize[1]
+        nnodes = nsize[2]
+        nvp = nsize[3]
+        start = (0, 0, 0, 0)
+        count = (nphi, nmu, nnodes, nvp)
+
+        if args.iphi:
+            count = (1, nmu, nnodes, nvp)
+            i_f = np.zeros(nsize)
+            i_f[0, :] = f.read("i_f", start=start, count=count)
         else:
-            print(f"[WARN] cannot open: {fname}")
-
-        outdir = "%s-%s" % (args.prefix, exp)
+            i_f = f.read("i_f", start=start, count=count)
+    f0_f = np.moveaxis(i_f, 2, 1).copy()
+
+    fname = "%s-recon.bp" % exp
+    if os.path.exists(fname):
+        with ad2.open(fname, "r") as f:
+            f0_g = f.read("i_f_recon")
+        print(f0_f.shape, f0_g.shape)
+    else:
+        print(f"[WARN] cannot open: {fname}")
+
+    fname = "%s-physics1.bp" % exp
+    if os.path.exists(fname):
+        with ad2.open(fname, "r") as f:
+            den_f = f.read("den_f")
+            den_g = f.read("den_g")
+    else:
+        print(f"[WARN] cannot open: {fname}")
+
+    fname = "%s-physics3.bp" % exp
+    if os.path.exists(fname):
+        with ad2.open(fname, "r") as f:
+            fn_n0_all_f = f.read("fn_n0_all_f")
+            fn_n0_all_g = f.read("fn_n0_all_g")
+            fn_turb_all_f = f.read("fn_turb_all_f")
+            fn_turb_all_g = f.read("fn_turb_all_g")
+        print(den_f.shape, fn_n0_all_f.shape, fn_turb_all_f.shape)
+    else:
+        print(f"[WARN] cannot open: {fname}")
+
+    outdir = "%s-%s" % (args.prefix, exp)
+    if (args.video is None) and (args.npy is None):
         print("outdir:", outdir)
         os.makedirs(outdir, exist_ok=True)
 
-        if args.mode in ("grey", "grey4x"):
-            for iphi in range(1):  # ,f0_f.shape[0]):
-                for inode in range(f0_f.shape[1]):
-                    # print (iphi, inode)
-                    X = f0_f[iphi, inode, :, :]
-                    X = (X - X.min()) / (X.max() - X.min()) * 255
-                    X = X.astype(np.float32).copy()
-                    if args.mode == "grey4x":
-                        X = X[::4, ::4]
-
-                    im = Image.fromarray(np.uint8(X))
-                    im = im.resize((160, 160))
-                    # fname = '%s/%d-%d-%05d.jpg'%(outdir,420,iphi,inode)
-                    fname = "%s/%06d.png" % (outdir, inode)
-                    im.save(fname)
-
-                    if inode % 1000 == 0:
-                        print(fname)
-        else:
+    if args.mode in ("grey", "grey4x"):
+        ## Thumbnails in batches of nodes; PNGs are encoded on a thread pool
+        torch.set_num_threads(args.nworkers)
+        step = 4 if args.mode == "grey4x" else 1
+        iphi = 0  # range(f0_f.shape[0])
+        nnodes = f0_f.shape[1]
+        out = None
+        if args.npy is not None:
+            out = np.lib.format.open_memmap(
+                args.npy, mode="w+", dtype=np.uint8, shape=(nnodes, 160, 160)
+            )
+        with concurrent.futures.ThreadPoolExecutor(args.nworkers) as executor:
+            for n0 in tqdm(range(0, nnodes, args.batch)):
+                n1 = min(n0 + args.batch, nnodes)
+                T = grey_thumbnails(f0_f[iphi, n0:n1, :, :], 160, step)
+                if out is not None:
+                    out[n0:n1] = T
+                    continue
+                # fname = '%s/%d-%d-%05d.jpg'%(outdir,420,iphi,inode)
+                fnames = ["%s/%06d.png" % (outdir, inode) for inode in range(n0, n1)]
+                for fname in executor.map(save_png, T, fnames):
+                    pass
+                print(fname)
+        if out is not None:
+            out.flush()
+            print("Saved:", args.npy)
+    else:
+        iphi = 0  # range(f0_f.shape[0])
+        # fsum = np.mean(f0_f[iphi,:], axis=(1,2))
+        fsum = np.log10(np.max(f0_f[iphi, :], axis=(1, 2)))
+
+        ## Frames: nodes of each flux surface, then the nodes not in any surface
+        frames = list()
+        members = mesh.members_surf < args.onlyn
+        for inode, i in zip(mesh.members_node[members], mesh.members_surf[members]):
+            if random.random() < args.rand:
+                frames.append((inode, i))
+        ub = min(len(not_in_surf), args.onlyn)
+        for inode in not_in_surf[:ub]:
+            if random.random() < args.rand:
+                frames.append((inode, -1))
+        print("Frames: %d" % len(frames))
+
+        def frame_data(inode):
             if args.mode == "only2":
-                dowork = dowork_only2
-                f0_g = f0_f
-                fn_n0_all_f = f0_f
-                fn_n0_all_g = f0_f
-                den_f = f0_f
-                den_g = f0_f
-            if args.mode == "full":
-                dowork = dowork_full
-
-            dq = queue.Queue()
-            dispatcher = Thread(target=dispatch, args=(dq,), daemon=True)
-            dispatcher.start()
-            seq = 0
-            for iphi in range(1):  # ,f0_f.shape[0]):
-                # fsum = np.mean(f0_f[iphi,:], axis=(1,2))
-                fsum = np.log10(np.max(f0_f[iphi, :], axis=(1, 2)))
-                for i in range(min(len(surf_idx), args.onlyn)):
-                    print("Surfid: %d/%d" % (i, len(surf_idx)))
-                    for j in tqdm(range(surf_len[i])):
-                        if random.random() >= args.rand:
-                            continue
-                        inode = surf_idx[i, j] - 1
-
-                        Z0 = f0_f[iphi, inode, :, :]
-                        Z1 = f0_g[iphi, inode, :, :]
-                        N0 = fn_n0_all_f[iphi, inode, :, :]
-                        N1 = fn_n0_all_g[iphi, inode, :, :]
-                        # T0 = fn_turb_all_f[iphi,inode,:,:]
-                        # T1 = fn_turb_all_g[iphi,inode,:,:]
-                        T0 = den_f[iphi, inode, :, :]
-                        T1 = den_g[iphi, inode, :, :]
-
-                        title = "node: %d (surfid: %d)" % (inode, i)
-                        if not args.nofuture:
-                            future = executor.submit(
-                                dowork,
-                                Z0,
-                                Z1,
-                                N0,
-                                N1,
-                                T0,
-                                T1,
-                                trimesh,
-                                r,
-                                z,
-                                fsum,
-                                inode,
-                                title,
-                                outdir,
-                                seq,
-                            )
-                            dq.put(future)
-                        else:
-                            dowork(
-                                Z0,
-                                Z1,
-                                N0,
-                                N1,
-                                T0,
-                                T1,
-                                trimesh,
-                                r,
-                                z,
-                                fsum,
-                                inode,
-                                title,
-                                outdir,
-                                seq,
-                            )
-                        seq += 1
-
-                print("Surfid: %d/%d" % (-1, len(surf_idx)))
-                ub = min(len(not_in_surf), args.onlyn)
-                for inode in tqdm(not_in_surf[:ub]):
-                    if random.random() >= args.rand:
-                        continue
-                    Z0 = f0_f[iphi, inode, :, :]
-                    Z1 = f0_g[iphi, inode, :, :]
-                    N0 = fn_n0_all_f[iphi, inode, :, :]
-                    N1 = fn_n0_all_g[iphi, inode, :, :]
-                    # T0 = fn_turb_all_f[iphi,inode,:,:]
-                    # T1 = fn_turb_all_g[iphi,inode,:,:]
-                    T0 = den_f[iphi, inode, :, :]
-                    T1 = den_g[iphi, inode, :, :]
-
-                    title = "node: %d (surfid: %d)" % (inode, -1)
-                    if not args.nofuture:
-                        future = executor.submit(
-                            dowork,
-                            Z0,
-                            Z1,
-                            N0,
-                            N1,
-                            T0,
-                            T1,
-                            trimesh,
-                            r,
-                            z,
-                            fsum,
-                            inode,
-                            title,
-                            outdir,
-                            seq,
-                        )
-                        dq.put(future)
-                    else:
-                        dowork(
-                            Z0,
-                            Z1,
-                            N0,
-                            N1,
-                            T0,
-                            T1,
-                            trimesh,
-                            r,
-                            z,
-                            fsum,
-                            inode,
-                            title,
-                            outdir,
-                            seq,
-                        )
-                    seq += 1
-
-            ## Clean up
-            dq.join()
-            print("All work completed")
-
-            # if not args.nofuture:
-            #     for future in tqdm(future_list):
-            #         _ = future.result()
+                return [f0_f[iphi, inode, :, :]]
+            ## T0/T1 are den_f/den_g (fn_turb_all_f/g are not shown)
+            return [
+                f0_f[iphi, inode, :, :],
+                den_f[iphi, inode, :, :],
+                fn_n0_all_f[iphi, inode, :, :],
+                f0_g[iphi, inode, :, :],
+                den_g[iphi, inode, :, :],
+                fn_n0_all_g[iphi, inode, :, :],
+            ]
+
+        ## Video: frames come back as RGB arrays and are written in order
+        writer = None
+        if args.video is not None:
+            writer = VideoWriter(args.video, len(frames), args.fps, args.ffmpeg)
+            outdir = None
+
+        def sink(out):
+            if writer is not None:
+                writer.write(out)
+
+        initargs = (args.mode, r, z, conn, fsum, f0_f.shape[2:], outdir)
+        if args.nofuture:
+            init_worker(*initargs)
+            for seq, (inode, surfid) in enumerate(tqdm(frames)):
+                title = "node: %d (surfid: %d)" % (inode, surfid)
+                sink(render_frame(seq, inode, title, frame_data(inode)))
+        else:
+            ## Workers get the mesh once; tasks carry only the per-node arrays.
+            ## At most maxpending frames are in flight, consumed in order.
+            maxpending = args.maxpending or 4 * args.nworkers
+            pending = deque()
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=args.nworkers, initializer=init_worker, initargs=initargs
+            ) as executor:
+                for seq, (inode, surfid) in enumerate(tqdm(frames)):
+                    if len(pending) >= maxpending:
+                        sink(pending.popleft().result())
+                    title = "node: %d (surfid: %d)" % (inode, surfid)
+                    future = executor.submit(
+                        render_frame, seq, inode, title, frame_data(inode)
+                    )
+                    pending.append(future)
+                while len(pending) > 0:
+                    sink(pending.popleft().result())
+        if writer is not None:
+            writer.close()
+        print("All work completed")
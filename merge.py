@@ -4,6 +4,23 @@ import os
 import argparse
 import logging
 import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+
+def get_shape(fname, varname):
+    with ad2.open(fname, "r") as f:
+        shape = f.available_variables()[varname]["Shape"]
+    return tuple([int(x.strip(",")) for x in shape.strip().split()])
+
+
+def read_block(fname):
+    """Read X0 (n, nx, ny) as the (nx, n, ny) block of the output"""
+    logging.debug("Read: %s" % fname)
+    with ad2.open(fname, "r") as f:
+        val = f.read("X0")
+    print(val.shape)
+    return np.ascontiguousarray(np.moveaxis(val, 0, 1))
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -14,25 +31,26 @@ if __name__ == "__main__":
     fmt = "[%(levelname)s] %(message)s"
     logging.basicConfig(level=logging.DEBUG, format=fmt)
 
-    val_list = list()
-    for fname in args.infile:
-        logging.debug("Read: %s" % fname)
-        with ad2.open(fname, "r") as f:
-            val = f.read("X0")
-            print(val.shape)
-            val_list.append(val)
-
-    out = np.array(val_list)
-    out = np.moveaxis(out, 1, 2)
-    print(out.shape)
+    ## All inputs are stacked: (ninputs, nx, n, ny)
+    lshape = get_shape(args.infile[0], "X0")
+    for fname in args.infile[1:]:
+        assert get_shape(fname, "X0") == lshape, fname
+    n, nx, ny = lshape
+    shape = (len(args.infile), nx, n, ny)
+    print(shape)
     logging.debug("Write: %s" % args.outfile)
 
-    with ad2.open(args.outfile, "w") as fw:
-        shape = out.shape
-        start = [
-            0,
-        ] * len(out.shape)
-        count = out.shape
-        fw.write("recon", out.copy(), shape, start, count)
+    ## The next input is read on a background thread while the current one is written
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        with ad2.open(args.outfile, "w") as fw:
+            future = executor.submit(read_block, args.infile[0])
+            for k in range(len(args.infile)):
+                block = future.result()
+                if k + 1 < len(args.infile):
+                    future = executor.submit(read_block, args.infile[k + 1])
+                start = (k, 0, 0, 0)
+                count = (1,) + block.shape
+                fw.write("recon", block, shape, start, count)
+                del block
 
     print("Done.")
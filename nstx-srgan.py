@@ -24,6 +24,7 @@ from torch.autograd import Variable
 
 from models import *
 from datasets import *
+from vapor.util.amp import PRECISIONS, get_autocast, get_grad_scaler
 
 import torch.nn as nn
 import torch.nn.functional as F
@@ -123,6 +124,12 @@ parser.add_argument(
     "--nchannel", type=int, default=1, help="num. of channels (default: %(default)s)"
 )
 parser.add_argument("--modelfile", help="modelfile (default: %(default)s)")
+parser.add_argument(
+    "--precision",
+    choices=PRECISIONS,
+    default="fp32",
+    help="training precision (default: %(default)s)",
+)
 parser.add_argument("--nofeatureloss", help="no feature loss", action="store_true")
 parser.add_argument("--log", help="log", action="store_true")
 parser.add_argument("--suffix", help="suffix")
@@ -339,6 +346,8 @@ optimizer_D = torch.optim.Adam(
 )
 
 Tensor = torch.cuda.FloatTensor if cuda else torch.Tensor
+scaler_G = get_grad_scaler(device, opt.precision)
+scaler_D = get_grad_scaler(device, opt.precision)
 
 # ----------
 #  Training
@@ -376,8 +385,9 @@ for epoch in range(opt.epoch, epoch_end):
         optimizer_G.zero_grad()
 
         # Generate a high resolution image from low resolution input
-        gen_hr = generator(imgs_lr)
-        gen_hr = gen_hr[:, :, :nh, :nw]
+        with get_autocast(device, opt.precision):
+            gen_hr = generator(imgs_lr)
+        gen_hr = gen_hr[:, :, :nh, :nw].float()
 
         # print ('imgs_lr', imgs_lr.min().item(), imgs_lr.max().item(), imgs_lr.mean().item())
         # print ('gen_hr', gen_hr.min().item(), gen_hr.max().item(), gen_hr.mean().item())
@@ -386,7 +396,9 @@ for epoch in range(opt.epoch, epoch_end):
         # valid.shape: torch.Size([16, 1, 16, 16])
         # fake.shape: torch.Size([16, 1, 16, 16])
         # discriminator(gen_hr).shape: torch.Size([16, 1, 16, 16])
-        out = discriminator(gen_hr)
+        with get_autocast(device, opt.precision):
+            out = discriminator(gen_hr)
+        out = out.float()
 
         nb, nc, nh, nw = out.shape
         output_shape = (nc, nh, nw)
@@ -400,9 +412,12 @@ for epoch in range(opt.epoch, epoch_end):
         loss_GAN = criterion_GAN(out, valid)
 
         # Content loss
-        gen_features = feature_extractor(gen_hr)
-        real_features = feature_extractor(imgs_hr)
-        loss_content = criterion_content(gen_features, real_features.detach())
+        with get_autocast(device, opt.precision):
+            gen_features = feature_extractor(gen_hr)
+            real_features = feature_extractor(imgs_hr)
+        loss_content = criterion_content(
+            gen_features.float(), real_features.detach().float()
+        )
         # loss_content = criterion_content(gen_hr, imgs_hr)
 
         # Total loss
@@ -411,8 +426,9 @@ for epoch in range(opt.epoch, epoch_end):
         else:
             loss_G = loss_content + 1e-3 * loss_GAN
 
-        loss_G.backward()
-        optimizer_G.step()
+        scaler_G.scale(loss_G).backward()
+        scaler_G.step(optimizer_G)
+        scaler_G.update()
 
         # ---------------------
         #  Train Discriminator
@@ -421,14 +437,18 @@ for epoch in range(opt.epoch, epoch_end):
         optimizer_D.zero_grad()
 
         # Loss of real and fake images
-        loss_real = criterion_GAN(discriminator(imgs_hr), valid)
-        loss_fake = criterion_GAN(discriminator(gen_hr.detach()), fake)
+        with get_autocast(device, opt.precision):
+            real_out = discriminator(imgs_hr)
+            fake_out = discriminator(gen_hr.detach())
+        loss_real = criterion_GAN(real_out.float(), valid)
+        loss_fake = criterion_GAN(fake_out.float(), fake)
 
         # Total loss
         loss_D = (loss_real + loss_fake) / 2
 
-        loss_D.backward()
-        optimizer_D.step()
+        scaler_D.scale(loss_D).backward()
+        scaler_D.step(optimizer_D)
+        scaler_D.update()
 
         # --------------
         #  Log Progress
@@ -10,7 +10,6 @@ import torch.optim as optim
 from torch.utils.data import DataLoader, random_split, WeightedRandomSampler
 from torch.utils.data import Dataset
 from PIL import Image, ImageFile
-from skimage.transform import resize
 
 from torchvision import datasets, models, transforms
 
@@ -26,6 +25,8 @@ import sys
 
 from sklearn.model_selection import train_test_split
 
+from vapor.dataset.mesh import digitizing, nearest_index_map
+
 # %%
 def visualize_model(model, dataloaders, num_images=6):
     def _imshow(inp, title=None):
@@ -76,18 +77,32 @@ def show_databatch(inputs, classes):
     imshow(out, title=[x.item() for x in classes])
 
 
-def digitizing(x, nbins):
+def landmark_isomap(
+    X, n_neighbors=30, nlandmarks=4000, npca=50, chunk=16384, n_jobs=None, seed=0
+):
     """
-    idx ranges from 1 ... nbins
-    nan is 0
+    1-d Isomap embedding of X (n, ...) that scales to many frames: PCA to npca
+    components, Isomap on nlandmarks randomly chosen frames, and the out-of-sample
+    extension (geodesic distances through the landmark graph) for all frames,
+    chunk by chunk. Neighbor searches run with n_jobs.
     """
-    assert nbins > 1
-    _x = x[~np.isnan(x)]
-    _, bins = np.histogram(_x, bins=nbins)
-    idx = np.digitize(x, bins, right=True)
-    idx = np.where(idx == 0, 1, idx)
-    idx = np.where(idx == nbins + 1, 0, idx)
-    return (idx, bins)
+    from sklearn import manifold
+    from sklearn.decomposition import PCA
+
+    n = len(X)
+    X = X.reshape([n, -1])
+    rng = np.random.default_rng(seed)
+    landmarks = np.sort(rng.choice(n, min(nlandmarks, n), replace=False))
+
+    pca = PCA(n_components=min(npca, len(landmarks), X.shape[1]), random_state=seed)
+    pca.fit(X[landmarks])
+    iso = manifold.Isomap(n_neighbors=n_neighbors, n_components=1, n_jobs=n_jobs)
+    iso.fit(pca.transform(X[landmarks]))
+
+    emb = np.zeros(n)
+    for i in range(0, n, chunk):
+        emb[i : i + chunk] = iso.transform(pca.transform(X[i : i + chunk]))[:, 0]
+    return emb
 
 
 class XGCFDataset(Dataset):
@@ -107,46 +122,35 @@ class XGCFDataset(Dataset):
             i_f = i_f.astype(np.float32)
             nphi, nnodes, nx, ny = i_f.shape
 
-            for iphi in range(nphi):
-                for i in range(nnodes):
-                    X = i_f[iphi, i, :, :]
-                    X = (X - np.min(X)) / (np.max(X) - np.min(X))
-                    # X = X[np.newaxis,:,:]
-                    # X = np.vstack([X,X,X])
-                    lx.append(X)
-                    ly.append(nclass[i])
-
-        self.X = np.array(lx)
-        self.y = np.array(ly)
+            ## Min-max normalization of all (iphi, node) slices at once
+            X = i_f.reshape((nphi * nnodes, nx, ny))
+            xmin = np.min(X, axis=(1, 2), keepdims=True)
+            xmax = np.max(X, axis=(1, 2), keepdims=True)
+            X -= xmin
+            X /= xmax - xmin
+            lx.append(X)
+            ly.append(np.tile(np.asarray(nclass)[:nnodes], nphi))
+            del i_f
+
+        self.X = np.concatenate(lx)
+        self.y = np.concatenate(ly)
         self.mean = np.mean(self.X)
         self.std = np.std(self.X)
         logging.debug("Dataset mean, std: %f %f" % (self.mean, self.std))
 
-        self.transform = transforms.Compose(
-            [
-                # transforms.ToPILImage(),
-                # transforms.Resize((hr_height, hr_height), Image.BICUBIC),
-                # transforms.ToTensor(),
-                # transforms.Normalize(mean, std),
-            ]
+        ## Nearest-neighbor upsample (skimage resize order=0) as one gather per sample
+        self.rows, self.cols = nearest_index_map(
+            self.X.shape[1:], (self.hr_height, self.hr_height)
         )
 
     def __getitem__(self, index):
         i = index
-        X = self.X[i, :]
-        ## 0: Nearest-neighbor, 1: Bi-linear, 2: Bi-quadratic, 3: Bi-cubic
-        X = resize(X, (self.hr_height, self.hr_height), order=0, anti_aliasing=False)
-        # (2021/02) Mnay problems for using PIL with numpy
-        # im = transforms.ToPILImage()(X)
-        # im = transforms.Resize((self.hr_height, self.hr_height), Image.BICUBIC)(im)
-        # X = np.array(im)
-        X = transforms.ToTensor()(X)
-        X = transforms.Normalize(self.mean, self.std)(X)
+        X = self.X[i][self.rows[:, np.newaxis], self.cols[np.newaxis, :]]
+        X = (X - self.mean) / self.std
+        X = torch.from_numpy(X.astype(np.float32)).unsqueeze(0)
         if self.nchannel == 3:
-            X = torch.cat([X, X, X])
+            X = X.expand(3, -1, -1)
         y = torch.tensor(self.y[i])
-        # print ('X:', X.shape, X.min(), X.max(), i)
-        # import pdb; pdb.set_trace()
         return (X, y)
 
     def __len__(self):
@@ -179,6 +183,25 @@ if __name__ == "__main__":
         help="number of cpu threads to use during batch generation",
     )
     parser.add_argument("--regen", help="regen", action="store_true")
+    parser.add_argument(
+        "--regen_method",
+        help="embedding for --regen: isomap (all frames) or landmark (PCA, landmark "
+        "Isomap and out-of-sample extension)",
+        choices=["isomap", "landmark"],
+        default="isomap",
+    )
+    parser.add_argument(
+        "--nlandmarks", type=int, default=4000, help="landmark: num. of landmarks"
+    )
+    parser.add_argument(
+        "--npca", type=int, default=50, help="landmark: num. of PCA components"
+    )
+    parser.add_argument(
+        "--regen_chunk", type=int, default=16384, help="landmark: frames per chunk"
+    )
+    parser.add_argument(
+        "--regen_jobs", type=int, default=-1, help="landmark: num. of parallel jobs"
+    )
     group = parser.add_mutually_exclusive_group()
     group.add_argument(
         "--N1024", help="N1024 model", action="store_const", dest="model", const="N1024"
@@ -211,29 +234,39 @@ if __name__ == "__main__":
     if opt.model == "N1024":
         ## 1024 classes
         if opt.regen:
-            import time
-            from sklearn import manifold
-
             n_neighbors = 30
-            _X = X.reshape([len(X), -1])
-            print("Embedding ...")
+            print("Embedding (%s) ..." % opt.regen_method)
             t0 = time.time()
-            X_iso = manifold.Isomap(
-                n_neighbors=n_neighbors, n_components=1
-            ).fit_transform(_X)
+            if opt.regen_method == "isomap":
+                from sklearn import manifold
+
+                _X = X.reshape([len(X), -1])
+                X_iso = manifold.Isomap(
+                    n_neighbors=n_neighbors, n_components=1
+                ).fit_transform(_X)[:, 0]
+            else:
+                X_iso = landmark_isomap(
+                    X,
+                    n_neighbors=n_neighbors,
+                    nlandmarks=opt.nlandmarks,
+                    npca=opt.npca,
+                    chunk=opt.regen_chunk,
+                    n_jobs=opt.regen_jobs,
+                )
             print("ISOMAP (time %.2fs)" % (time.time() - t0))
 
-            od = np.argsort(X_iso[:, 0])
+            ## Equal-size bins along the embedding
+            od = np.argsort(X_iso)
             ood = np.argsort(od)
             label = (
                 np.digitize(
-                    range(len(od)), np.linspace(0, len(od), 1024 + 1, dtype=np.int)
+                    range(len(od)), np.linspace(0, len(od), 1024 + 1, dtype=int)
                 )
                 - 1
             )
             print(min(label), max(label))
             np.save("nstx-label-%s.npy" % opt.model, label[ood])
-            nclass = label
+            nclass = label[ood]
         else:
             nclass = np.load("nstx-label-%s.npy" % opt.model)[:length]
         print(nclass.shape)
@@ -4,12 +4,17 @@ import os
 import logging
 import argparse
 
-
 parser = argparse.ArgumentParser()
 parser.add_argument("--exp", help="exp")
 parser.add_argument("--istep", help="istep", type=int, default=None)
 parser.add_argument("FILES", help="recon files", nargs="+", type=str)
 parser.add_argument("--output", help="exp", default="recon.bp")
+parser.add_argument(
+    "--nplanes",
+    help="num. of planes assembled and written per block (default: %(default)s)",
+    type=int,
+    default=1,
+)
 args = parser.parse_args()
 
 logging.basicConfig(level=logging.DEBUG, format="[%(levelname)s] %(message)s")
@@ -18,30 +23,74 @@ expdir = args.exp
 istep = args.istep
 recon_files = args.FILES
 
+## Only the shape and type of the original i_f are needed
 fname = os.path.join(expdir, "restart_dir/xgc.f0.%05d.bp" % istep)
 logging.debug(f"Reading: {fname}")
 with ad2.open(fname, "r") as f:
-    Zif = f.read("i_f")
+    var = f.available_variables()["i_f"]
+    shape = tuple([int(x.strip(",")) for x in var["Shape"].strip().split()])
+    dtype = {"float": np.float32}.get(var["Type"], np.float64)
+nphi, nmu, nnodes, nvp = shape
 
-Xif = np.zeros_like(Zif)
+## zlb of each recon file (X0 rows are read per plane block when needed)
+zlbs = list()
+whole = list()
 for fname in recon_files:
-    logging.debug(f"Reading: {fname}")
     with ad2.open(fname, "r") as f:
-        X0 = f.read("X0")
         zlb = f.read("zlb")
-    logging.debug(f"X0, zlb: {X0.shape} {zlb.shape}")
+    zlbs.append(zlb)
+    ## Rows of a plane block are contiguous only in recon files made from read_f0.
+    ## With read_f0_nodes or --surfid the rows are node-major, so every block spans
+    ## almost the whole file. When the block ranges add up to well over the file,
+    ## it is read once in full and kept in memory until its last plane block.
+    nread = 0
+    for p0 in range(0, nphi, args.nplanes):
+        rows = zlb[(zlb[:, 2] >= p0) & (zlb[:, 2] < p0 + args.nplanes), 0]
+        if len(rows) > 0:
+            nread += np.max(rows) - np.min(rows) + 1
+    whole.append(nread > 1.5 * len(zlb))
+
+
+def read_rows(fname, r0=None, r1=None):
+    with ad2.open(fname, "r") as f:
+        if r0 is None:
+            return f.read("X0")
+        shape0 = f.available_variables()["X0"]["Shape"]
+        _, nx, ny = [int(x.strip(",")) for x in shape0.strip().split()]
+        return f.read("X0", start=(r0, 0, 0), count=(r1 - r0, nx, ny))
 
-    for i, istep, iphi, inode in zlb:
-        Xif[iphi, :, inode, :] = X0[i, :, :]
 
+X0s = dict()
 fname = args.output
 logging.debug(f"Saving: {fname}")
 with ad2.open(fname, "w") as fw:
-    shape = Xif.shape
-    start = [
-        0,
-    ] * len(shape)
-    count = shape
-    fw.write("i_f", Xif.copy(), shape, start, count)
+    for p0 in range(0, nphi, args.nplanes):
+        p1 = min(p0 + args.nplanes, nphi)
+        block = np.zeros((p1 - p0, nmu, nnodes, nvp), dtype=dtype)
+        for k, (fname, zlb) in enumerate(zip(recon_files, zlbs)):
+            last = np.max(zlb[:, 2]) < p1
+            ## zlb: (i, istep, iphi, inode)
+            zlb = zlb[(zlb[:, 2] >= p0) & (zlb[:, 2] < p1)]
+            if len(zlb) == 0:
+                continue
+            if whole[k]:
+                if k not in X0s:
+                    logging.debug(f"Reading: {fname}")
+                    X0s[k] = read_rows(fname)
+                X0, r0 = X0s[k], 0
+                if last:
+                    del X0s[k]
+            else:
+                ## Only the rows range of this block
+                r0, r1 = np.min(zlb[:, 0]), np.max(zlb[:, 0]) + 1
+                logging.debug(f"Reading: {fname} rows {r0}:{r1}")
+                X0 = read_rows(fname, r0, r1)
+            logging.debug(f"X0, zlb: {X0.shape} {zlb.shape}")
+
+            block[zlb[:, 2] - p0, :, zlb[:, 3], :] = X0[zlb[:, 0] - r0, :, :]
+            del X0
+
+        start = (p0, 0, 0, 0)
+        fw.write("i_f", block, shape, start, block.shape)
 
 print("Done.")
@@ -0,0 +1,152 @@
+import sys
+import types
+
+import numpy as np
+import pytest
+
+try:
+    import adios2
+except ImportError:
+    ## vapor.dataset imports adios2 at module level; the mesh readers under test
+    ## import it when called and get FakeAdios below
+    sys.modules["adios2"] = types.ModuleType("adios2")
+
+from vapor.dataset import cond, mesh
+
+
+class FakeFile:
+    def __init__(self, variables):
+        self.variables = variables
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def available_variables(self):
+        return {k: {"Shape": str(v.shape)} for k, v in self.variables.items()}
+
+    def read(self, name):
+        return self.variables[name].copy()
+
+
+class FakeAdios:
+    """adios2 high-level API over in-memory files"""
+
+    def __init__(self, files):
+        self.files = files
+
+    def open(self, fname, mode):
+        return FakeFile(self.files[fname])
+
+
+def make_mesh(rng):
+    nnodes = 30
+    rz = np.concatenate(
+        [[[1.7, 0.0]], rng.uniform((1.0, -1.2), (2.4, 1.2), (nnodes - 1, 2))]
+    )
+    ## Three surfaces over nodes 1 ... 24 (1-based in surf_idx); 25 ... 29 are off
+    surf_len = np.array([8, 10, 6])
+    surf_idx = np.zeros((3, 10), dtype=np.int32)
+    start = 1
+    for i, n in enumerate(surf_len):
+        surf_idx[i, :n] = np.arange(start, start + n) + 1
+        start += n
+    theta = rng.uniform(-np.pi, np.pi, nnodes)
+    theta[25:] = -10
+    return {
+        "n_n": np.array(nnodes),
+        "rz": rz,
+        "nd_connect_list": np.zeros((1, 3), dtype=np.int32),
+        "nextnode": np.arange(nnodes),
+        "surf_idx": surf_idx,
+        "surf_len": surf_len,
+        "psi_surf": np.array([0.1, 0.2, 0.3]),
+        "theta": theta,
+    }
+
+
+def old_setup_da(rz, zlb, polar):
+    """The per-sample loop setup_da used before conditioning_features"""
+    da = np.zeros((len(zlb), 2), dtype=np.float32)
+    _rz = np.array(rz[:, 0], dtype=complex)
+    _rz.imag = rz[:, 1]
+    for i, inode in enumerate(zlb[:, 3]):
+        if polar:
+            dist = np.linalg.norm(_rz[inode] - _rz[0])
+            angle = np.angle(_rz[inode] - _rz[0])
+        else:
+            dist = rz[inode, 0] - rz[0, 0]
+            angle = rz[inode, 1] - rz[0, 1]
+        da[i, :] = (dist, angle)
+    return da
+
+
+def old_surface_features(variables):
+    """psi, theta and surf of each node from a loop over surf_idx"""
+    nnodes = int(variables["n_n"])
+    nsurf = len(variables["surf_len"])
+    psi = np.zeros(nnodes)
+    surf = np.zeros(nnodes)
+    for i in range(nsurf):
+        for j in range(variables["surf_len"][i]):
+            inode = variables["surf_idx"][i, j] - 1
+            psi[inode] = variables["psi_surf"][i]
+            surf[inode] = (i + 1) / nsurf
+    theta = variables["theta"].copy()
+    theta[theta == -10] = 0
+    return np.stack([psi, theta, surf], axis=1)
+
+
+@pytest.fixture
+def files(monkeypatch):
+    files = dict()
+    monkeypatch.setitem(sys.modules, "adios2", FakeAdios(files))
+    for f in (cond._load_rz, cond._node_features, mesh._load_mesh):
+        f.cache_clear()
+    yield files
+    for f in (cond._load_rz, cond._node_features, mesh._load_mesh):
+        f.cache_clear()
+
+
+@pytest.fixture
+def zlb():
+    zlb = np.zeros((200, 4), dtype=np.int64)
+    zlb[:, 3] = np.random.default_rng(1).integers(0, 30, len(zlb))
+    return zlb
+
+
+@pytest.mark.parametrize("polar", [True, False])
+def test_geometry_matches_loop(files, zlb, polar):
+    rz = make_mesh(np.random.default_rng(0))["rz"]
+    ## rz only: polar/cartesian must not need the mesh topology
+    files["/xgc.mesh.bp"] = {"rz": rz}
+    da = cond.conditioning_features(
+        "/xgc.mesh.bp", zlb, ("polar" if polar else "cartesian",)
+    )
+    np.testing.assert_allclose(da, old_setup_da(rz, zlb, polar), rtol=1e-6, atol=1e-6)
+
+
+def test_surface_features_match_loop(files, zlb):
+    variables = make_mesh(np.random.default_rng(0))
+    files["/xgc.mesh.bp"] = variables
+    da = cond.conditioning_features(
+        "/xgc.mesh.bp", zlb, ("polar", "psi", "theta", "surf")
+    )
+    assert da.shape == (len(zlb), 5)
+    np.testing.assert_allclose(
+        da[:, :2], old_setup_da(variables["rz"], zlb, True), rtol=1e-6, atol=1e-6
+    )
+    np.testing.assert_allclose(
+        da[:, 2:], old_surface_features(variables)[zlb[:, 3]], rtol=1e-6
+    )
+
+
+@pytest.mark.parametrize("name,missing", [("theta", "theta"), ("psi", "psi_surf")])
+def test_missing_mesh_variable(files, zlb, name, missing):
+    variables = make_mesh(np.random.default_rng(0))
+    del variables[missing]
+    files["/xgc.mesh.bp"] = variables
+    with pytest.raises(ValueError, match="mesh variable '%s'" % name):
+        cond.conditioning_features("/xgc.mesh.bp", zlb, ("polar", name))
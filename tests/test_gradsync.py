@@ -0,0 +1,84 @@
+import types
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from vapor.model.vqvae import VectorQuantizerEMA
+from vapor.util.gradsync import GradientSync, replaced_in_forward
+
+
+class FakeRequest:
+    pass
+
+
+class FakeComm:
+    """Two ranks with identical gradients: a reduction doubles the buffer"""
+
+    def __init__(self):
+        self.launched = 0
+
+    def Get_size(self):
+        return 2
+
+    def Iallreduce(self, sendbuf, recvbuf, op=None):
+        recvbuf *= 2
+        self.launched += 1
+        return FakeRequest()
+
+    def Allreduce(self, sendbuf, recvbuf, op=None):
+        recvbuf *= 2
+
+
+FakeMPI = types.SimpleNamespace(
+    IN_PLACE=None,
+    SUM=None,
+    Request=types.SimpleNamespace(Waitall=lambda requests: None),
+)
+
+
+class VQModel(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.encoder = nn.Conv2d(1, 8, 3, padding=1)
+        self.vq = VectorQuantizerEMA(16, 8, 0.25, 0.99)
+        self.decoder = nn.Conv2d(8, 1, 3, padding=1)
+
+    def forward(self, x):
+        loss, quantized, _, _ = self.vq(self.encoder(x))
+        return loss + torch.mean((self.decoder(quantized) - x) ** 2)
+
+
+def make_sync(model):
+    comm = FakeComm()
+    sync = GradientSync(model, comm=comm, bucket_cap_mb=0)
+    sync.MPI = FakeMPI
+    return sync, comm
+
+
+def test_ema_params_not_bucketed():
+    model = VQModel()
+    sync, _ = make_sync(model)
+    ema = set(id(p) for p in replaced_in_forward(model))
+    assert ema == set(id(p) for p in model.vq.parameters())
+    for bucket in sync.buckets:
+        assert not any(id(p) in ema for p in bucket.params)
+
+
+def test_ema_buckets_launch_during_backward():
+    torch.manual_seed(0)
+    model = VQModel()
+    model.train()
+    sync, comm = make_sync(model)
+    x = torch.rand(4, 1, 8, 8)
+    for _ in range(3):
+        model.zero_grad()
+        loss = model(x)
+        loss.backward()
+        ## Every bucket went out from the hooks, none is left for synchronize()
+        assert comm.launched == len(sync.buckets)
+        grads = [p.grad.clone() for p in model.decoder.parameters()]
+        sync.synchronize()
+        for p, g in zip(model.decoder.parameters(), grads):
+            np.testing.assert_allclose(p.grad.numpy(), g.numpy(), rtol=1e-6)
+        comm.launched = 0
@@ -37,7 +37,6 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.utils.data import DataLoader
 import torch.optim as optim
-import torch.autograd.profiler as profiler
 from torch.backends import cudnn
 
 import torchvision.datasets as datasets
@@ -56,10 +55,39 @@ import hashlib
 from skimage.transform import resize
 
 from models import *
+from vapor.util.metric import MetricAccumulator
+from vapor.util.tracker import ErrorTracker, window_error
+from vapor.util.timer import PhaseTimer, TraceWindow
+from vapor.util.amp import PRECISIONS, get_autocast, get_grad_scaler
+from vapor.util.gradsync import GradientSync
+from vapor.util.shard import shard_work
+from vapor.util.checkpoint import (
+    AsyncCheckpointer,
+    load_training_state,
+    get_rng_state,
+    set_rng_state,
+)
+from vapor.dataset.parallel import (
+    read_f0_parallel,
+    allgather_nodes,
+    redistribute_nodes,
+    balance_nodes,
+    node_blocks,
+)
+from vapor.dataset.sampler import AdaptiveSampler
+from vapor.dataset.cond import conditioning_features
 
 from torchvision.models.resnet import conv3x3, conv1x1, BasicBlock
 
 ## Global variables
+## Training histories saved with checkpoints (metric name: file name)
+HISTORY_NAMES = {
+    "recon_error": "err",
+    "loss": "loss",
+    "vq_loss": "vq_loss",
+    "perplexity": "perplexity",
+    "physics_error": "physics_error",
+}
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 xgcexp = None
 Z0, zmu, zsig, zmin, zmax = None, None, None, None, None
@@ -358,10 +386,19 @@ def physics_loss(data, lb, data_recon, progress=False):
 
 # %%
 def read_f0_nodes(
-    istep, inodes, expdir=None, iphi=None, nextnode_arr=None, rescale=None
+    istep,
+    inodes,
+    expdir=None,
+    iphi=None,
+    nextnode_arr=None,
+    rescale=None,
+    comm=None,
+    nreaders=None,
 ):
     """
     Read XGC f0 data
+    With comm, ranks read disjoint node blocks collectively and each rank keeps only
+    its share of inodes (the full array is assembled only for untwist).
     """
 
     def adios2_get_shape(f, varname):
@@ -378,18 +415,39 @@ def read_f0_nodes(
         return (nstep, lshape)
 
     fname = os.path.join(expdir, "restart_dir/xgc.f0.%05d.bp" % istep)
-    with ad2.open(fname, "r") as f:
-        nstep, nsize = adios2_get_shape(f, "i_f")
-        ndim = len(nsize)
-        nphi = nsize[0] if iphi is None else 1
+    if comm is not None:
+        size, rank = comm.Get_size(), comm.Get_rank()
+        block, n0, n1 = read_f0_parallel(fname, comm, iphi=iphi, nreaders=nreaders)
+        inodes = np.asarray(inodes)
+        parts = node_blocks(len(inodes), size)
+        if nextnode_arr is not None:
+            ## untwist follows field lines through all nodes: needs the full array
+            i_f = allgather_nodes(block, n0, n1, comm).astype("float64")
+            nodes = None
+        else:
+            dest = np.full(max(comm.allgather(n1)), -1)
+            for k, (a, b) in enumerate(parts):
+                dest[inodes[a:b]] = k
+            block, nodes = redistribute_nodes(block, n0, dest, comm)
+            i_f = block.astype("float64")
+        a, b = parts[rank]
+        inodes = inodes[a:b]
+        nphi = i_f.shape[0]
         iphi = 0 if iphi is None else iphi
-        nnodes = nsize[2]
-        nmu = nsize[1]
-        nvp = nsize[3]
-        start = (iphi, 0, 0, 0)
-        count = (nphi, nmu, nnodes, nvp)
-        logging.info(f"Reading: {fname} {start} {count}")
-        i_f = f.read("i_f", start=start, count=count).astype("float64")
+    else:
+        with ad2.open(fname, "r") as f:
+            nstep, nsize = adios2_get_shape(f, "i_f")
+            ndim = len(nsize)
+            nphi = nsize[0] if iphi is None else 1
+            iphi = 0 if iphi is None else iphi
+            nnodes = nsize[2]
+            nmu = nsize[1]
+            nvp = nsize[3]
+            start = (iphi, 0, 0, 0)
+            count = (nphi, nmu, nnodes, nvp)
+            logging.info(f"Reading: {fname} {start} {count}")
+            i_f = f.read("i_f", start=start, count=count).astype("float64")
+        nodes = None
 
     # if i_f.shape[3] == 31:
     #     i_f = np.append(i_f, i_f[...,30:31], axis=3)
@@ -412,9 +470,12 @@ def read_f0_nodes(
     lb_list = list()
     ## i_f is already subset
     ## (2021/02) group by inter-planes first
-    for j in inodes:
+    ## Position of each node in i_f (only the received nodes with comm)
+    pos = inodes if nodes is None else np.searchsorted(nodes, inodes)
+    assert nodes is None or np.all(nodes[pos] == inodes), "duplicated inodes"
+    for j, p in zip(inodes, pos):
         for i in range(nphi):
-            da_list.append(i_f[i, j, :, :])
+            da_list.append(i_f[i, p, :, :])
             k = j
             if nextnode_arr is not None:
                 k = nextnode_arr[i + iphi, j]
@@ -458,9 +519,13 @@ def read_f0(
     nchunk=16,
     fieldline=False,
     normalize=False,
+    comm=None,
+    nreaders=None,
 ):
     """
     Read XGC f0 data
+    With comm, ranks read disjoint node blocks collectively and assemble them
+    (contiguous node range only).
     """
 
     def adios2_get_shape(f, varname):
@@ -558,6 +623,15 @@ def read_f0(
         logging.info(f"Fieldline: {len(lb)}")
         logging.info(f"{lb}")
         i_f = i_f[:, :, lb, :]
+    elif comm is not None:
+        ## Each rank keeps only its balanced share of the node range
+        block, n0, n1 = read_f0_parallel(
+            fname, comm, iphi=iphi, inode=inode, nnodes=nnodes, nreaders=nreaders
+        )
+        block, nodes = balance_nodes(block, n0, n1, comm)
+        i_f = block.astype("float64")
+        nphi = i_f.shape[0]
+        lb = np.array(inode + nodes, dtype=np.int32)
     else:
         with ad2.open(fname, "r") as f:
             nstep, nsize = adios2_get_shape(f, "i_f")
@@ -614,6 +688,65 @@ def read_f0(
     return (Z0, Zif, zmu, zsig, zmin, zmax, zlb)
 
 
+# %%
+def f0_work_units(istep, expdir=None, iphi=None, inode=0, nnodes=None, nblock=256):
+    """
+    Split (timestep, iphi, node range) of XGC f0 data into work units
+    (istep, iphi, n0, n1) of at most nblock nodes
+    """
+    fname = os.path.join(expdir, "restart_dir/xgc.f0.%05d.bp" % istep)
+    with ad2.open(fname, "r") as f:
+        shape = f.available_variables()["i_f"]["Shape"]
+        nsize = tuple([int(x.strip(",")) for x in shape.strip().split()])
+    planes = range(nsize[0]) if iphi is None else [iphi]
+    _nnodes = nsize[2] - inode if nnodes is None else nnodes
+    units = list()
+    for p in planes:
+        for n0 in range(inode, inode + _nnodes, nblock):
+            units.append((istep, p, n0, min(n0 + nblock, inode + _nnodes)))
+    return units
+
+
+# %%
+def read_f0_units(istep, units, expdir=None, normalize=False):
+    """
+    Read XGC f0 data of the given work units (istep, iphi, n0, n1) of a timestep.
+    Only the selections of the units are read. Returns the same tuple as read_f0.
+    """
+    fname = os.path.join(expdir, "restart_dir/xgc.f0.%05d.bp" % istep)
+    lf = list()
+    lb = list()
+    with ad2.open(fname, "r") as f:
+        shape = f.available_variables()["i_f"]["Shape"]
+        nsize = tuple([int(x.strip(",")) for x in shape.strip().split()])
+        nmu = nsize[1]
+        nvp = nsize[3]
+        for (_istep, iphi, n0, n1) in units:
+            assert _istep == istep
+            start = (iphi, 0, n0, 0)
+            count = (1, nmu, n1 - n0, nvp)
+            logging.info(f"Reading: {fname} {start} {count}")
+            i_f = f.read("i_f", start=start, count=count).astype("float64")
+            lf.append(np.moveaxis(i_f[0], 0, 1))
+            lb.extend([(istep, iphi, k) for k in range(n0, n1)])
+
+    Z0 = np.concatenate(lf, axis=0)
+    zlb = np.array(lb)
+
+    zmu = np.mean(Z0, axis=(1, 2))
+    zsig = np.std(Z0, axis=(1, 2))
+    zmin = np.min(Z0, axis=(1, 2))
+    zmax = np.max(Z0, axis=(1, 2))
+    if normalize:
+        Zif = (Z0 - zmin[:, np.newaxis, np.newaxis]) / (zmax - zmin)[
+            :, np.newaxis, np.newaxis
+        ]
+    else:
+        Zif = Z0
+
+    return (Z0, Zif, zmu, zsig, zmin, zmax, zlb)
+
+
 # %%
 def read_nstx(
     expdir=None,
@@ -654,32 +787,6 @@ def read_nstx(
     return (Z0, Zif, zmu, zsig, zmin, zmax, zlb)
 
 
-# %%
-def average_gradients(model):
-    """
-    Gradient averaging
-    """
-    try:
-        MPI
-    except NameError:
-        return
-
-    comm = MPI.COMM_WORLD
-    size = comm.Get_size()
-    rank = comm.Get_rank()
-    for i, (name, param) in enumerate(model.named_parameters()):
-        if param.grad is not None:
-            # print ('[%d] %d: %s (b): %f '%(rank, i, name, param.grad.data.sum()))
-            x = comm.allreduce(param.grad.data, op=MPI.SUM)
-            param.grad.data = x / size
-            # print ('[%d] %d: %s (a): %f'%(rank, i, name, param.grad.data.sum()))
-        else:
-            # print ('[%d] %d: %s (b): %f '%(rank, i, name, param.data.sum()))
-            x = comm.allreduce(param.data, op=MPI.SUM)
-            param.data = x / size
-            # print ('[%d] %d: %s (a): %f'%(rank, i, name, param.data.sum()))
-
-
 # %%
 def recon(
     model,
@@ -928,6 +1035,11 @@ class VectorQuantizer(nn.Module):
         self._commitment_cost = commitment_cost
 
     def forward(self, inputs):
+        ## Distances and EMA updates stay in fp32 when called under autocast
+        with torch.autocast(device_type=inputs.device.type, enabled=False):
+            return self._forward(inputs.float())
+
+    def _forward(self, inputs):
         # convert inputs from BCHW -> BHWC
         inputs = inputs.permute(0, 2, 3, 1).contiguous()
         input_shape = inputs.shape
@@ -989,6 +1101,11 @@ class VectorQuantizerEMA(nn.Module):
         self._epsilon = epsilon
 
     def forward(self, inputs):
+        ## Distances and EMA updates stay in fp32 when called under autocast
+        with torch.autocast(device_type=inputs.device.type, enabled=False):
+            return self._forward(inputs.float())
+
+    def _forward(self, inputs):
         # convert inputs from BCHW -> BHWC
         inputs = inputs.permute(0, 2, 3, 1).contiguous()
         input_shape = inputs.shape
@@ -1201,12 +1318,10 @@ class Encoder(nn.Module):
         # (2020/11) Testing with resize
         x = inputs
         if da is not None:
-            _d = torch.zeros_like(x)
-            _a = torch.zeros_like(x)
-            _d[:, :, :, :] = da[:, 0, np.newaxis, np.newaxis, np.newaxis]
-            _a[:, :, :, :] = da[:, 1, np.newaxis, np.newaxis, np.newaxis]
-            _da = torch.cat((_d, _a), dim=1)
-            x = torch.cat((x, _d, _a), dim=1)
+            ## One constant channel per conditioning feature
+            nb, nc, nx, ny = x.shape
+            _da = da.to(x.dtype)[:, :, np.newaxis, np.newaxis].expand(-1, -1, nx, ny)
+            x = torch.cat((x, _da), dim=1)
         # print ('ENC #1:', x.shape)
         # if self._rescale is not None:
         #     x = F.interpolate(inputs, size=x.shape[-1]*self._rescale)
@@ -1357,12 +1472,10 @@ class Decoder(nn.Module):
     def forward(self, inputs, da=None):
         x = inputs
         if da is not None:
+            ## One constant channel per conditioning feature
             nb, nc, nx, ny = x.shape
-            _d = torch.zeros_like(x)
-            _a = torch.zeros_like(x)
-            _d[:, :, :, :] = da[:, 0, np.newaxis, np.newaxis, np.newaxis]
-            _a[:, :, :, :] = da[:, 1, np.newaxis, np.newaxis, np.newaxis]
-            x = torch.cat((x, _d[:, -1:, :, :], _a[:, -1:, :, :]), dim=1)
+            _da = da.to(x.dtype)[:, :, np.newaxis, np.newaxis].expand(-1, -1, nx, ny)
+            x = torch.cat((x, _da), dim=1)
         # print ('DEC #1:', x.shape)
 
         x = self._conv_1(x)
@@ -1410,6 +1523,7 @@ class Model(nn.Module):
         conditional=False,
         decoder_padding=[1, 1, 1],
         da_conditional=False,
+        ncond=2,
         decoder_layer_sizes=[],
     ):
         super(Model, self).__init__()
@@ -1428,7 +1542,7 @@ class Model(nn.Module):
 
         self.ncond = 0
         if da_conditional:
-            self.ncond = 2
+            self.ncond = ncond
 
         self._encoder = Encoder(
             self.width + self.ncond,
@@ -1573,7 +1687,11 @@ class Model(nn.Module):
 
 
 # %%
-def load_checkpoint(DIR, prefix, model):
+def load_checkpoint(DIR, prefix, model, state=None):
+    """
+    Restore model weights from the latest checkpoint.
+    state is an already loaded checkpoint (load_training_state) to avoid a second read.
+    """
     ## (2020/06) no use anymore
     # hcode = hashlib.md5(str(model).encode()).hexdigest()
     # print ('hash:', hcode)
@@ -1581,49 +1699,63 @@ def load_checkpoint(DIR, prefix, model):
     _istart = None
     _model = None
     _dmodel = None
-    _err = None
     try:
         with open("%s/checkpoint.txt" % (_prefix), "r") as f:
             _istart = int(f.readline())
-        fname = "%s/checkpoint.%d.pytorch" % (_prefix, _istart)
-        log("Checkpoint:", fname)
-        _model = torch.load(fname)
-        model.load_state_dict(_model.state_dict())
-        _model = model
-        _model.eval()
-    except:
-        log("Error:", sys.exc_info()[0])
+    except FileNotFoundError:
         log("No restart info")
-        pass
+        return (_istart, _model, _dmodel)
+
+    ## Legacy checkpoints pickle the whole module, which torch.load refuses with the
+    ## weights_only default (torch >= 2.6). These files are written by us.
+    fname = "%s/checkpoint.%d.pytorch" % (_prefix, _istart)
+    log("Checkpoint:", fname)
+    if state is None:
+        state = torch.load(fname, map_location="cpu", weights_only=False)
+    if isinstance(state, dict):
+        ## state_dict checkpoint (AsyncCheckpointer)
+        model.load_state_dict(state["model"])
+    else:
+        ## (legacy) pickled module
+        model.load_state_dict(state.state_dict())
+    _model = model
+    _model.eval()
 
-    try:
-        fname = "%s/checkpoint-dmodel.%d.pytorch" % (_prefix, _istart)
+    fname = "%s/checkpoint-dmodel.%d.pytorch" % (_prefix, _istart)
+    if os.path.exists(fname):
         log("Checkpoint:", fname)
-        _dmodel = torch.load(fname)
-    except:
-        pass
+        _dmodel = torch.load(fname, map_location="cpu", weights_only=False)
 
     return (_istart, _model, _dmodel)
 
 
 # %%
-def save_checkpoint(DIR, prefix, model, err, epoch, dmodel=None):
-    ## (2020/06) no use anymore
-    # hcode = hashlib.md5(str(model).encode()).hexdigest()
-    _prefix = "%s/%s" % (DIR, prefix)
-    Path(_prefix).mkdir(parents=True, exist_ok=True)
-    with open("%s/model.txt" % (_prefix), "w+") as f:
-        f.write(str(model))
-    fname = "%s/err.%d.npz" % (_prefix, epoch)
-    np.savez(fname, err=err)
-    fname = "%s/checkpoint.%d.pytorch" % (_prefix, epoch)
-    torch.save(model, fname)
-    if dmodel is not None:
-        fname = "%s/checkpoint-dmodel.%d.pytorch" % (_prefix, epoch)
-        torch.save(dmodel, fname)
-    with open("%s/checkpoint.txt" % (_prefix), "w+") as f:
-        f.write(str(epoch))
-    log("Saved checkpoint: %s" % (fname))
+def save_checkpoint(
+    checkpointer,
+    model,
+    err,
+    epoch,
+    dmodel=None,
+    optimizer=None,
+    scheduler=None,
+    history=None,
+    extra=None,
+):
+    """
+    Snapshot model (and dmodel, optimizer, scheduler) state on CPU and write it in the
+    background. Only the new part of the err (and other) histories is appended.
+    """
+    _history = {"err": err}
+    _history.update(history or dict())
+    checkpointer.save(
+        epoch,
+        model,
+        optimizer=optimizer,
+        scheduler=scheduler,
+        history=_history,
+        extra=extra,
+        dmodel=dmodel,
+    )
 
 
 class ResidualLinear(nn.Module):
@@ -1683,6 +1815,7 @@ class VAE(nn.Module):
         num_residual_layers,
         shaconv=False,
         da_conditional=False,
+        ncond=2,
     ):
         super(VAE, self).__init__()
 
@@ -1697,7 +1830,7 @@ class VAE(nn.Module):
 
         self.ncond = 0
         if da_conditional:
-            self.ncond = 2
+            self.ncond = ncond
         self.fc1 = nn.Linear(self.nx * self.ny + self.ncond, self.nh)
         self.fc21 = nn.Linear(self.nh, self.nz)
         self.fc22 = nn.Linear(self.nh, self.nz)
@@ -1789,6 +1922,7 @@ class AE(nn.Module):
         decoder_layer_sizes=[],
         conditional=False,
         da_conditional=False,
+        ncond=2,
     ):
         super().__init__()
 
@@ -1811,7 +1945,7 @@ class AE(nn.Module):
 
         self.ncond = 0
         if da_conditional:
-            self.ncond = 2
+            self.ncond = ncond
 
         ## (2021/03) 400 = 16x5x5 to match with VQ-VAE
         # self._encoder = nn.Sequential(
@@ -2401,6 +2535,18 @@ def main():
         type=int,
         default=10_000,
     )
+    parser.add_argument(
+        "--keep_checkpoints",
+        help="num. of latest checkpoints to keep (default: %(default)s)",
+        type=int,
+        default=3,
+    )
+    parser.add_argument(
+        "--metric_interval",
+        help="steps between copying training metrics to host (default: %(default)s)",
+        type=int,
+        default=100,
+    )
     parser.add_argument("--nompi", help="nompi", action="store_true")
     parser.add_argument("--seed", help="seed (default: %(default)s)", type=int)
     parser.add_argument("--nworkers", help="nworkers (default: %(default)s)", type=int)
@@ -2412,6 +2558,31 @@ def main():
     parser.add_argument(
         "--resampling_interval", help="resampling_interval", type=int, default=None
     )
+    parser.add_argument(
+        "--resampling_mode",
+        help="full: estimate_error over the dataset; incremental: errors tracked in "
+        "training plus a probe batch (default: %(default)s)",
+        choices=("full", "incremental"),
+        default="full",
+    )
+    parser.add_argument(
+        "--probe_size",
+        help="num. of stale windows refreshed per resampling (default: %(default)s)",
+        type=int,
+        default=256,
+    )
+    parser.add_argument(
+        "--profile_steps",
+        help="record a Chrome trace for steps [START, STOP)",
+        nargs=2,
+        type=int,
+        metavar=("START", "STOP"),
+    )
+    parser.add_argument(
+        "--timing_sync",
+        help="synchronize CUDA around each timed phase",
+        action="store_true",
+    )
     parser.add_argument("--overwrite", help="overwrite", action="store_true")
     parser.add_argument(
         "--learning_rate", "--lr", help="learning_rate", type=float, default=1e-3
@@ -2432,6 +2603,12 @@ def main():
         "--stepsize", help="scheduler step size", type=int, default=50_000
     )
     parser.add_argument("--tb", help="tensorboard", action="store_true")
+    parser.add_argument(
+        "--precision",
+        help="training precision, vqvae/cvqvae only (default: %(default)s)",
+        choices=PRECISIONS,
+        default="fp32",
+    )
 
     parser.add_argument("--c_alpha", help="c_alpha", type=float, default=1.0)
     parser.add_argument("--c_beta", help="c_beta", type=float, default=1.0)
@@ -2466,6 +2643,33 @@ def main():
     group1.add_argument("--iphi", help="iphi", type=int, default=None)
     group1.add_argument("--nodestride", help="nodestride", type=int, default=1)
     group1.add_argument("--splitfiles", help="splitfiles", action="store_true")
+    group1.add_argument(
+        "--shard",
+        help="read only this rank's share of (timestep, iphi, node block) units",
+        action="store_true",
+    )
+    group1.add_argument(
+        "--parallel_read",
+        help="read each file collectively over MPI ranks (disjoint node blocks)",
+        action="store_true",
+    )
+    group1.add_argument(
+        "--nreaders",
+        help="num. of ranks reading with --parallel_read (default: all)",
+        type=int,
+        default=None,
+    )
+    group1.add_argument(
+        "--shard_shuffle",
+        help="randomize the shard assignment with --seed",
+        action="store_true",
+    )
+    group1.add_argument(
+        "--shard_block",
+        help="nodes per shard unit (default: %(default)s)",
+        type=int,
+        default=256,
+    )
     group1.add_argument("--overwrap", help="overwrap", type=int, default=1)
     group1.add_argument("--inode", help="inode", type=int, default=0)
     group1.add_argument("--nnodes", help="nnodes", type=int, default=None)
@@ -2476,6 +2680,13 @@ def main():
     group1.add_argument("--fieldline", help="fieldline", action="store_true")
     group1.add_argument("--saverecon", help="save recon", action="store_true")
     group1.add_argument("--polar", help="use polar info", action="store_true")
+    group1.add_argument(
+        "--da_features",
+        help="extra per-node conditioning features (cvqvae, cvae, cae)",
+        nargs="+",
+        choices=["psi", "theta", "surf"],
+        default=[],
+    )
 
     group2 = parser.add_argument_group("NSTX", "NSTX processing options")
     ## 159065, 172585, 186106, 199626, 213146, 226667, 240187, 253708, 267228, 280749
@@ -2528,6 +2739,11 @@ def main():
     )
     parser.set_defaults(model="vqvae")
     args = parser.parse_args()
+    ## Autocast and loss scaling are wired into the vqvae/cvqvae step only
+    if (args.precision != "fp32") and (args.model not in ("vqvae", "cvqvae")):
+        parser.error(
+            "--precision %s is not supported for %s" % (args.precision, args.model)
+        )
 
     DIR = args.wdir
     prefix = "exp-%s-%s-B%d-C%d-H%d-R%d-L%d-E%d-e%d" % (
@@ -2646,6 +2862,21 @@ def main():
     # prefix='xgc-%s-batch%d-edim%d-nhidden%d-nchannel%d-nresidual_hidden%d'%(args.exp, args.batch_size, args.embedding_dim, args.num_hiddens, args.num_channels, args.num_residual_hiddens)
     logging.info("prefix: %s" % prefix)
     writer = SummaryWriter("runs/%s" % prefix)
+    ## Resumable training state (optimizer, scheduler, RNG, sampling, histories, stats)
+    state = None
+    history_len = None
+    if args.overwrite:
+        history_len = {name: 0 for name in HISTORY_NAMES.values()}
+    else:
+        state = load_training_state("%s/%s" % (DIR, prefix))
+        if state is not None:
+            history_len = state["history_len"]
+    ## Only rank 0 writes the checkpoints and histories, so only it truncates them
+    checkpointer = AsyncCheckpointer(
+        "%s/%s" % (DIR, prefix),
+        keep=args.keep_checkpoints,
+        history_len=history_len if rank == 0 else None,
+    )
 
     # %%
     ## Reading data
@@ -2660,12 +2891,64 @@ def main():
         timesteps = args.timesteps
         if args.splitfiles:
             timesteps = np.array_split(np.array(timesteps), size)[rank]
+        ## Collective reads need every rank on the same file
+        read_comm = None
+        if args.parallel_read and (comm is not None):
+            assert not args.splitfiles and not args.shard
+            read_comm = comm
+        shard_units = None
+        if args.shard:
+            assert args.surfid is None and args.randomread == 0.0 and not args.fieldline
+            timesteps = args.timesteps
+            units = list()
+            for istep in timesteps:
+                units.extend(
+                    f0_work_units(
+                        istep,
+                        expdir=args.datadir,
+                        iphi=args.iphi,
+                        inode=args.inode,
+                        nnodes=args.nnodes,
+                        nblock=args.shard_block,
+                    )
+                )
+            if len(units) < size:
+                raise ValueError(
+                    "--shard: %d work units for %d ranks; every rank needs at least "
+                    "one (use a smaller --shard_block)" % (len(units), size)
+                )
+            weights = [n1 - n0 for (_, _, n0, n1) in units]
+            shard_units = shard_work(
+                units,
+                size,
+                rank,
+                weights=weights,
+                shuffle=args.shard_shuffle,
+                seed=0 if args.seed is None else args.seed,
+            )
+            timesteps = sorted(set([u[0] for u in shard_units]))
+            logging.info(
+                "Shard: %d of %d units, %d samples"
+                % (
+                    len(shard_units),
+                    len(units),
+                    sum([n1 - n0 for (_, _, n0, n1) in shard_units]),
+                )
+            )
         f0_data_list = list()
         hr_data_list = list()
         logging.info(f"Data dir: {args.datadir}")
         for istep in timesteps:
             logging.info(f"Reading: {istep}")
-            if args.surfid is not None:
+            if shard_units is not None:
+                _units = [u for u in shard_units if u[0] == istep]
+                _out = read_f0_units(istep, _units, expdir=args.datadir)
+                f0_data_list.append(_out)
+                if args.hr:
+                    assert args.hr_datadir is not None
+                    _out2 = read_f0_units(istep, _units, expdir=args.hr_datadir)
+                    hr_data_list.append(_out2)
+            elif args.surfid is not None:
                 surfid_list = parse_rangestr(args.surfid)
                 node_list = list()
                 for i in surfid_list:
@@ -2682,6 +2965,8 @@ def main():
                     iphi=args.iphi,
                     nextnode_arr=nextnode_arr,
                     rescale=args.rescaleinput,
+                    comm=read_comm,
+                    nreaders=args.nreaders,
                 )
                 f0_data_list.append(_out)
                 if args.hr:
@@ -2693,6 +2978,8 @@ def main():
                         iphi=args.iphi,
                         nextnode_arr=nextnode_arr,
                         rescale=args.rescaleinput,
+                        comm=read_comm,
+                        nreaders=args.nreaders,
                     )
                     hr_data_list.append(_out2)
             else:
@@ -2705,6 +2992,8 @@ def main():
                     randomread=args.randomread,
                     nchunk=num_channels,
                     fieldline=args.fieldline,
+                    comm=read_comm,
+                    nreaders=args.nreaders,
                 )
                 f0_data_list.append(_out)
                 if args.hr:
@@ -2718,9 +3007,15 @@ def main():
                         randomread=args.randomread,
                         nchunk=num_channels,
                         fieldline=args.fieldline,
+                        comm=read_comm,
+                        nreaders=args.nreaders,
                     )
                     hr_data_list.append(_out2)
 
+        if len(f0_data_list) == 0:
+            raise ValueError(
+                "Rank %d has no data to read (more ranks than inputs)" % rank
+            )
         lst = list(zip(*f0_data_list))
 
         Z0 = np.r_[(lst[0])]
@@ -2851,6 +3146,7 @@ def main():
 
         myloss = LpLoss(size_average=False)
         y_normalizer.to(device)
+        train_err_list = list()
         for ep in range(istart, istart + args.num_training_updates):
             model.train()
             t1 = default_timer()
@@ -2898,9 +3194,10 @@ def main():
 
             t2 = default_timer()
             log(ep, t2 - t1, train_err, test_err, abs_err)
+            train_err_list.append(train_err)
 
             if (ep % args.checkpoint_interval == 0) and (rank == 0):
-                save_checkpoint(DIR, prefix, model, train_err, ep)
+                save_checkpoint(checkpointer, model, train_err_list, ep)
 
                 out_list = list()
                 out1_list = list()
@@ -2952,6 +3249,7 @@ def main():
                     )
                     fw.write("zlb", zlb.copy(), shape, start, count)
 
+        checkpointer.close()
         return 0
     ## end of fno
 
@@ -2987,12 +3285,20 @@ def main():
         else:
             lh.append(0)
 
-    _lx = [x[0, :] for x in lx]
-    data_variance = np.var(_lx, dtype=np.float64)
-    log("data_variance", data_variance)
-    if args.hr:
-        _lh = [x[0, :] for x in lh]
-        hr_data_variance = np.var(_lh, dtype=np.float64)
+    hr_data_variance = None
+    extra = None if state is None else state["extra"]
+    if (extra is not None) and (extra.get("nsamples") == len(lx)):
+        ## Fast restart: reuse data statistics
+        data_variance = extra["data_variance"]
+        hr_data_variance = extra["hr_data_variance"]
+        log("data_variance (restart)", data_variance)
+    else:
+        _lx = [x[0, :] for x in lx]
+        data_variance = np.var(_lx, dtype=np.float64)
+        log("data_variance", data_variance)
+        if args.hr:
+            _lh = [x[0, :] for x in lh]
+            hr_data_variance = np.var(_lh, dtype=np.float64)
 
     # %%
     # Loadding
@@ -3000,15 +3306,18 @@ def main():
     # training_data = torch.utils.data.TensorDataset(torch.tensor(X_train), torch.tensor(y_train))
     # validation_data = torch.utils.data.TensorDataset(torch.tensor(X_test), torch.tensor(y_test))
     # (2020/11) Temporary. Use all data for training
+    ## The last tensor is the window index (for the error tracker)
     training_data = torch.utils.data.TensorDataset(
-        torch.tensor(lx), torch.tensor(ly), torch.tensor(lh)
+        torch.tensor(lx), torch.tensor(ly), torch.tensor(lh), torch.arange(len(lx))
     )
     validation_data = torch.utils.data.TensorDataset(
         torch.tensor(lx), torch.tensor(ly), torch.tensor(lh)
     )
 
+    ## Resampling changes only the sampler's indices
+    sampler = AdaptiveSampler(len(training_data))
     training_loader = DataLoader(
-        training_data, batch_size=batch_size, shuffle=True, pin_memory=True
+        training_data, batch_size=batch_size, sampler=sampler, pin_memory=True
     )
     validation_loader = DataLoader(
         validation_data, batch_size=batch_size, shuffle=True, pin_memory=True
@@ -3027,30 +3336,11 @@ def main():
     #                 commitment_cost, decay, rescale=args.rescale, learndiff=args.learndiff).to(device)
 
     def setup_da():
+        ## Distance and angle (or dr, dz) of each node plus --da_features, per sample
         fname2 = os.path.join(args.datadir, "xgc.mesh.bp")
-        with ad2.open(fname2, "r") as f:
-            rz = f.read("rz")
-
-        _rz = np.array(rz[:, 0], dtype=complex)
-        _rz.imag = rz[:, 1]
-
+        features = ("polar" if args.polar else "cartesian",) + tuple(args.da_features)
         global da
-        da = np.zeros(
-            (len(zlb), 2), dtype=np.float32
-        )  ## list of distance and angle pair
-        for i, inode in enumerate(zlb[:, 3]):
-            if args.polar:
-                ## Polar info
-                dist = np.linalg.norm(_rz[inode] - _rz[0])
-                angle = np.angle(_rz[inode] - _rz[0])
-            else:
-                ## Cartesian info
-                dist = rz[inode, 0] - rz[0, 0]
-                angle = rz[inode, 1] - rz[0, 1]
-            da[i, 0] = dist
-            da[i, 1] = angle
-        # da = (da - np.min(da, axis=0))/(np.max(da, axis=0) - np.min(da, axis=0))
-        # log ('Condition information (distance and angle) normalized:', np.min(da, axis=0), np.max(da, axis=0))
+        da = conditioning_features(fname2, zlb, features)
         da = torch.tensor(da, dtype=torch.float).to(device)
 
     _, nx, ny = Z0.shape
@@ -3080,6 +3370,7 @@ def main():
             conditional=args.conditional,
             decoder_padding=padding,
             da_conditional=da_conditional,
+            ncond=da.shape[1] if da_conditional else 2,
             decoder_layer_sizes=args.decoder_layer_sizes,
         ).to(device)
         # hook = Hook(model._decoder.MLP.R0.module[2])
@@ -3108,6 +3399,7 @@ def main():
             num_residual_hiddens,
             num_residual_layers,
             da_conditional=True,
+            ncond=da.shape[1],
         ).to(device)
 
     if args.model == "gan":
@@ -3156,6 +3448,7 @@ def main():
             encoder_layer_sizes=args.encoder_layer_sizes,
             decoder_layer_sizes=args.decoder_layer_sizes,
             da_conditional=True,
+            ncond=da.shape[1],
         ).to(device)
 
     if args.model == "ae-vqvae":
@@ -3184,15 +3477,30 @@ def main():
         model = Autoencoder().to(device)
 
     # %%
-    train_res_recon_error = []
-    train_res_perplexity = []
-    train_res_physics_error = []
+    metrics = MetricAccumulator(
+        ["loss", "vq_loss", "recon_error", "perplexity", "physics_error"],
+        interval=args.metric_interval,
+        device=device,
+        writer=writer,
+        tags={
+            "loss": "Loss/train",
+            "vq_loss": "VQLoss/train",
+            "recon_error": "Recon_error/train",
+            "perplexity": "Perplexity/train",
+        },
+    )
+    train_res_recon_error = metrics.history["recon_error"]
+    train_res_perplexity = metrics.history["perplexity"]
+    train_res_physics_error = metrics.history["physics_error"]
+    if state is not None:
+        for key, name in HISTORY_NAMES.items():
+            metrics.history[key].extend(state["history"].get(name, list()))
     istart = 1
 
     # Load checkpoint
     _istart, _model, _dmodel = 0, None, None
     if not args.overwrite:
-        _istart, _model, _dmodel = load_checkpoint(DIR, prefix, model)
+        _istart, _model, _dmodel = load_checkpoint(DIR, prefix, model, state=state)
 
     if _model is not None:
         istart = _istart + 1
@@ -3210,11 +3518,29 @@ def main():
             optimizer, step_size=args.stepsize, gamma=0.1
         )
         # scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'min', patience=1000)
+    if (_model is not None) and (state is not None):
+        if state["optimizer"] is not None:
+            optimizer.load_state_dict(state["optimizer"])
+        if state["scheduler"] is not None:
+            scheduler.load_state_dict(state["scheduler"])
+
+    ## Gradient averaging across ranks (no-op with --nompi or no --average_interval)
+    gradsync = GradientSync(
+        model,
+        comm
+        if (args.average_interval is not None) and (args.model in ("vqvae", "cvqvae"))
+        else None,
+    )
 
     dmodel = None
     if args.learndiff2:
         dim1, dim2 = Zif.shape[-2], Zif.shape[-1]
         dmodel = AE(input_shape=num_channels * dim1 * dim2).to(device)
+        if isinstance(_dmodel, dict):
+            dmodel.load_state_dict(_dmodel)
+        elif _dmodel is not None:
+            ## (legacy) pickled module
+            dmodel.load_state_dict(_dmodel.state_dict())
         doptimizer = optim.AdamW(dmodel.parameters(), lr=1e-3)
         dcriterion = nn.MSELoss()
 
@@ -3233,6 +3559,8 @@ def main():
         nworkers = len(os.sched_getaffinity(0)) - 1
     logging.info("Nworkers: %d" % nworkers)
 
+    scaler = get_grad_scaler(device, args.precision)
+
     counter = mp.Value("i", 0)
     executor = ProcessPoolExecutor(
         max_workers=nworkers, initializer=init, initargs=(counter,)
@@ -3246,17 +3574,46 @@ def main():
     logging.info(
         f"Rsampling, resampling interval: {args.resampling} {resampling_interval}"
     )
+    tracker = None
+    if args.resampling and (args.resampling_mode == "incremental"):
+        assert args.model in ("vqvae", "cvqvae", "ae", "cae")
+        tracker = ErrorTracker(len(lx), device=device)
     total_trained = np.ones(len(lx), dtype=np.int32)
+    resample_idx = None
+    resume = (_model is not None) and (extra is not None)
+    if resume and (extra.get("nsamples") == len(lx)):
+        total_trained = extra["total_trained"].numpy()
+        resample_idx = extra["resample_idx"]
+        if resample_idx is not None:
+            resample_idx = resample_idx.numpy()
+            sampler.set_indices(resample_idx)
+        if extra.get("scaler") is not None:
+            scaler.load_state_dict(extra["scaler"])
+        set_rng_state(extra["rng"])
+        log("Restored training state:", _istart)
     logging.info("Training: %d" % num_training_updates)
+    timer = PhaseTimer(window=args.log_interval, sync=args.timing_sync, writer=writer)
+    if args.model in ("vqvae", "cvqvae"):
+        timer.attach(model._vq_vae, "quantizer")
+    trace = None
+    if args.profile_steps is not None:
+        fname = "%s/%s/trace-%d-%d.json" % (DIR, prefix, *args.profile_steps)
+        trace = TraceWindow(*args.profile_steps, fname)
     model.train()
     ns = 0.0
     for i in xrange(istart, istart + num_training_updates):
+        if trace is not None:
+            trace.step(i)
         t0 = time.time()
-        (data, lb, hr_data) = next(iter(training_loader))
+        with timer.phase("data"):
+            (data, lb, hr_data, widx) = next(iter(training_loader))
         # print ("Training:", lb)
+        timer.start("h2d")
         data = data.to(device)
         if args.hr:
             hr_data = hr_data.to(device)
+        timer.stop("h2d")
+        if args.hr:
             hr_data_variance = hr_data_variance
         else:
             hr_data = data
@@ -3266,6 +3623,9 @@ def main():
             ns = torch.normal(mean=0.0, std=data.detach() * args.noise)
 
         optimizer.zero_grad()  # clear previous gradients
+        gradsync.enabled = (args.average_interval is not None) and (
+            i % args.average_interval == 0
+        )
 
         if args.model in ("vqvae", "cvqvae"):
             _da = None
@@ -3274,7 +3634,12 @@ def main():
                     lb[:, 0, 0],
                 ]
 
-            vq_loss, data_recon, perplexity, dloss = model(data + ns, _da)
+            with timer.phase("forward"), timer.hooks():
+                with get_autocast(device, args.precision):
+                    vq_loss, data_recon, perplexity, dloss = model(data + ns, _da)
+            data_recon = data_recon.float()
+            if tracker is not None:
+                tracker.update(widx, window_error(data_recon, hr_data), i)
             ## mean squared error: torch.mean((data_recon - data)**2)
             ## relative variance
             # import pdb; pdb.set_trace()
@@ -3282,9 +3647,10 @@ def main():
             physics_error = torch.tensor(0.0).to(data_recon.device)
             if args.physicsloss and (i % args.physicsloss_interval == 0):
                 # den_err, u_para_err, T_perp_err, T_para_err = physics_loss_con(data, lb, data_recon, executor=executor)
-                den_err, u_para_err, T_perp_err, T_para_err = physics_loss(
-                    hr_data, lb, data_recon
-                )
+                with timer.phase("physics"):
+                    den_err, u_para_err, T_perp_err, T_para_err = physics_loss(
+                        hr_data, lb, data_recon
+                    )
                 # ds = torch.mean(data_recon.cpu().data.numpy()**2)
                 if i % args.log_interval == 0:
                     print("Physics loss:", den_err, u_para_err, T_perp_err, T_para_err)
@@ -3304,15 +3670,19 @@ def main():
                 + delta * dloss
                 + zeta * feature_loss
             )
-            loss.backward()
+            with timer.phase("backward"):
+                scaler.scale(loss).backward()
             # hook_list.append(hook.output.detach().numpy())
             # print('---'*17)
 
-            if (args.average_interval is not None) and (i % args.average_interval == 0):
+            if gradsync.enabled:
                 ## Gradient averaging
                 logging.info("iteration %d: gradient averaging" % (i))
-                average_gradients(model)
-            optimizer.step()
+                with timer.phase("gradsync"):
+                    gradsync.synchronize()
+            with timer.phase("optimizer"):
+                scaler.step(optimizer)
+                scaler.update()
 
         if args.model in ("vae", "cvae"):
             _da = None
@@ -3320,7 +3690,8 @@ def main():
                 _da = da[
                     lb[:, 0, 0],
                 ]
-            recon_batch, mu, logvar = model(data, _da)
+            with timer.phase("forward"):
+                recon_batch, mu, logvar = model(data, _da)
 
             loss = model.loss_function(recon_batch, hr_data, mu, logvar)
             recon_error = (
@@ -3329,8 +3700,10 @@ def main():
             vq_loss = torch.tensor(0)
             perplexity = torch.tensor(0)
             physics_error = torch.tensor(0.0)
-            loss.backward()
-            optimizer.step()
+            with timer.phase("backward"):
+                loss.backward()
+            with timer.phase("optimizer"):
+                optimizer.step()
 
         if args.model == "gan":
             valid = torch.ones(args.batch_size, 1, requires_grad=False).to(device)
@@ -3338,28 +3711,34 @@ def main():
             # z = torch.tensor(np.random.normal(0, 1, data.shape)).to(device)
 
             # vq_loss, data_recon, perplexity, dloss = model(data+ns)
-            vq_loss, data_recon, perplexity, dloss = model(data + ns)
+            with timer.phase("forward"):
+                vq_loss, data_recon, perplexity, dloss = model(data + ns)
+                dout = discriminator(data_recon)
             recon_error = F.mse_loss(data_recon, hr_data) / hr_data_variance
             physics_error = torch.tensor(0.0).to(data_recon.device)
 
-            dout = discriminator(data_recon)
             g_loss = adversarial_loss(dout, valid)
 
             loss = recon_error + vq_loss + physics_error + dloss + g_loss
 
-            loss.backward()
-            optimizer.step()
+            with timer.phase("backward"):
+                loss.backward()
+            with timer.phase("optimizer"):
+                optimizer.step()
 
             #  Train Discriminator
             optimizer_D.zero_grad()
-            real_dout = discriminator(hr_data)
-            fake_dout = discriminator(data_recon.detach())
+            with timer.phase("forward_D"):
+                real_dout = discriminator(hr_data)
+                fake_dout = discriminator(data_recon.detach())
             real_loss = adversarial_loss(real_dout, valid)
             fake_loss = adversarial_loss(fake_dout, fake)
             d_loss = (real_loss + fake_loss) / 2
 
-            d_loss.backward()
-            optimizer_D.step()
+            with timer.phase("backward_D"):
+                d_loss.backward()
+            with timer.phase("optimizer_D"):
+                optimizer_D.step()
 
         if args.model in ("ae", "cae"):
             _da = None
@@ -3367,7 +3746,10 @@ def main():
                 _da = da[
                     lb[:, 0, 0],
                 ]
-            recon_batch = model(data, _da)
+            with timer.phase("forward"):
+                recon_batch = model(data, _da)
+            if tracker is not None:
+                tracker.update(widx, window_error(recon_batch, hr_data), i)
 
             recon_error = F.mse_loss(recon_batch, hr_data) / hr_data_variance
             # l1loss = nn.L1Loss()
@@ -3376,21 +3758,27 @@ def main():
             perplexity = torch.tensor(0)
             physics_error = torch.tensor(0.0)
             loss = recon_error
-            loss.backward()
-            optimizer.step()
+            with timer.phase("backward"):
+                loss.backward()
+            with timer.phase("optimizer"):
+                optimizer.step()
 
         if args.model == "ae2d":
-            recon_batch = model(data)
+            with timer.phase("forward"):
+                recon_batch = model(data)
             recon_error = F.mse_loss(recon_batch, hr_data) / hr_data_variance
             vq_loss = torch.tensor(0)
             perplexity = torch.tensor(0)
             physics_error = torch.tensor(0.0)
             loss = recon_error
-            loss.backward()
-            optimizer.step()
+            with timer.phase("backward"):
+                loss.backward()
+            with timer.phase("optimizer"):
+                optimizer.step()
 
         if args.model == "ae-vqvae":
-            recon_batch = model(data + ns)
+            with timer.phase("forward"):
+                recon_batch = model(data + ns)
             recon_error = F.mse_loss(recon_batch, hr_data.detach()) / hr_data_variance
             # l1loss = nn.L1Loss()
             # recon_error = l1loss(recon_batch, data)
@@ -3398,11 +3786,14 @@ def main():
             perplexity = torch.tensor(0)
             physics_error = torch.tensor(0.0)
             loss = recon_error
-            loss.backward()
-            optimizer.step()
+            with timer.phase("backward"):
+                loss.backward()
+            with timer.phase("optimizer"):
+                optimizer.step()
 
             optimizer2.zero_grad()
-            vq_loss, data_recon, perplexity, dloss = model2(recon_batch.detach())
+            with timer.phase("forward2"):
+                vq_loss, data_recon, perplexity, dloss = model2(recon_batch.detach())
             recon2_error = F.mse_loss(data_recon, hr_data.detach()) / hr_data_variance
             physics2_error = torch.tensor(0.0).to(data_recon.device)
             feature_loss = torch.tensor(0.0).to(data_recon.device)
@@ -3413,53 +3804,73 @@ def main():
                 + delta * dloss
                 + zeta * feature_loss
             )
-            loss2.backward()
-            optimizer2.step()
-
-        writer.add_scalar("Loss/train", loss, i)
-        writer.add_scalar("VQLoss/train", vq_loss, i)
-        writer.add_scalar("Recon_error/train", recon_error, i)
-        writer.add_scalar("Perplexity/train", perplexity, i)
-        train_res_recon_error.append(recon_error.item())
-        train_res_perplexity.append(perplexity.item())
-        train_res_physics_error.append(physics_error.item())
+            with timer.phase("backward2"):
+                loss2.backward()
+            with timer.phase("optimizer2"):
+                optimizer2.step()
+
+        metrics.update(
+            i,
+            loss=loss,
+            vq_loss=vq_loss,
+            recon_error=recon_error,
+            perplexity=perplexity,
+            physics_error=physics_error,
+        )
         scheduler.step()
 
         if args.resampling and (i % resampling_interval == 0):
             t1 = time.time()
-            err_list, _ = estimate_error(
-                model,
-                Xif,
-                Zif,
-                zmin,
-                zmax,
-                zlb,
-                num_channels,
-                modelname=args.model,
-                conditional=args.conditional,
-            )
-            err = np.array(
-                [
-                    max(err_list[i : i + num_channels])
-                    for i in xrange(0, len(err_list), num_channels)
-                ]
-            )
-            idx = np.random.choice(range(len(lx)), len(lx), p=err / sum(err))
-            lxx = [lx[i] for i in idx]
-            lyy = [ly[i] for i in idx]
-            lhh = [lh[i] for i in idx]
-
-            training_data = torch.utils.data.TensorDataset(
-                torch.tensor(lxx), torch.tensor(lyy), torch.tensor(lhh)
-            )
-            training_loader = DataLoader(
-                training_data, batch_size=batch_size, shuffle=True, pin_memory=True
-            )
+            timer.start("eval")
+            if tracker is not None:
+                ## Refresh the stalest windows with a probe batch: O(batch), not O(dataset)
+                probe = tracker.stale(args.probe_size).cpu()
+                px, plb, ph, _ = training_data[probe]
+                px = px.to(device)
+                ph = ph.to(device) if args.hr else px
+                _da = None
+                if args.model in ("cvqvae", "cae"):
+                    _da = da[
+                        plb[:, 0, 0],
+                    ]
+                model.eval()
+                with torch.no_grad():
+                    with get_autocast(device, args.precision):
+                        if args.model in ("vqvae", "cvqvae"):
+                            _, precon, _, _ = model(px, _da)
+                        else:
+                            precon = model(px, _da)
+                model.train()
+                tracker.update(probe, window_error(precon, ph), i)
+                err = tracker.weights()
+            else:
+                err_list, _ = estimate_error(
+                    model,
+                    Xif,
+                    Zif,
+                    zmin,
+                    zmax,
+                    zlb,
+                    num_channels,
+                    modelname=args.model,
+                    conditional=args.conditional,
+                )
+                err = np.array(
+                    [
+                        max(err_list[i : i + num_channels])
+                        for i in xrange(0, len(err_list), num_channels)
+                    ]
+                )
+            idx = sampler.update(err)
             total_trained[idx] += 1
+            resample_idx = idx
+            timer.stop("eval")
             logging.info(f"{i} Resampling time: {time.time()-t1:.3f}")
 
         if i % args.log_interval == 0:
+            metrics.flush()
             logging.info(f"{i} time: {time.time()-t0:.3f}")
+            timer.log(i)
             logging.info(
                 f"{i} Avg: {np.mean(train_res_recon_error[-args.log_interval:]):g} {np.mean(train_res_perplexity[-args.log_interval:]):g} {np.mean(train_res_physics_error[-args.log_interval:]):g}"
             )
@@ -3483,18 +3894,19 @@ def main():
             fname = None
             if (i % args.checkpoint_interval == 0) and (rank == 0):
                 fname = "%s/%s/img-%d.jpg" % (DIR, prefix, i)
-            rmse_list, abserr_list = estimate_error(
-                model,
-                Xif,
-                Zif,
-                zmin,
-                zmax,
-                zlb,
-                num_channels,
-                modelname=args.model,
-                fname=fname,
-                conditional=args.conditional,
-            )
+            with timer.phase("eval"):
+                rmse_list, abserr_list = estimate_error(
+                    model,
+                    Xif,
+                    Zif,
+                    zmin,
+                    zmax,
+                    zlb,
+                    num_channels,
+                    modelname=args.model,
+                    fname=fname,
+                    conditional=args.conditional,
+                )
             logging.info(
                 f'{i} Error: {np.max(rmse_list):g} {np.max(abserr_list):g} Next LR: {optimizer.param_groups[0]["lr"]:g}'
             )
@@ -3509,8 +3921,41 @@ def main():
                 writer.add_image("recon_data", img_grid, i)
 
         if (i % args.checkpoint_interval == 0) and (rank == 0):
-            save_checkpoint(DIR, prefix, model, train_res_recon_error, i, dmodel=dmodel)
+            metrics.flush()
+            timer.start("checkpoint")
+            save_checkpoint(
+                checkpointer,
+                model,
+                train_res_recon_error,
+                i,
+                dmodel=dmodel,
+                optimizer=optimizer,
+                scheduler=scheduler,
+                history={
+                    name: metrics.history[key]
+                    for key, name in HISTORY_NAMES.items()
+                    if name != "err"
+                },
+                extra=dict(
+                    nsamples=len(lx),
+                    data_variance=float(data_variance),
+                    hr_data_variance=None
+                    if hr_data_variance is None
+                    else float(hr_data_variance),
+                    total_trained=torch.from_numpy(total_trained.copy()),
+                    resample_idx=None
+                    if resample_idx is None
+                    else torch.from_numpy(np.asarray(resample_idx)),
+                    scaler=scaler.state_dict(),
+                    rng=get_rng_state(),
+                ),
+            )
+            timer.stop("checkpoint")
             writer.flush()
+    metrics.flush()
+    checkpointer.close()
+    if trace is not None:
+        trace.close()
     istart = istart + num_training_updates
 
     # %%
@@ -3728,9 +4173,3 @@ if __name__ == "__main__":
         os.sched_setaffinity(0, _affinity)
 
     main()
-    # with profiler.profile() as prof:
-    # from pytracing import TraceProfiler
-    # tp = TraceProfiler(output=open('trace.out', 'wb'))
-    # with tp.traced():
-    #     main()
-    # prof.export_chrome_trace("trace.json")
@@ -1 +1,4 @@
 from .dataset import XGC_F0_Dataset
+from .sampler import AdaptiveSampler
+from .mesh import MeshTopology, load_mesh, digitizing, nearest_index_map
+from .cond import node_features, conditioning_features
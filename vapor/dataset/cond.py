@@ -0,0 +1,75 @@
+import os
+import functools
+import numpy as np
+
+from .mesh import load_mesh
+
+## Per-node conditioning features. polar/cartesian are two columns each (distance
+## and angle to the magnetic axis, or dr and dz) and only need rz; psi, theta and
+## surf are one column each and need the mesh topology.
+FEATURES = ("polar", "cartesian", "psi", "theta", "surf")
+GEOMETRY = ("polar", "cartesian")
+
+
+@functools.lru_cache(maxsize=8)
+def _load_rz(fname, mtime):
+    import adios2 as ad2
+
+    with ad2.open(fname, "r") as f:
+        return f.read("rz")
+
+
+def _geometry(rz, name):
+    dr = rz[:, 0] - rz[0, 0]
+    dz = rz[:, 1] - rz[0, 1]
+    if name == "polar":
+        return [np.hypot(dr, dz), np.arctan2(dz, dr)]
+    if name == "cartesian":
+        return [dr, dz]
+    raise NotImplementedError(name)
+
+
+def _feature(mesh, name):
+    if name == "psi":
+        if mesh.psi is not None:
+            return [np.nan_to_num(mesh.psi)]
+        if mesh.psi_surf is None:
+            raise ValueError(
+                "da feature 'psi' needs mesh variable 'psi' or 'psi_surf' in %s"
+                % mesh.fname
+            )
+        return [np.nan_to_num(mesh.surf_psi)]
+    if name == "theta":
+        if mesh.theta is None:
+            raise ValueError(
+                "da feature 'theta' needs mesh variable 'theta' in %s" % mesh.fname
+            )
+        ## -10: nodes without theta (e.g., outside the separatrix)
+        return [np.where(mesh.theta == -10, 0.0, mesh.theta)]
+    if name == "surf":
+        ## Surface id scaled to (0, 1]; 0 for nodes not on a surface
+        return [(mesh.surf_id + 1) / mesh.nsurf]
+    raise NotImplementedError(name)
+
+
+@functools.lru_cache(maxsize=8)
+def _node_features(fname, mtime, features):
+    cols = list()
+    for name in features:
+        if name in GEOMETRY:
+            cols.extend(_geometry(_load_rz(fname, mtime), name))
+        else:
+            cols.extend(_feature(load_mesh(fname), name))
+    return np.stack(cols, axis=1).astype(np.float32)
+
+
+def node_features(fname, features=("polar",)):
+    """(nnodes, ncond) conditioning features of all nodes of a mesh, cached per file"""
+    fname = os.path.realpath(fname)
+    mtime = os.stat(fname).st_mtime_ns if os.path.exists(fname) else None
+    return _node_features(fname, mtime, tuple(features))
+
+
+def conditioning_features(fname, zlb, features=("polar",)):
+    """Conditioning features of each sample: node_features gathered by zlb[:, 3]"""
+    return node_features(fname, features)[zlb[:, 3]]
@@ -0,0 +1,123 @@
+import os
+import functools
+import numpy as np
+
+
+def digitizing(x, nbins):
+    """
+    idx ranges from 1 ... nbins
+    nan is 0
+    """
+    assert nbins > 1
+    _x = x[~np.isnan(x)]
+    _, bins = np.histogram(_x, bins=nbins)
+    idx = np.digitize(x, bins, right=True)
+    idx = np.where(idx == 0, 1, idx)
+    idx = np.where(idx == nbins + 1, 0, idx)
+    return (idx, bins)
+
+
+def nearest_index_map(shape, size):
+    """
+    Row and column indices of the nearest-neighbor upsample of shape to size, as
+    done by skimage resize(order=0): X[rows[:, None], cols[None, :]]
+    """
+    from skimage.transform import resize
+
+    nx, ny = shape
+    rows = np.broadcast_to(np.arange(nx, dtype=np.float64)[:, np.newaxis], shape)
+    cols = np.broadcast_to(np.arange(ny, dtype=np.float64)[np.newaxis, :], shape)
+    kw = dict(order=0, anti_aliasing=False, preserve_range=True)
+    rows = resize(rows, size, **kw)[:, 0].astype(np.int64)
+    cols = resize(cols, size, **kw)[0, :].astype(np.int64)
+    return (rows, cols)
+
+
+class MeshTopology:
+    """
+    Node-to-flux-surface topology of an XGC mesh (xgc.mesh.bp), per node and vectorized.
+
+    surf_id: surface of each node (-1 if not on a surface)
+    surf_pos: position of the node along its surface (-1 if not on a surface)
+    surf_psi: psi_surf of the node's surface (nan if not on a surface)
+    inboard/outboard: r < r[0] / r > r[0] (node 0 is the magnetic axis)
+    members_node, members_surf: all (node, surface) pairs of surf_idx in surface
+    order, for per-surface reductions (e.g., np.maximum.at)
+    """
+
+    def __init__(self, fname):
+        import adios2 as ad2
+
+        self.fname = fname
+        with ad2.open(fname, "r") as f:
+            varlist = f.available_variables()
+            self.nnodes = int(
+                f.read(
+                    "n_n",
+                )
+            )
+            rz = f.read("rz")
+            self.conn = f.read("nd_connect_list")
+            self.nextnode = f.read("nextnode")
+            surf_idx = f.read("surf_idx")
+            surf_len = f.read("surf_len")
+            self.psi = f.read("psi") if "psi" in varlist else None
+            self.psi_surf = f.read("psi_surf") if "psi_surf" in varlist else None
+            self.theta = f.read("theta") if "theta" in varlist else None
+
+        self.r = rz[:, 0]
+        self.z = rz[:, 1]
+        self.nsurf = len(surf_len)
+
+        ## (nsurf, maxlen) mask of the valid entries of surf_idx (1-based)
+        pos = np.arange(surf_idx.shape[1])
+        valid = pos[np.newaxis, :] < surf_len[:, np.newaxis]
+        self.members_node = (surf_idx[valid] - 1).astype(np.int64)
+        self.members_surf = np.nonzero(valid)[0]
+        members_pos = np.broadcast_to(pos, surf_idx.shape)[valid]
+
+        self.surf_id = np.full(self.nnodes, -1, dtype=np.int64)
+        self.surf_id[self.members_node] = self.members_surf
+        self.surf_pos = np.full(self.nnodes, -1, dtype=np.int64)
+        self.surf_pos[self.members_node] = members_pos
+        self.in_surf = self.surf_id >= 0
+        self.not_in_surf = np.flatnonzero(~self.in_surf)
+
+        self.surf_psi = np.full(self.nnodes, np.nan)
+        if self.psi_surf is not None:
+            self.surf_psi[self.in_surf] = self.psi_surf[self.surf_id[self.in_surf]]
+
+        self.inboard = self.r < self.r[0]
+        self.outboard = self.r > self.r[0]
+        self._bins = dict()
+
+    def theta_bin(self, nbins=32):
+        """Theta bin of each node, 1 ... nbins (0 for nodes without theta)"""
+        if ("theta", nbins) not in self._bins:
+            x = np.where(self.theta == -10, np.nan, self.theta)
+            self._bins[("theta", nbins)] = digitizing(x, nbins)
+        return self._bins[("theta", nbins)][0]
+
+    def psi_bin(self, nbins=32):
+        """Bin of surf_psi of each node, 1 ... nbins (0 if not on a surface)"""
+        if ("psi", nbins) not in self._bins:
+            self._bins[("psi", nbins)] = digitizing(self.surf_psi, nbins)
+        return self._bins[("psi", nbins)][0]
+
+    def surf_reduce(self, values, ufunc=np.maximum, initial=-np.inf):
+        """Reduce per-node values over the nodes of each surface -> (nsurf,)"""
+        out = np.full(self.nsurf, initial, dtype=np.float64)
+        ufunc.at(out, self.members_surf, values[self.members_node])
+        return out
+
+
+@functools.lru_cache(maxsize=8)
+def _load_mesh(fname, mtime):
+    return MeshTopology(fname)
+
+
+def load_mesh(fname):
+    """MeshTopology of fname, cached per file (re-read if the file changes)"""
+    fname = os.path.realpath(fname)
+    mtime = os.stat(fname).st_mtime_ns if os.path.exists(fname) else None
+    return _load_mesh(fname, mtime)
@@ -0,0 +1,130 @@
+import numpy as np
+import adios2 as ad2
+
+from vapor.util.logging import log0
+
+
+def node_blocks(nnodes, nparts):
+    """Return the (n0, n1) bounds of nparts contiguous, balanced node blocks"""
+    bounds = np.linspace(0, nnodes, nparts + 1).astype(np.int64)
+    return [(int(bounds[i]), int(bounds[i + 1])) for i in range(nparts)]
+
+
+def read_f0_parallel(
+    fname, comm, varname="i_f", iphi=None, inode=0, nnodes=None, nreaders=None
+):
+    """
+    Read XGC f0 (nphi, nmu, nnodes, nvp) cooperatively with an MPI-enabled ADIOS2 open.
+
+    The node range [inode, inode+nnodes) is split into contiguous blocks and each of the
+    first nreaders ranks (default: all) reads only its own block; the others get an
+    empty block. Returns (block, n0, n1) with node indices relative to inode.
+    """
+    from mpi4py import MPI
+
+    size, rank = comm.Get_size(), comm.Get_rank()
+    nreaders = size if nreaders is None else min(nreaders, size)
+
+    nsize, dtype = None, None
+    rcomm = comm.Split(0 if rank < nreaders else MPI.UNDEFINED, rank)
+    if rcomm != MPI.COMM_NULL:
+        with ad2.open(fname, "r", rcomm) as f:
+            var = f.available_variables()[varname]
+            nsize = tuple([int(x.strip(",")) for x in var["Shape"].strip().split()])
+            nphi = nsize[0] if iphi is None else 1
+            _iphi = 0 if iphi is None else iphi
+            _nnodes = nsize[2] - inode if nnodes is None else nnodes
+            n0, n1 = node_blocks(_nnodes, nreaders)[rank]
+            start = (_iphi, 0, inode + n0, 0)
+            count = (nphi, nsize[1], n1 - n0, nsize[3])
+            log0(f"Reading (parallel, {nreaders} readers): {fname} {start} {count}")
+            block = f.read(varname, start=start, count=count)
+            dtype = block.dtype.str
+        rcomm.Free()
+
+    nsize, dtype = comm.bcast((nsize, dtype), root=0)
+    if rank >= nreaders:
+        nphi = nsize[0] if iphi is None else 1
+        _nnodes = nsize[2] - inode if nnodes is None else nnodes
+        n0 = n1 = _nnodes
+        block = np.zeros((nphi, nsize[1], 0, nsize[3]), dtype=np.dtype(dtype))
+
+    return (block, n0, n1)
+
+
+def node_datatype(block):
+    """
+    MPI datatype of one node (nphi*nmu*nvp values) of a (nphi, nmu, nnodes, nvp) block,
+    so that collective counts and displacements are in nodes rather than elements
+    (which overflow the int32 counts of MPI for large restarts). Free it after use.
+    """
+    from mpi4py.util.dtlib import from_numpy_dtype
+
+    nphi, nmu, _, nvp = block.shape
+    return from_numpy_dtype(block.dtype).Create_contiguous(nphi * nmu * nvp).Commit()
+
+
+def balanced_owner(nnodes, size):
+    """Rank owning each node when nnodes are split into size contiguous blocks"""
+    counts = [n1 - n0 for (n0, n1) in node_blocks(nnodes, size)]
+    return np.repeat(np.arange(size), counts)
+
+
+def allgather_nodes(block, n0, n1, comm):
+    """Assemble the node blocks of all ranks into the full array on every rank"""
+    nphi, nmu, nloc, nvp = block.shape
+    bounds = comm.allgather((n0, n1))
+    counts = [b - a for (a, b) in bounds]
+    displs = [a for (a, _) in bounds]
+    nnodes = max([b for (_, b) in bounds])
+
+    ## Nodes first so that each rank's block is contiguous
+    sendbuf = np.ascontiguousarray(np.moveaxis(block, 2, 0))
+    recvbuf = np.empty((nnodes, nphi, nmu, nvp), dtype=block.dtype)
+    ntype = node_datatype(block)
+    comm.Allgatherv([sendbuf, nloc, ntype], [recvbuf, counts, displs, ntype])
+    ntype.Free()
+    return np.moveaxis(recvbuf, 0, 2)
+
+
+def redistribute_nodes(block, n0, dest, comm):
+    """
+    Send each node of the local block [n0, n0+nloc) to the rank dest[node] with Alltoallv.
+    dest is a rank per node (relative to inode, same on all ranks); nodes with a negative
+    dest are dropped. Returns (block, nodes) with the received nodes in increasing order.
+    """
+    size = comm.Get_size()
+    nphi, nmu, nloc, nvp = block.shape
+    nodes = np.arange(n0, n0 + nloc, dtype=np.int64)
+    owner = np.asarray(dest)[nodes]
+    od = np.argsort(owner, kind="stable")
+    od = od[owner[od] >= 0]
+
+    sendbuf = np.ascontiguousarray(np.moveaxis(block, 2, 0)[od])
+    sendnodes = nodes[od]
+    scount = np.bincount(owner[od], minlength=size).astype(np.int64)
+    rcount = np.empty(size, dtype=np.int64)
+    comm.Alltoall(scount, rcount)
+    sdispl = np.concatenate([[0], np.cumsum(scount)[:-1]])
+    rdispl = np.concatenate([[0], np.cumsum(rcount)[:-1]])
+
+    recvnodes = np.empty(rcount.sum(), dtype=np.int64)
+    comm.Alltoallv([sendnodes, (scount, sdispl)], [recvnodes, (rcount, rdispl)])
+    recvbuf = np.empty((rcount.sum(), nphi, nmu, nvp), dtype=block.dtype)
+    ntype = node_datatype(block)
+    comm.Alltoallv([sendbuf, scount, sdispl, ntype], [recvbuf, rcount, rdispl, ntype])
+    ntype.Free()
+
+    od = np.argsort(recvnodes, kind="stable")
+    return (np.moveaxis(recvbuf[od], 0, 2), recvnodes[od])
+
+
+def balance_nodes(block, n0, n1, comm):
+    """
+    Redistribute the blocks of read_f0_parallel (the first nreaders ranks hold data) so
+    that every rank keeps one balanced contiguous node block. Returns (block, nodes).
+    """
+    from mpi4py import MPI
+
+    nnodes = comm.allreduce(n1, op=MPI.MAX)
+    return redistribute_nodes(block, n0, balanced_owner(nnodes, comm.Get_size()), comm)
@@ -0,0 +1,36 @@
+import numpy as np
+import torch
+
+
+class AdaptiveSampler(torch.utils.data.Sampler):
+    """
+    Sampler over a fixed dataset whose distribution can be changed during training.
+
+    update(weights) draws len(dataset) indices with replacement with probability
+    proportional to weights (e.g., per-window reconstruction error); each iteration
+    yields a new permutation of the drawn indices. Only the index array changes, the
+    dataset and DataLoader are kept. Without weights it is a plain random permutation.
+    """
+
+    def __init__(self, num_samples):
+        self.num_samples = num_samples
+        self.indices = None
+
+    def update(self, weights):
+        """Draw new indices from weights (numpy global RNG) and return them"""
+        p = np.asarray(weights, dtype=np.float64)
+        p = p / p.sum()
+        self.indices = np.random.choice(self.num_samples, self.num_samples, p=p)
+        return self.indices
+
+    def set_indices(self, indices):
+        self.indices = None if indices is None else np.asarray(indices)
+
+    def __iter__(self):
+        od = torch.randperm(self.num_samples).numpy()
+        if self.indices is not None:
+            od = self.indices[od]
+        return iter(od.tolist())
+
+    def __len__(self):
+        return self.num_samples
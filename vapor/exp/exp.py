@@ -1,6 +1,8 @@
 from ..util import *
 from ..model import *
 
+import contextlib
+
 import torch
 from torch.nn.parallel import DistributedDataParallel as DDP
 import torch.optim as optim
@@ -95,11 +97,28 @@ class Exp:
         self.optimizer = create_opimizer(self.model, config)
         self.scheduler = create_scheduler(self.optimizer, config)
 
+        self.precision = dget(config, "precision", "fp32")
+        self.scaler = get_grad_scaler(device, self.precision)
+        self.accumulation_steps = dget(config, "accumulation_steps", 1)
+
         self.train_loader = None
         self.validation_loader = None
         self.test_loader = None
         self.loss_fn = None
         self.device = device
+        self.timing = None
+
+    def micro_batch(self, i, m):
+        """
+        Return (sync, scale) for micro-batch i of m.
+        Gradients are allreduced and applied only on the last micro-batch of each
+        group of accumulation_steps; the loss is scaled by 1/(group size).
+        """
+        n = self.accumulation_steps
+        start = i - i % n
+        size = min(n, m - start)
+        sync = (i + 1 == start + size)
+        return sync, 1.0 / size
 
     def train(self, k):
         self.model.train()
@@ -108,22 +127,31 @@ class Exp:
             self.train_loader.sampler.set_epoch(k)
 
         m = len(self.train_loader)
-        loss_list = list()
-        for i, sample in enumerate(self.train_loader):
-            lr = sample["lr"].to(self.device)
-            hr = sample["hr"].to(self.device)
-            lb = sample["lb"].to(self.device)
+        metrics = MetricAccumulator(["loss"], interval=m, device=self.device)
+        self.optimizer.zero_grad()
+        loader = Prefetcher(self.train_loader, self.device, keys=("lr", "hr"))
+        for i, sample in enumerate(loader):
+            lr = sample["lr"]
+            hr = sample["hr"]
 
-            self.optimizer.zero_grad()
+            sync, scale = self.micro_batch(i, m)
+            with contextlib.nullcontext() if sync else self.model.no_sync():
+                with get_autocast(self.device, self.precision):
+                    recon = self.model(lr)
+                recon = recon.float()
+                loss = self.loss_fn(recon, hr)
+                self.scaler.scale(loss * scale).backward()
 
-            recon = self.model(lr)
-            loss = self.loss_fn(recon, hr)
-            loss.backward()
-            self.optimizer.step()
+            if sync:
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+                self.optimizer.zero_grad()
 
-            loss_list.append(loss.item())
+            metrics.update(i, loss=loss)
 
-        return loss_list, lr, hr, recon
+        metrics.flush()
+        self.timing = loader.timing()
+        return metrics.history["loss"], lr, hr, recon
 
 
 class Exp2(Exp):
@@ -146,23 +174,35 @@ class Exp2(Exp):
             self.train_loader.sampler.set_epoch(k)
 
         m = len(self.train_loader)
-        loss_list = list()
-        for i, sample in enumerate(self.train_loader):
-            lr = sample["lr"].to(self.device)
-            hr = sample["hr"].to(self.device)
-            lb = sample["lb"].to(self.device)
-
-            self.optimizer.zero_grad()
-
-            vq_loss, recon, perplexity = self.model(lr)
-            recon_error = self.loss_fn(recon, hr) / self.data_variance
-            loss = recon_error + vq_loss
-            loss.backward()
-            self.optimizer.step()
-
-            loss_list.append(loss.item())
-
-            if (k + 1) % 10 == 0:
-                log("recon_errror,vq_loss", recon_error.item(), vq_loss.item())
-
-        return loss_list, lr, hr, recon
+        metrics = MetricAccumulator(
+            ["loss", "recon_error", "vq_loss"], interval=m, device=self.device
+        )
+        self.optimizer.zero_grad()
+        loader = Prefetcher(self.train_loader, self.device, keys=("lr", "hr"))
+        for i, sample in enumerate(loader):
+            lr = sample["lr"]
+            hr = sample["hr"]
+
+            sync, scale = self.micro_batch(i, m)
+            with contextlib.nullcontext() if sync else self.model.no_sync():
+                with get_autocast(self.device, self.precision):
+                    vq_loss, recon, perplexity = self.model(lr)
+                recon = recon.float()
+                recon_error = self.loss_fn(recon, hr) / self.data_variance
+                loss = recon_error + vq_loss
+                self.scaler.scale(loss * scale).backward()
+
+            if sync:
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+                self.optimizer.zero_grad()
+
+            metrics.update(i, loss=loss, recon_error=recon_error, vq_loss=vq_loss)
+
+        metrics.flush()
+        if (k + 1) % 10 == 0:
+            avg = metrics.mean()
+            log("recon_errror,vq_loss", avg["recon_error"], avg["vq_loss"])
+
+        self.timing = loader.timing()
+        return metrics.history["loss"], lr, hr, recon
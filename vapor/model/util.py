@@ -1,34 +1,102 @@
 import os
 import torch
+import torch.distributed as dist
 from collections import OrderedDict
 
 
-def save_model(model, optimizer, prefix, filename):
-    """Save both model and optimizer state in a single checkpoint file"""
-    path_name = os.path.join(prefix, filename + ".pt")
-    torch.save(
-        {
-            "model_state_dict": model.state_dict(),
-            "optimizer_state_dict": optimizer.state_dict(),
-        },
-        path_name,
-    )
+def _rank_size():
+    if dist.is_available() and dist.is_initialized():
+        return (dist.get_rank(), dist.get_world_size())
+    return (0, 1)
+
+
+def _load(path_name):
+    """Memory-mapped, lazy torch.load on CPU (falls back to a regular load)"""
+    try:
+        return torch.load(path_name, map_location="cpu", mmap=True)
+    except (TypeError, RuntimeError):
+        ## Older torch without mmap or a legacy (non-zip) file
+        return torch.load(path_name, map_location="cpu")
+
+
+def _match_prefix(model, state_dict):
+    """Return state_dict with or without a "module." prefix to match model"""
+    has_prefix = next(iter(model.state_dict())).startswith("module.")
+    sd_prefix = next(iter(state_dict)).startswith("module.")
+    if has_prefix and not sd_prefix:
+        ## To be compatible with old checkpoint which was not written as a ddp model
+        return OrderedDict(("module." + k, v) for k, v in state_dict.items())
+    if sd_prefix and not has_prefix:
+        n = len("module.")
+        return OrderedDict((k[n:], v) for k, v in state_dict.items())
+    return state_dict
+
+
+def save_model(model, optimizer, prefix, filename, sharded=False):
+    """
+    Save both model and optimizer state.
+    Single format: prefix/filename.pt written by rank 0.
+    Sharded format (to be called on all ranks): prefix/filename/ with a manifest and the
+    model state written by rank 0, and optim.<rank>.pt with the optimizer state of the
+    parameters owned by each rank (index % world_size).
+    """
+    rank, world_size = _rank_size()
+    if not sharded:
+        if rank == 0:
+            path_name = os.path.join(prefix, filename + ".pt")
+            torch.save(
+                {
+                    "model_state_dict": model.state_dict(),
+                    "optimizer_state_dict": optimizer.state_dict(),
+                },
+                path_name,
+            )
+        return
+
+    path = os.path.join(prefix, filename)
+    os.makedirs(path, exist_ok=True)
+    optim_state = optimizer.state_dict()
+    shard = {
+        k: v for k, v in optim_state["state"].items() if k % world_size == rank
+    }
+    torch.save({"state": shard}, os.path.join(path, "optim.%05d.pt" % rank))
+    if rank == 0:
+        torch.save(model.state_dict(), os.path.join(path, "model.pt"))
+    ## All optimizer shards are on disk before the manifest is written
+    if world_size > 1:
+        dist.barrier()
+    if rank == 0:
+        manifest = {
+            "format": "sharded",
+            "world_size": world_size,
+            "model": "model.pt",
+            "optimizer": ["optim.%05d.pt" % r for r in range(world_size)],
+            "param_groups": optim_state["param_groups"],
+        }
+        ## Written last: a complete manifest means a complete checkpoint
+        torch.save(manifest, os.path.join(path, "manifest.pt"))
 
 
 def load_model(model, prefix, filename, device=None, optimizer=None):
-    """Load both model and optimizer state from a single checkpoint file"""
-    path_name = os.path.join(prefix, filename + ".pt")
-    # map_location = {"cuda:%d" % 0: get_device_name()}
+    """Load both model and optimizer state (single or sharded format)"""
+    path = os.path.join(prefix, filename)
+    if os.path.exists(os.path.join(path, "manifest.pt")):
+        manifest = torch.load(os.path.join(path, "manifest.pt"), map_location="cpu")
+        state_dict = _load(os.path.join(path, manifest["model"]))
+        model.load_state_dict(_match_prefix(model, state_dict))
+        if optimizer is not None:
+            state = dict()
+            for fname in manifest["optimizer"]:
+                state.update(_load(os.path.join(path, fname))["state"])
+            optimizer.load_state_dict(
+                {"state": state, "param_groups": manifest["param_groups"]}
+            )
+        return
+
+    path_name = path + ".pt"
     # print_master("Load existing model:", path_name)
-    checkpoint = torch.load(path_name, map_location=None)
+    checkpoint = _load(path_name)
     state_dict = checkpoint["model_state_dict"]
-    ## To be compatible with old checkpoint which was not written as a ddp model
-    if not next(iter(state_dict)).startswith("module"):
-        ddp_state_dict = OrderedDict()
-        for k, v in state_dict.items():
-            k = "module." + k
-            ddp_state_dict[k] = v
-        state_dict = ddp_state_dict
-    model.load_state_dict(state_dict)
+    model.load_state_dict(_match_prefix(model, state_dict))
     if (optimizer is not None) and ("optimizer_state_dict" in checkpoint):
         optimizer.load_state_dict(checkpoint["optimizer_state_dict"])
@@ -17,6 +17,11 @@ class VectorQuantizer(nn.Module):
         self._commitment_cost = commitment_cost
 
     def forward(self, inputs):
+        ## Distances and EMA updates stay in fp32 when called under autocast
+        with torch.autocast(device_type=inputs.device.type, enabled=False):
+            return self._forward(inputs.float())
+
+    def _forward(self, inputs):
         # convert inputs from BCHW -> BHWC
         inputs = inputs.permute(0, 2, 3, 1).contiguous()
         input_shape = inputs.shape
@@ -75,6 +80,11 @@ class VectorQuantizerEMA(nn.Module):
         self._epsilon = epsilon
 
     def forward(self, inputs):
+        ## Distances and EMA updates stay in fp32 when called under autocast
+        with torch.autocast(device_type=inputs.device.type, enabled=False):
+            return self._forward(inputs.float())
+
+    def _forward(self, inputs):
         # convert inputs from BCHW -> BHWC
         inputs = inputs.permute(0, 2, 3, 1).contiguous()
         input_shape = inputs.shape
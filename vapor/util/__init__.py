@@ -1,3 +1,11 @@
 from .config import initconf, setconf, getconf, dget
 from .logging import print_model, setup_log, log, log0, plot_one, plot_loss
 from .ddp import setup_ddp
+from .prefetch import Prefetcher
+from .metric import MetricAccumulator
+from .amp import get_autocast, get_grad_scaler
+from .gradsync import GradientSync
+from .shard import shard_work
+from .checkpoint import AsyncCheckpointer, load_training_state
+from .tracker import ErrorTracker, window_error
+from .timer import PhaseTimer, TraceWindow
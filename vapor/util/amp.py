@@ -0,0 +1,34 @@
+import contextlib
+
+import torch
+
+PRECISIONS = ("fp32", "bf16", "fp16")
+
+
+def get_autocast(device, precision=None):
+    """
+    Return an autocast context for the given device and precision ("fp32", "bf16", "fp16").
+    fp32 (or None) gives a no-op context. CPU supports bf16 only.
+    """
+    if precision in (None, "fp32"):
+        return contextlib.nullcontext()
+    device = torch.device(device)
+    if precision == "bf16":
+        dtype = torch.bfloat16
+    elif precision == "fp16":
+        if device.type == "cpu":
+            raise ValueError("fp16 autocast is not supported on CPU. Use bf16.")
+        dtype = torch.float16
+    else:
+        raise NotImplementedError(precision)
+    return torch.autocast(device_type=device.type, dtype=dtype)
+
+
+def get_grad_scaler(device, precision=None):
+    """
+    Return a GradScaler, enabled only for fp16 on GPU.
+    bf16 keeps the fp32 exponent range and does not need loss scaling.
+    """
+    device = torch.device(device)
+    enabled = (precision == "fp16") and (device.type == "cuda")
+    return torch.amp.GradScaler(device.type, enabled=enabled)
@@ -0,0 +1,210 @@
+import os
+import glob
+import re
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from .logging import log
+
+
+def to_cpu(obj):
+    """Return a copy of obj with every tensor (in nested dicts/lists/tuples) on CPU"""
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, fname):
+    """torch.save to a temporary file and rename, so fname is never partially written"""
+    tmp = "%s.tmp.%d" % (fname, os.getpid())
+    torch.save(obj, tmp)
+    os.replace(tmp, fname)
+
+
+def atomic_write(text, fname):
+    tmp = "%s.tmp.%d" % (fname, os.getpid())
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, fname)
+
+
+class AsyncCheckpointer:
+    """
+    Write checkpoints on a background thread.
+
+    save() snapshots the model (and optimizer/scheduler) state_dict to CPU and returns;
+    the file is written by a single worker thread as <path>/checkpoint.<step>.pytorch
+    through a temporary file and rename, and checkpoint.txt is updated only after the
+    write is complete. Only the last keep checkpoints are kept (keep=None keeps all).
+
+    Histories (e.g., recon error) are appended to <path>/<name>.dat (float64) with only
+    the values added since the previous save. The length at each checkpoint is stored in
+    the checkpoint so that a restart can truncate the file to a consistent state.
+    history_len truncates the files in __init__, so pass it only on the writing rank.
+    """
+
+    def __init__(self, path, keep=3, history_len=None):
+        self.path = path
+        self.keep = keep
+        os.makedirs(path, exist_ok=True)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+        self.history_len = dict()
+        self._wrote_model_txt = False
+        if history_len is not None:
+            for name, n in history_len.items():
+                self._truncate(name, n)
+
+    def _history_fname(self, name):
+        return os.path.join(self.path, "%s.dat" % name)
+
+    def _truncate(self, name, n):
+        fname = self._history_fname(name)
+        if os.path.exists(fname):
+            os.truncate(fname, min(os.path.getsize(fname), n * 8))
+        self.history_len[name] = n
+
+    def save(
+        self,
+        step,
+        model,
+        optimizer=None,
+        scheduler=None,
+        history=None,
+        extra=None,
+        dmodel=None,
+    ):
+        state = {
+            "step": step,
+            "model": to_cpu(model.state_dict()),
+            "optimizer": None if optimizer is None else to_cpu(optimizer.state_dict()),
+            "scheduler": None if scheduler is None else scheduler.state_dict(),
+            "extra": to_cpu(extra),
+        }
+        dstate = None if dmodel is None else to_cpu(dmodel.state_dict())
+
+        ## Only the new part of each history
+        tail = dict()
+        for name, values in (history or dict()).items():
+            n = self.history_len.get(name, 0)
+            tail[name] = np.array(values[n:], dtype=np.float64)
+            self.history_len[name] = len(values)
+        state["history_len"] = dict(self.history_len)
+
+        model_txt = None
+        if not self._wrote_model_txt:
+            model_txt = str(model)
+            self._wrote_model_txt = True
+
+        self.wait()
+        self.future = self.executor.submit(
+            self._write, step, state, dstate, tail, model_txt
+        )
+        return self.future
+
+    def _write(self, step, state, dstate, tail, model_txt):
+        if model_txt is not None:
+            atomic_write(model_txt, os.path.join(self.path, "model.txt"))
+        for name, values in tail.items():
+            with open(self._history_fname(name), "ab") as f:
+                values.tofile(f)
+        fname = os.path.join(self.path, "checkpoint.%d.pytorch" % step)
+        atomic_save(state, fname)
+        if dstate is not None:
+            atomic_save(
+                dstate, os.path.join(self.path, "checkpoint-dmodel.%d.pytorch" % step)
+            )
+        atomic_write(str(step), os.path.join(self.path, "checkpoint.txt"))
+        self._rotate()
+        log("Saved checkpoint: %s" % (fname))
+
+    def _rotate(self):
+        if self.keep is None:
+            return
+        steps = list()
+        for fname in glob.glob(os.path.join(self.path, "checkpoint.*.pytorch")):
+            m = re.match(r".*checkpoint\.(\d+)\.pytorch$", fname)
+            if m is not None:
+                steps.append(int(m.group(1)))
+        for step in sorted(steps)[: -self.keep]:
+            for fmt in ("checkpoint.%d.pytorch", "checkpoint-dmodel.%d.pytorch"):
+                fname = os.path.join(self.path, fmt % step)
+                if os.path.exists(fname):
+                    os.remove(fname)
+
+    def wait(self):
+        """Block until the pending write (if any) is done; re-raise its error"""
+        if self.future is not None:
+            self.future.result()
+            self.future = None
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+
+def get_rng_state():
+    """Return the python, numpy and torch (CPU/CUDA) RNG states"""
+    name, keys, pos, has_gauss, cached = np.random.get_state()
+    state = {
+        "python": random.getstate(),
+        "numpy": (
+            name,
+            torch.from_numpy(keys.astype(np.int64)),
+            pos,
+            has_gauss,
+            cached,
+        ),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    name, keys, pos, has_gauss, cached = state["numpy"]
+    np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached))
+    torch.set_rng_state(state["torch"])
+    if ("cuda" in state) and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def load_training_state(path):
+    """
+    Load the latest checkpoint written by AsyncCheckpointer in path, with its histories
+    (truncated to the checkpoint) in state["history"]. Returns None if there is none or
+    the checkpoint is a legacy pickled module.
+    """
+    try:
+        with open(os.path.join(path, "checkpoint.txt"), "r") as f:
+            step = int(f.readline())
+    except (OSError, ValueError):
+        return None
+    fname = os.path.join(path, "checkpoint.%d.pytorch" % step)
+    log("Training state:", fname)
+    ## weights_only=False: legacy checkpoints pickle the whole module
+    state = torch.load(fname, map_location="cpu", weights_only=False)
+    if not isinstance(state, dict):
+        return None
+    state["history"] = dict()
+    for name, n in state.get("history_len", dict()).items():
+        state["history"][name] = read_history(path, name, n).tolist()
+    return state
+
+
+def read_history(path, name, n=None):
+    """Read a history appended by AsyncCheckpointer (up to n values)"""
+    fname = os.path.join(path, "%s.dat" % name)
+    if not os.path.exists(fname):
+        return np.zeros(0, dtype=np.float64)
+    x = np.fromfile(fname, dtype=np.float64)
+    return x if n is None else x[:n]
@@ -0,0 +1,175 @@
+import torch
+
+
+class _Bucket:
+    def __init__(self, params, dtype, pin):
+        self.params = params
+        self.offsets = list()
+        n = 0
+        for p in params:
+            self.offsets.append(n)
+            n += p.numel()
+        self.buffer = torch.zeros(n, dtype=dtype, pin_memory=pin)
+        self.array = self.buffer.numpy()
+        self.pending = set()
+        self.request = None
+
+    def pack(self):
+        for p, k in zip(self.params, self.offsets):
+            dst = self.buffer[k : k + p.numel()]
+            if p.grad is None:
+                dst.zero_()
+            else:
+                dst.copy_(p.grad.detach().reshape(-1))
+
+    def unpack(self, scale):
+        for p, k in zip(self.params, self.offsets):
+            if p.grad is None:
+                continue
+            src = self.buffer[k : k + p.numel()].view_as(p.grad)
+            p.grad.copy_(src, non_blocking=True).mul_(scale)
+
+
+def replaced_in_forward(model):
+    """
+    Parameters that are replaced by new Parameters in every training forward: the
+    _ema_w and _embedding.weight of the EMA vector quantizers. Hooks registered on them
+    would never fire, so they are left out of the buckets.
+    """
+    params = list()
+    for m in model.modules():
+        if hasattr(m, "_ema_w") and hasattr(m, "_decay"):
+            params.extend(m.parameters())
+    return params
+
+
+class GradientSync:
+    """
+    Bucketed gradient averaging over an mpi4py communicator.
+
+    Gradients are packed into fixed-size contiguous host buffers and reduced with the
+    buffer-based Iallreduce on NumPy views of the buffers (no pickling). With overlap,
+    buckets are launched (in order) from a post-accumulate-grad hook as soon as all of
+    their gradients are ready, so the reduction runs while backward continues.
+    synchronize() launches what is left, waits and writes the averaged gradients back.
+
+    Parameters of the model that are not in a bucket (the ones replaced by the EMA
+    vector quantizer in forward, see replaced_in_forward) or have no gradient are
+    handled in one extra Allreduce in synchronize(): their gradient is averaged if
+    present, otherwise the parameter values are averaged.
+
+    With comm=None (or a single rank) everything is a no-op. Set enabled=False before
+    backward to skip steps (e.g., with --average_interval).
+    """
+
+    def __init__(self, model, comm=None, bucket_cap_mb=25, overlap=True):
+        self.model = model
+        self.comm = comm
+        self.size = 1 if comm is None else comm.Get_size()
+        self.enabled = True
+        self.buckets = list()
+        self.bucket_of = dict()
+        self._handles = list()
+        if self.size == 1:
+            return
+
+        from mpi4py import MPI
+
+        self.MPI = MPI
+
+        replaced = set(id(p) for p in replaced_in_forward(model))
+        params = [
+            p for p in model.parameters() if p.requires_grad and id(p) not in replaced
+        ]
+        ## Backward produces gradients roughly in reverse order of definition
+        params = params[::-1]
+        pin = torch.cuda.is_available()
+        cap = bucket_cap_mb * 2 ** 20
+        groups = dict()
+        for p in params:
+            dtype = p.dtype
+            if dtype not in (torch.float32, torch.float64):
+                dtype = torch.float32
+            cur = groups.setdefault(dtype, [list(), 0])
+            cur[0].append(p)
+            cur[1] += p.numel() * p.element_size()
+            if cur[1] >= cap:
+                self._add_bucket(cur[0], dtype, pin)
+                groups[dtype] = [list(), 0]
+        for dtype, (plist, _) in groups.items():
+            if len(plist) > 0:
+                self._add_bucket(plist, dtype, pin)
+
+        if overlap:
+            for p in params:
+                if getattr(p, "register_post_accumulate_grad_hook", None) is None:
+                    break
+                self._handles.append(p.register_post_accumulate_grad_hook(self._hook))
+        self._reset()
+
+    def _add_bucket(self, params, dtype, pin):
+        bucket = _Bucket(params, dtype, pin)
+        for p in params:
+            self.bucket_of[id(p)] = bucket
+        self.buckets.append(bucket)
+
+    def _reset(self):
+        for bucket in self.buckets:
+            bucket.pending = set(id(p) for p in bucket.params)
+            bucket.request = None
+        self._next = 0
+
+    def _launch(self, bucket):
+        bucket.pack()
+        bucket.request = self.comm.Iallreduce(
+            self.MPI.IN_PLACE, bucket.array, op=self.MPI.SUM
+        )
+
+    def _hook(self, param):
+        if not self.enabled:
+            return
+        bucket = self.bucket_of.get(id(param))
+        if bucket is None:
+            return
+        bucket.pending.discard(id(param))
+        ## Collectives are issued in bucket order so that all ranks match
+        while self._next < len(self.buckets):
+            bucket = self.buckets[self._next]
+            if len(bucket.pending) > 0:
+                break
+            self._launch(bucket)
+            self._next += 1
+
+    def synchronize(self):
+        """Finish the reduction and replace gradients with their average"""
+        if self.size == 1:
+            return
+
+        for bucket in self.buckets[self._next :]:
+            self._launch(bucket)
+
+        ## Parameters not covered by the buckets (re-queried every call)
+        extra = list()
+        for p in self.model.parameters():
+            if (id(p) in self.bucket_of) and (p.grad is not None):
+                continue
+            extra.append(p.grad if p.grad is not None else p.data)
+        if len(extra) > 0:
+            flat = torch.cat([x.detach().reshape(-1).float().cpu() for x in extra])
+            self.comm.Allreduce(self.MPI.IN_PLACE, flat.numpy(), op=self.MPI.SUM)
+            flat /= self.size
+            k = 0
+            for x in extra:
+                n = x.numel()
+                x.copy_(flat[k : k + n].view_as(x))
+                k += n
+
+        self.MPI.Request.Waitall([bucket.request for bucket in self.buckets])
+        for bucket in self.buckets:
+            bucket.unpack(1.0 / self.size)
+        self._reset()
+
+    def remove(self):
+        for h in self._handles:
+            h.remove()
+        self._handles = list()
@@ -0,0 +1,72 @@
+import torch
+
+
+class MetricAccumulator:
+    """
+    Keep per-step training metrics on the device and move them to the host in blocks.
+
+    update() only stacks detached tensors; the host copy (and TensorBoard write) happens in
+    flush(), which is called every interval steps. Running sums are kept on the device so
+    the mean over all updates since reset() needs a single transfer.
+    """
+
+    def __init__(self, names, interval=100, device=None, writer=None, tags=None):
+        self.names = list(names)
+        self.interval = interval
+        self.device = device
+        self.writer = writer
+        self.tags = tags if tags is not None else dict()
+        self.history = {name: list() for name in self.names}
+        self.steps = list()
+        self._buf = list()
+        self._bufsteps = list()
+        self._sums = None
+        self._count = 0
+
+    def _to_tensor(self, x):
+        if not torch.is_tensor(x):
+            x = torch.tensor(x)
+        x = x.detach().reshape(())
+        if self.device is None:
+            self.device = x.device
+        return x.to(self.device, torch.float32, non_blocking=True)
+
+    def update(self, step, **values):
+        row = torch.stack([self._to_tensor(values[name]) for name in self.names])
+        self._buf.append(row)
+        self._bufsteps.append(step)
+        self._sums = row if self._sums is None else self._sums + row
+        self._count += 1
+        if len(self._buf) >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """Copy buffered values to the host and write them to TensorBoard"""
+        if len(self._buf) == 0:
+            return
+        block = torch.stack(self._buf).cpu().numpy()
+        for k, name in enumerate(self.names):
+            self.history[name].extend(block[:, k].tolist())
+        self.steps.extend(self._bufsteps)
+
+        if self.writer is not None:
+            for k, name in enumerate(self.names):
+                tag = self.tags.get(name)
+                if tag is None:
+                    continue
+                for step, val in zip(self._bufsteps, block[:, k]):
+                    self.writer.add_scalar(tag, val, step)
+
+        self._buf = list()
+        self._bufsteps = list()
+
+    def mean(self):
+        """Return the mean of each metric since the last reset as a dict"""
+        if self._count == 0:
+            return {name: float("nan") for name in self.names}
+        x = (self._sums / self._count).cpu().numpy()
+        return dict(zip(self.names, x.tolist()))
+
+    def reset(self):
+        self._sums = None
+        self._count = 0
@@ -0,0 +1,116 @@
+import time
+import queue
+import threading
+
+import torch
+
+
+class Prefetcher:
+    """
+    Wrap a DataLoader and stage the next batch on the device while the current one is used.
+
+    On CUDA, the copy is issued with non_blocking on a side stream (pinned memory is needed
+    for a real overlap). Otherwise, a background thread fetches and moves the next batches.
+    Only the fields listed in keys are moved; the others are dropped from the sample.
+    """
+
+    def __init__(self, loader, device, keys=None, depth=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.keys = keys
+        self.depth = depth
+        self.wait_time = 0.0
+        self.compute_time = 0.0
+        self.nbatch = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _move(self, sample):
+        if isinstance(sample, dict):
+            keys = sample.keys() if self.keys is None else self.keys
+            return {k: sample[k].to(self.device, non_blocking=True) for k in keys}
+        keys = range(len(sample)) if self.keys is None else self.keys
+        return [sample[k].to(self.device, non_blocking=True) for k in keys]
+
+    def _iter_cuda(self):
+        stream = torch.cuda.Stream(device=self.device)
+
+        def stage(it):
+            try:
+                sample = next(it)
+            except StopIteration:
+                return None
+            with torch.cuda.stream(stream):
+                return self._move(sample)
+
+        it = iter(self.loader)
+        nxt = stage(it)
+        while nxt is not None:
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+            sample = nxt
+            for v in sample.values() if isinstance(sample, dict) else sample:
+                v.record_stream(torch.cuda.current_stream(self.device))
+            nxt = stage(it)
+            yield sample
+
+    def _iter_thread(self):
+        q = queue.Queue(maxsize=self.depth)
+        done = object()
+        stop = threading.Event()
+
+        def worker():
+            try:
+                for sample in self.loader:
+                    if stop.is_set():
+                        return
+                    q.put(self._move(sample))
+                q.put(done)
+            except Exception as e:
+                q.put(e)
+
+        t = threading.Thread(target=worker, daemon=True)
+        t.start()
+        try:
+            while True:
+                sample = q.get()
+                if sample is done:
+                    break
+                if isinstance(sample, Exception):
+                    raise sample
+                yield sample
+        finally:
+            ## unblock the worker if the consumer stops early
+            stop.set()
+            while t.is_alive():
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    t.join(0.01)
+
+    def __iter__(self):
+        if self.device.type == "cuda":
+            it = self._iter_cuda()
+        else:
+            it = self._iter_thread()
+
+        t0 = time.time()
+        while True:
+            try:
+                sample = next(it)
+            except StopIteration:
+                break
+            t1 = time.time()
+            self.wait_time += t1 - t0
+            self.nbatch += 1
+            yield sample
+            t0 = time.time()
+            self.compute_time += t0 - t1
+
+    def timing(self):
+        """Return accumulated (data wait, compute) seconds and the number of batches"""
+        return {
+            "wait": self.wait_time,
+            "compute": self.compute_time,
+            "nbatch": self.nbatch,
+        }
@@ -0,0 +1,30 @@
+import heapq
+
+import numpy as np
+
+
+def shard_work(units, size, rank, weights=None, shuffle=False, seed=0, epoch=0):
+    """
+    Assign work units to ranks with balanced total weight (e.g., number of samples).
+
+    Units are handed out largest-first to the least loaded rank (LPT). With shuffle,
+    ties are broken by a permutation drawn from (seed, epoch), so calling again with a
+    new epoch gives a different assignment. The result is the same on every rank.
+    Returns the list of units for this rank, in their original order.
+    """
+    n = len(units)
+    weights = np.ones(n) if weights is None else np.asarray(weights, dtype=np.float64)
+    order = np.arange(n)
+    if shuffle:
+        rng = np.random.default_rng(seed + epoch)
+        order = rng.permutation(n)
+    order = order[np.argsort(-weights[order], kind="stable")]
+
+    heap = [(0.0, r) for r in range(size)]
+    owner = np.zeros(n, dtype=np.int64)
+    for k in order:
+        load, r = heapq.heappop(heap)
+        owner[k] = r
+        heapq.heappush(heap, (load + weights[k], r))
+
+    return [units[k] for k in range(n) if owner[k] == rank]
@@ -0,0 +1,135 @@
+import time
+import logging
+import contextlib
+from collections import defaultdict, deque
+
+import torch
+
+
+class PhaseTimer:
+    """
+    Named wall-clock timers for the phases of a training step.
+
+        with timer.phase("forward"):
+            ...
+
+    Each phase is also a torch.profiler record_function range, so it shows up in
+    Chrome traces. With sync=True, CUDA is synchronized around each phase so the times
+    are not attributed to whichever phase happens to wait. log() emits the mean over the
+    last window steps to the log and TensorBoard (Time/<phase>, in ms).
+    """
+
+    def __init__(self, window=100, sync=False, writer=None, enabled=True):
+        self.window = window
+        self.sync = sync and torch.cuda.is_available()
+        self.writer = writer
+        self.enabled = enabled
+        self.history = defaultdict(lambda: deque(maxlen=window))
+        self.order = list()
+        self._start = dict()
+        self._range = dict()
+        self._hooks = False
+
+    def start(self, name):
+        if not self.enabled:
+            return
+        if self.sync:
+            torch.cuda.synchronize()
+        self._range[name] = torch.profiler.record_function(name)
+        self._range[name].__enter__()
+        self._start[name] = time.perf_counter()
+
+    def stop(self, name):
+        if not self.enabled or (name not in self._start):
+            return
+        if self.sync:
+            torch.cuda.synchronize()
+        t = time.perf_counter() - self._start.pop(name)
+        self._range.pop(name).__exit__(None, None, None)
+        if name not in self.history:
+            self.order.append(name)
+        self.history[name].append(t)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(name)
+
+    @contextlib.contextmanager
+    def hooks(self):
+        """Enable the attach() timers, e.g., only around the training forward"""
+        self._hooks = True
+        try:
+            yield
+        finally:
+            self._hooks = False
+
+    def attach(self, module, name):
+        """
+        Time the forward calls of module (e.g., the quantizer inside the model) made
+        inside a hooks() block, so evaluation forwards are not counted.
+        """
+
+        def start(m, x):
+            if self._hooks:
+                self.start(name)
+
+        def stop(m, x, y):
+            if self._hooks:
+                self.stop(name)
+
+        module.register_forward_pre_hook(start)
+        module.register_forward_hook(stop)
+
+    def summary(self):
+        """Mean time (ms) per phase over the window"""
+        return {
+            name: 1e3 * sum(self.history[name]) / len(self.history[name])
+            for name in self.order
+            if len(self.history[name]) > 0
+        }
+
+    def log(self, step):
+        if not self.enabled:
+            return
+        s = self.summary()
+        logging.info(
+            "%d phase (ms): %s"
+            % (step, " ".join(["%s=%.3f" % (k, v) for k, v in s.items()]))
+        )
+        if self.writer is not None:
+            for k, v in s.items():
+                self.writer.add_scalar("Time/%s" % k, v, step)
+
+
+class TraceWindow:
+    """
+    Record a torch.profiler Chrome trace for steps [start, stop) and export it to fname.
+    Call step(i) at the beginning of every step.
+    """
+
+    def __init__(self, start, stop, fname):
+        self.start = start
+        self.stop = stop
+        self.fname = fname
+        self.prof = None
+
+    def step(self, i):
+        if (i == self.start) and (self.prof is None):
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.prof = torch.profiler.profile(activities=activities)
+            self.prof.__enter__()
+        elif (i == self.stop) and (self.prof is not None):
+            self.close()
+
+    def close(self):
+        if self.prof is not None:
+            self.prof.__exit__(None, None, None)
+            self.prof.export_chrome_trace(self.fname)
+            logging.info("Chrome trace: %s" % self.fname)
+            self.prof = None
@@ -0,0 +1,41 @@
+import torch
+
+
+def window_error(recon, target):
+    """Per-window error: max over channels of the RMSE of each (H, W) slice"""
+    x = (recon.detach().float() - target.detach().float()) ** 2
+    rmse = torch.sqrt(torch.mean(x.reshape(x.shape[0], x.shape[1], -1), dim=-1))
+    return torch.max(rmse, dim=1)[0]
+
+
+class ErrorTracker:
+    """
+    Keep the latest reconstruction error of every training window on the device.
+
+    update() records the error of the windows in a training batch (a byproduct of the
+    forward pass). stale() returns the windows not updated for the longest time, to be
+    refreshed with a small probe batch. weights() gives the current error vector for
+    the sampler; windows never seen use the mean of the seen ones.
+    """
+
+    def __init__(self, num_windows, device=None):
+        self.err = torch.zeros(num_windows, device=device)
+        self.stamp = torch.full((num_windows,), -1, dtype=torch.long, device=device)
+
+    def update(self, idx, values, step):
+        idx = idx.to(self.err.device, non_blocking=True)
+        self.err[idx] = values.detach().to(self.err.device, torch.float32)
+        self.stamp[idx] = step
+
+    def stale(self, k):
+        k = min(k, len(self.stamp))
+        return torch.topk(-self.stamp, k)[1]
+
+    def weights(self):
+        seen = self.stamp >= 0
+        err = self.err.clone()
+        if seen.any():
+            err[~seen] = err[seen].mean()
+        else:
+            err[:] = 1.0
+        return err.cpu().numpy()
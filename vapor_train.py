@@ -40,6 +40,7 @@ if __name__ == "__main__":
     checkpoint_period = dget(config, "checkpoint_period", 100)
     log_period = dget(config, "log_period", 100)
     plot_period = dget(config, "plot_period", 100)
+    checkpoint_format = dget(config, "checkpoint_format", "single")
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     world_size, rank = MPI.COMM_WORLD.Get_size(), MPI.COMM_WORLD.Get_rank()
@@ -141,6 +142,11 @@ if __name__ == "__main__":
     exp.train_loader = training_loader
     exp.validation_loader = validation_loader
     exp.loss_fn = torch.nn.MSELoss()
+    log(
+        "effective batch_size",
+        batch_size * exp.accumulation_steps * world_size,
+        "(accumulation_steps: %d)" % exp.accumulation_steps,
+    )
 
     if rank == 0:
         print_model(exp.model)
@@ -171,14 +177,25 @@ if __name__ == "__main__":
                 "Epoch %d loss,lr: %g %g %g"
                 % (k + 1, bx, exp.optimizer.param_groups[0]["lr"], time.time() - t0)
             )
+            log(
+                "Epoch %d data wait,compute: %g %g"
+                % (k + 1, exp.timing["wait"], exp.timing["compute"])
+            )
 
         if (k + 1) % plot_period == 0 and rank == 0:
             plot_one(lr, hr, recon, istep=k + 1, scale_each=False, prefix=prefix)
             plot_loss(train_step, train_loss, istep=k + 1, prefix=prefix)
 
-        if (k + 1) % checkpoint_period == 0 and rank == 0:
+        if (k + 1) % checkpoint_period == 0:
+            ## All ranks: each writes its own shard with the sharded format
             fname = "model-%d" % (k + 1)
-            save_model(exp.model, exp.optimizer, prefix, fname)
-            log("Save model:", fname)
+            save_model(
+                exp.model,
+                exp.optimizer,
+                prefix,
+                fname,
+                sharded=(checkpoint_format == "sharded"),
+            )
+            log0("Save model:", fname)
 
     log("Done.")
@@ -24,6 +24,7 @@ from torch.autograd import Variable
 
 from models import *
 from datasets import *
+from vapor.util.amp import PRECISIONS, get_autocast, get_grad_scaler
 
 import torch.nn as nn
 import torch.nn.functional as F
@@ -113,6 +114,12 @@ parser.add_argument(
     "--nchannel", type=int, default=1, help="num. of channels (default: %(default)s)"
 )
 parser.add_argument("--modelfile", help="modelfile (default: %(default)s)")
+parser.add_argument(
+    "--precision",
+    choices=PRECISIONS,
+    default="fp32",
+    help="training precision (default: %(default)s)",
+)
 group = parser.add_mutually_exclusive_group()
 group.add_argument(
     "--N20", help="N20 model", action="store_const", dest="model", const="N20"
@@ -183,6 +190,9 @@ optimizer_D = torch.optim.Adam(
 )
 
 Tensor = torch.cuda.FloatTensor if cuda else torch.Tensor
+device = torch.device("cuda" if cuda else "cpu")
+scaler_G = get_grad_scaler(device, opt.precision)
+scaler_D = get_grad_scaler(device, opt.precision)
 
 mean = 0.121008 * 2
 std = 0.217191
@@ -228,32 +238,40 @@ for epoch in range(opt.epoch, opt.n_epochs):
 
         optimizer_G.zero_grad()
 
-        # Generate a high resolution image from low resolution input
-        gen_hr = generator(imgs_lr)
+        ## Forward passes under autocast; the losses are computed in fp32
+        with get_autocast(device, opt.precision):
+            # Generate a high resolution image from low resolution input
+            gen_hr = generator(imgs_lr)
+
+            # valid.shape: torch.Size([16, 1, 16, 16])
+            # fake.shape: torch.Size([16, 1, 16, 16])
+            # discriminator(gen_hr).shape: torch.Size([16, 1, 16, 16])
+            out = discriminator(gen_hr)
+
+            if opt.nchannel == 3:
+                _gen_hr = torch.cat((gen_hr, gen_hr, gen_hr), dim=1)
+                _imgs_hr = torch.cat((imgs_hr, imgs_hr, imgs_hr), dim=1)
+                gen_features = feature_extractor(_gen_hr)
+                real_features = feature_extractor(_imgs_hr)
+            else:
+                gen_features = feature_extractor(gen_hr)
+                real_features = feature_extractor(imgs_hr)
 
         # Adversarial loss
-        # valid.shape: torch.Size([16, 1, 16, 16])
-        # fake.shape: torch.Size([16, 1, 16, 16])
-        # discriminator(gen_hr).shape: torch.Size([16, 1, 16, 16])
-        loss_GAN = criterion_GAN(discriminator(gen_hr), valid)
+        loss_GAN = criterion_GAN(out.float(), valid)
 
         # Content loss
-        if opt.nchannel == 3:
-            _gen_hr = torch.cat((gen_hr, gen_hr, gen_hr), dim=1)
-            _imgs_hr = torch.cat((imgs_hr, imgs_hr, imgs_hr), dim=1)
-            gen_features = feature_extractor(_gen_hr)
-            real_features = feature_extractor(_imgs_hr)
-        else:
-            gen_features = feature_extractor(gen_hr)
-            real_features = feature_extractor(imgs_hr)
-        loss_content = criterion_content(gen_features, real_features.detach())
+        loss_content = criterion_content(
+            gen_features.float(), real_features.detach().float()
+        )
         # loss_content = criterion_content(gen_hr, imgs_hr)
 
         # Total loss
         loss_G = loss_content + 1e-3 * loss_GAN
 
-        loss_G.backward()
-        optimizer_G.step()
+        scaler_G.scale(loss_G).backward()
+        scaler_G.step(optimizer_G)
+        scaler_G.update()
 
         # ---------------------
         #  Train Discriminator
@@ -262,14 +280,18 @@ for epoch in range(opt.epoch, opt.n_epochs):
         optimizer_D.zero_grad()
 
         # Loss of real and fake images
-        loss_real = criterion_GAN(discriminator(imgs_hr), valid)
-        loss_fake = criterion_GAN(discriminator(gen_hr.detach()), fake)
+        with get_autocast(device, opt.precision):
+            real_out = discriminator(imgs_hr)
+            fake_out = discriminator(gen_hr.detach())
+        loss_real = criterion_GAN(real_out.float(), valid)
+        loss_fake = criterion_GAN(fake_out.float(), fake)
 
         # Total loss
         loss_D = (loss_real + loss_fake) / 2
 
-        loss_D.backward()
-        optimizer_D.step()
+        scaler_D.scale(loss_D).backward()
+        scaler_D.step(optimizer_D)
+        scaler_D.update()
 
         # --------------
         #  Log Progress
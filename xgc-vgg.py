@@ -10,7 +10,6 @@ import torch.optim as optim
 from torch.utils.data import DataLoader, random_split, WeightedRandomSampler
 from torch.utils.data import Dataset
 from PIL import Image, ImageFile
-from skimage.transform import resize
 
 from torchvision import datasets, models, transforms
 
@@ -24,6 +23,8 @@ import argparse
 import logging
 import sys
 
+from vapor.dataset.mesh import load_mesh, digitizing, nearest_index_map
+
 # %%
 def visualize_model(model, dataloaders, num_images=6):
     def _imshow(inp, title=None):
@@ -74,20 +75,6 @@ def show_databatch(inputs, classes):
     imshow(out, title=[x.item() for x in classes])
 
 
-def digitizing(x, nbins):
-    """
-    idx ranges from 1 ... nbins
-    nan is 0
-    """
-    assert nbins > 1
-    _x = x[~np.isnan(x)]
-    _, bins = np.histogram(_x, bins=nbins)
-    idx = np.digitize(x, bins, right=True)
-    idx = np.where(idx == 0, 1, idx)
-    idx = np.where(idx == nbins + 1, 0, idx)
-    return (idx, bins)
-
-
 class XGCFDataset(Dataset):
     def __init__(self, expdir, step_list, nchannel, nclass, shape):
 
@@ -105,46 +92,35 @@ class XGCFDataset(Dataset):
             i_f = i_f.astype(np.float32)
             nphi, nnodes, nx, ny = i_f.shape
 
-            for iphi in range(nphi):
-                for i in range(nnodes):
-                    X = i_f[iphi, i, :, :]
-                    X = (X - np.min(X)) / (np.max(X) - np.min(X))
-                    # X = X[np.newaxis,:,:]
-                    # X = np.vstack([X,X,X])
-                    lx.append(X)
-                    ly.append(nclass[i])
-
-        self.X = np.array(lx)
-        self.y = np.array(ly)
+            ## Min-max normalization of all (iphi, node) slices at once
+            X = i_f.reshape((nphi * nnodes, nx, ny))
+            xmin = np.min(X, axis=(1, 2), keepdims=True)
+            xmax = np.max(X, axis=(1, 2), keepdims=True)
+            X -= xmin
+            X /= xmax - xmin
+            lx.append(X)
+            ly.append(np.tile(np.asarray(nclass)[:nnodes], nphi))
+            del i_f
+
+        self.X = np.concatenate(lx)
+        self.y = np.concatenate(ly)
         self.mean = np.mean(self.X)
         self.std = np.std(self.X)
         logging.debug("Dataset mean, std: %f %f" % (self.mean, self.std))
 
-        self.transform = transforms.Compose(
-            [
-                # transforms.ToPILImage(),
-                # transforms.Resize((hr_height, hr_height), Image.BICUBIC),
-                # transforms.ToTensor(),
-                # transforms.Normalize(mean, std),
-            ]
+        ## Nearest-neighbor upsample (skimage resize order=0) as one gather per sample
+        self.rows, self.cols = nearest_index_map(
+            self.X.shape[1:], (self.hr_height, self.hr_height)
         )
 
     def __getitem__(self, index):
         i = index
-        X = self.X[i, :]
-        ## 0: Nearest-neighbor, 1: Bi-linear, 2: Bi-quadratic, 3: Bi-cubic
-        X = resize(X, (self.hr_height, self.hr_height), order=0, anti_aliasing=False)
-        # (2021/02) Mnay problems for using PIL with numpy
-        # im = transforms.ToPILImage()(X)
-        # im = transforms.Resize((self.hr_height, self.hr_height), Image.BICUBIC)(im)
-        # X = np.array(im)
-        X = transforms.ToTensor()(X)
-        X = transforms.Normalize(self.mean, self.std)(X)
+        X = self.X[i][self.rows[:, np.newaxis], self.cols[np.newaxis, :]]
+        X = (X - self.mean) / self.std
+        X = torch.from_numpy(X.astype(np.float32)).unsqueeze(0)
         if self.nchannel == 3:
-            X = torch.cat([X, X, X])
+            X = X.expand(3, -1, -1)
         y = torch.tensor(self.y[i])
-        # print ('X:', X.shape, X.min(), X.max(), i)
-        # import pdb; pdb.set_trace()
         return (X, y)
 
     def __len__(self):
@@ -203,34 +179,11 @@ if __name__ == "__main__":
         logging.debug("\t{0}: {1}".format(k, v))
 
     # %%
-    # psi_surf: psi value of each surface
-    # surf_len: # of nodes of each surface
-    # surf_idx: list of node index of each surface
-    with ad2.open("d3d_coarse_v2_4x/xgc.mesh.bp", "r") as f:
-        nnodes = int(
-            f.read(
-                "n_n",
-            )
-        )
-        ncells = int(
-            f.read(
-                "n_t",
-            )
-        )
-        rz = f.read("rz")
-        conn = f.read("nd_connect_list")
-        psi = f.read("psi")
-        nextnode = f.read("nextnode")
-        epsilon = f.read("epsilon")
-        node_vol = f.read("node_vol")
-        node_vol_nearest = f.read("node_vol_nearest")
-        psi_surf = f.read("psi_surf")
-        surf_idx = f.read("surf_idx")
-        surf_len = f.read("surf_len")
-        theta = f.read("theta")
-
-    r = rz[:, 0]
-    z = rz[:, 1]
+    ## Node-to-surface topology (surface id, psi, theta bin, inboard/outboard)
+    mesh = load_mesh("d3d_coarse_v2_4x/xgc.mesh.bp")
+    nnodes = mesh.nnodes
+    r = mesh.r
+    z = mesh.z
     print(nnodes)
 
     # %%
@@ -242,11 +195,7 @@ if __name__ == "__main__":
     # %%
     if opt.model == "N20":
         ## 20 classes
-        fmax = list()
-        for i in range(len(psi_surf)):
-            n = surf_len[i]
-            k = surf_idx[i, :n] - 1
-            fmax.append(np.max(i_f[:, k, :, :]))
+        fmax = mesh.surf_reduce(np.max(i_f, axis=(0, 2, 3)))
 
         lx = np.log10(fmax)
         # plt.figure(figsize=[16,4])
@@ -257,40 +206,23 @@ if __name__ == "__main__":
         # for i in range(len(lx)):
         #     plt.text(i, lx[i], str(inds[i]))
 
-        nclass = np.zeros(len(rz), dtype=np.int)
-        for i in range(len(psi_surf)):
-            n = surf_len[i]
-            k = surf_idx[i, :n] - 1
-            nclass[k] = inds[i] * 2
-
-        for i in range(len(rz)):
-            if r[i] < r[0]:
-                nclass[i] = nclass[i] + 1
+        nclass = np.zeros(nnodes, dtype=int)
+        nclass[mesh.members_node] = inds[mesh.members_surf] * 2
+        nclass += mesh.inboard
 
     if opt.model == "N200":
         ## 202 classes
-        nclass = np.zeros(len(rz), dtype=np.int)
-        for i in range(len(psi_surf)):
-            n = surf_len[i]
-            k = surf_idx[i, :n] - 1
-            nclass[k] = i * 2
-
-        for i in range(len(rz)):
-            if r[i] > r[0]:
-                nclass[i] = nclass[i] + 1
+        nclass = np.zeros(nnodes, dtype=int)
+        nclass[mesh.members_node] = mesh.members_surf * 2
+        nclass += mesh.outboard
 
     if opt.model == "N1000":
         ## 1088 classes
-        x = np.where(theta == -10, np.nan, theta)
-        theta_id, theta_bins = digitizing(x, 32)
-
-        node_psi = np.zeros_like(theta)
-        node_psi[:] = np.nan
-        for i in range(len(psi_surf)):
-            n = surf_len[i]
-            k = surf_idx[i, :n]
-            node_psi[k] = psi_surf[i]
+        theta_id = mesh.theta_bin(32)
 
+        ## surf_idx is 1-based and was used as is: each node has the psi of the
+        ## surface of the previous node. Kept for the existing N1000 labels.
+        node_psi = np.concatenate([[np.nan], mesh.surf_psi[:-1]])
         psi_id, psi_bins = digitizing(node_psi, 32)
 
         nclass = psi_id * 33 + theta_id
@@ -322,16 +254,12 @@ if __name__ == "__main__":
     )
     logging.debug("Split: %d %d" % (len(training_data), len(validation_data)))
 
-    p_training_data = np.zeros(len(training_data))
-    for i, (_, y) in enumerate(training_data):
-        k = y.item()
-        p_training_data[i] = 1.0 / fcls[k]
+    ## Inverse class frequency of each sample, from the labels only (no image access)
+    ncounts = np.bincount(nclass)
+    p_training_data = 1.0 / ncounts[dataset.y[training_data.indices]]
     p_training_data = p_training_data / np.sum(p_training_data)
 
-    p_validation_data = np.zeros(len(validation_data))
-    for i, (_, y) in enumerate(validation_data):
-        k = y.item()
-        p_validation_data[i] = 1.0 / fcls[k]
+    p_validation_data = 1.0 / ncounts[dataset.y[validation_data.indices]]
     p_validation_data = p_validation_data / np.sum(p_validation_data)
 
     training_sample_size = len(fcls) * batch_size * 80